@@ -12,5 +12,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'app.settings')
+# 読み込みの多いページと API を非同期ビュー (paplib.async_views) で処理する
+os.environ.setdefault('PAPLIB_ASYNC_VIEWS', '1')
 
 application = get_asgi_application()
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -40,9 +41,11 @@ INSTALLED_APPS = [
     'paplib',
     'django_bootstrap5',
     'rest_framework',
+    'rest_framework.authtoken',
 ]
 
 MIDDLEWARE = [
+    'paplib.profiling.RequestProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -52,7 +55,10 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
-ROOT_URLCONF = 'app.urls'
+# ASGI (app/asgi.py) では読み込み用の非同期ビューを使う。WSGI では全て同期のビューのまま
+PAPLIB_ASYNC_VIEWS = os.environ.get('PAPLIB_ASYNC_VIEWS') == '1'
+
+ROOT_URLCONF = 'app.urls_async' if PAPLIB_ASYNC_VIEWS else 'app.urls'
 
 TEMPLATES = [
     {
@@ -75,14 +81,107 @@ WSGI_APPLICATION = 'app.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# SQLite を同時書き込みに耐える設定で使う。
+# WAL で読み込みと書き込みを並行させ、書き込むトランザクションは最初から書き込みロックを取る
+# (途中でロックを昇格できずに "database is locked" になるのを防ぐ)。
+# synchronous=NORMAL は WAL なら壊れないが、電源断で直前のコミットが失われることはある。
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,  # ミリ秒
+    'cache_size': -20000,  # 負の値は KiB 単位 (約20MB)
+    'mmap_size': 128 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+}
+
+# PAPLIB_SQLITE_PROFILE=default で Django の既定の設定に戻せる (bench_sqlite での比較用)
+SQLITE_PROFILES = {
+    'default': {},
+    'tuned': {
+        # リクエストごとに接続し直さない
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'transaction_mode': 'IMMEDIATE',
+            'init_command': ';'.join(f'PRAGMA {name}={value}' for name, value in SQLITE_PRAGMAS.items()),
+        },
+    },
+}
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        **SQLITE_PROFILES[os.environ.get('PAPLIB_SQLITE_PROFILE', 'tuned')],
     }
 }
 
 
+# Cache
+# 山の一覧ページ・山のAPIの応答をキャッシュする。PAPLIB_CACHE で locmem / file / db を選ぶ
+# (db の場合は先に `python manage.py createcachetable` を実行する)
+
+_CACHE_BACKENDS = {
+    'locmem': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'paplib',
+    },
+    'file': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache',
+    },
+    'db': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'paplib_cache',
+    },
+}
+
+CACHES = {
+    'default': {
+        **_CACHE_BACKENDS[os.environ.get('PAPLIB_CACHE', 'locmem')],
+        'TIMEOUT': 600,
+    },
+}
+
+PAPLIB_CACHE_ALIAS = 'default'
+PAPLIB_CACHE_TIMEOUT = 600
+
+
+# Request profiling (paplib.profiling)
+# 詳しく測るリクエストの割合 (0〜1)。測ったリクエストには Server-Timing ヘッダーが付く
+
+PAPLIB_PROFILE_SAMPLE_RATE = float(os.environ.get('PAPLIB_PROFILE_SAMPLE_RATE', '1.0' if DEBUG else '0.05'))
+# これより遅いリクエストを slow log (paplib.slow_requests) に書く
+PAPLIB_SLOW_REQUEST_MS = int(os.environ.get('PAPLIB_SLOW_REQUEST_MS', '500'))
+# slow log に載せる遅いクエリの件数
+PAPLIB_SLOW_QUERY_COUNT = 5
+
+# PAPLIB_SLOW_LOG にファイル名を指定するとそこへ、なければ標準エラー出力へ書く
+PAPLIB_SLOW_LOG = os.environ.get('PAPLIB_SLOW_LOG')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'message': {'format': '%(asctime)s %(message)s'},
+    },
+    'handlers': {
+        'slow_requests': (
+            {'class': 'logging.FileHandler', 'filename': PAPLIB_SLOW_LOG, 'formatter': 'message'}
+            if PAPLIB_SLOW_LOG else
+            {'class': 'logging.StreamHandler', 'formatter': 'message'}
+        ),
+    },
+    'loggers': {
+        'paplib.slow_requests': {
+            'handlers': ['slow_requests'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -128,4 +227,71 @@ LOGIN_REDIRECT_URL = '/'
 LOGOUT_REDIRECT_URL = '/'
 
 MEDIA_URL = '/media/'
-MEDIA_ROOT = BASE_DIR / 'media'
\ No newline at end of file
+MEDIA_ROOT = BASE_DIR / 'media'
+
+# 登山記録の写真は内容のハッシュを名前にして保存し、同じ写真は1つのファイルを共有する (paplib.storage)
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+    'photos': {'BACKEND': 'paplib.storage.ContentAddressedStorage'},
+}
+
+# MEDIA_URL のファイルを Django から返すか (本番ではWebサーバーから返す)。
+# ハッシュを名前にした写真には、この秒数の immutable な Cache-Control を付ける
+SERVE_MEDIA = DEBUG
+MEDIA_IMMUTABLE_MAX_AGE = 60 * 60 * 24 * 365
+
+# 登山記録の写真から作る縮小画像の形式 ('JPEG' または 'WEBP')
+IMAGE_VARIANT_FORMAT = 'JPEG'
+
+# Django REST framework
+# 一覧APIはすべてカーソルページネーションで返す
+# CLI などのクライアントは /api/token/ で取得したトークンで認証する (Basic 認証は毎回パスワードのハッシュを計算するので遅い)
+
+REST_FRAMEWORK = {
+    'DEFAULT_PAGINATION_CLASS': 'paplib.pagination.StandardCursorPagination',
+    'PAGE_SIZE': 50,
+    'DEFAULT_AUTHENTICATION_CLASSES': [
+        'rest_framework.authentication.SessionAuthentication',
+        'paplib.authentication.ExpiringTokenAuthentication',
+        'rest_framework.authentication.BasicAuthentication',
+    ],
+}
+
+# API トークンの有効期間 (秒)
+API_TOKEN_TTL = 60 * 60 * 24 * 30
+
+# 差分同期 (/api/sync/, paplib.sync)
+# 書き込み中のトランザクションを取りこぼさないよう、この秒数より新しい変更は次の同期で返す
+SYNC_SETTLE_SECONDS = 5
+# 1回に返す件数 (山・記録・削除のそれぞれ) の既定値と上限
+SYNC_BATCH_SIZE = 500
+SYNC_MAX_BATCH_SIZE = 5000
+# 削除の記録 (Tombstone) を残す日数。これより古いカーソルは最初から同期し直す (prune_tombstones で消す)
+SYNC_TOMBSTONE_DAYS = 90
+
+API_MAX_PAGE_SIZE = 200
+
+# 登山記録の一括登録 (/api/records/bulk/) で一度に検証・登録する件数と、1リクエストの上限
+RECORD_IMPORT_CHUNK_SIZE = 1000
+RECORD_IMPORT_MAX_ROWS = 100000
+
+# 写真の分割アップロード (/api/uploads/, paplib.uploads)
+# 受け取った部分を置くディレクトリ (MEDIA_ROOT の外に置いて公開しない)
+PHOTO_UPLOAD_TEMP_DIR = BASE_DIR / 'uploads'
+# 1枚の写真と、1回に送れる部分の上限 (バイト)
+PHOTO_UPLOAD_MAX_BYTES = 30 * 1024 * 1024
+PHOTO_UPLOAD_CHUNK_BYTES = 1024 * 1024
+# 変換後の写真の長辺の上限 (ピクセル)
+PHOTO_MAX_DIMENSION = 4096
+# 送信が終わらないまま、または処理が終わってからこの時間が経ったアップロードは process_uploads で消す
+PHOTO_UPLOAD_EXPIRE_HOURS = 24
+
+# DB のタスクキュー (paplib.tasks)。タスクは manage.py run_worker で実行する
+# True ならキューに入れずにその場で実行する (テスト用)
+TASKS_EAGER = False
+# 実行中のタスクがこの秒数で終わらなければ、別のワーカーが実行し直す
+TASKS_VISIBILITY_TIMEOUT = 300
+# 失敗したタスクの実行回数の上限と、再試行までの秒数 (1回ごとに倍にする)
+TASKS_MAX_ATTEMPTS = 3
+TASKS_RETRY_DELAY = 10
@@ -15,15 +15,17 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.contrib import admin
-from django.urls import path, include
+import re
+
+from django.urls import path, include, re_path
 from django.conf import settings
-from django.conf.urls.static import static
 from rest_framework import routers
 from paplib import views
 
 router = routers.DefaultRouter()
 router.register(r'mountains', views.MountainViewSet)
 router.register(r'records', views.ClimbRecordViewSet)
+router.register(r'uploads', views.PhotoUploadViewSet, basename='photoupload')
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -32,8 +34,14 @@ urlpatterns = [
     path('api/', include(router.urls)),
     path('api-auth/', include('rest_framework.urls', namespace='rest_framework')),
     path('api/register/', views.UserCreateAPIView.as_view(), name='register'),
+    path('api/token/', views.AuthTokenAPIView.as_view(), name='api-token'),
+    path('api/sync/', views.SyncAPIView.as_view(), name='api-sync'),
+    path('api/stats/', views.UserStatsAPIView.as_view(), name='api-stats'),
+    path('api/leaderboards/', views.LeaderboardAPIView.as_view(), name='api-leaderboards'),
     path('register/', views.RegisterPageView.as_view(), name='register-page'),
 ]
 
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
+if settings.SERVE_MEDIA:
+    urlpatterns += [
+        re_path(rf'^{re.escape(settings.MEDIA_URL.lstrip("/"))}(?P<path>.*)$', views.serve_media, name='media'),
+    ]
\ No newline at end of file
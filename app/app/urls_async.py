@@ -0,0 +1,17 @@
+"""
+ASGI (app/asgi.py) で使う URL 設定。
+
+読み込みの多いページと API を paplib.async_views の非同期ビューに差し替え、
+それ以外は app.urls と同じ。
+"""
+from django.urls import path
+from paplib import async_views
+
+from .urls import urlpatterns as sync_urlpatterns
+
+urlpatterns = [
+    path('', async_views.mountain_list, name='mountain_list'),
+    path('mountain/<int:pk>/', async_views.mountain_detail, name='mountain_detail'),
+    path('api/records/', async_views.record_list, name='climbrecord-list'),
+    path('api/records/<int:pk>/', async_views.record_detail, name='climbrecord-detail'),
+] + sync_urlpatterns
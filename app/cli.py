@@ -1,10 +1,246 @@
 # cli.py
 import requests
 import click
+import csv
+import datetime
+import hashlib
 import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from requests.adapters import HTTPAdapter
+from requests.auth import AuthBase
+from urllib3.util.retry import Retry
 
-# APIのベースURL (自分の環境に合わせて変更)
-BASE_URL = 'http://127.0.0.1:8000'
+# APIのベースURL (--base-url オプションか環境変数 CLIMB_REC_BASE_URL で変更できます)
+BASE_URL = os.environ.get('CLIMB_REC_BASE_URL', 'http://127.0.0.1:8000')
+
+# 応答キャッシュの保存先 (環境変数 CLIMB_REC_CACHE_DIR で変更できます)
+CACHE_DIR = os.environ.get(
+    'CLIMB_REC_CACHE_DIR',
+    os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'climb_rec'),
+)
+
+# ログインで取得したトークンの保存先 (環境変数 CLIMB_REC_TOKEN_FILE で変更できます)
+TOKEN_FILE = os.environ.get(
+    'CLIMB_REC_TOKEN_FILE',
+    os.path.join(os.environ.get('XDG_CONFIG_HOME', os.path.expanduser('~/.config')), 'climb_rec', 'tokens.json'),
+)
+
+# 送信途中の写真のアップロードID (次回はその続きから送る)
+UPLOAD_STATE_FILE = os.path.join(CACHE_DIR, 'uploads.json')
+
+# --- APIクライアント ---
+
+class ResponseCache:
+    """GET の応答を URL ごとにディスクへ保存する LRU キャッシュ
+
+    ETag / Last-Modified を一緒に保存し、次回は条件付きリクエストで再検証する。
+    最終利用時刻はファイルの mtime で管理し、max_entries を超えたら古いものから消す。
+    """
+
+    def __init__(self, directory=CACHE_DIR, max_entries=256):
+        self.directory = directory
+        self.max_entries = max_entries
+
+    def _path(self, url):
+        return os.path.join(self.directory, hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, url):
+        path = self._path(url)
+        try:
+            with open(path, encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        os.utime(path)
+        return entry
+
+    def set(self, url, response):
+        headers = {k: response.headers[k] for k in ('ETag', 'Last-Modified', 'Content-Type') if k in response.headers}
+        if 'ETag' not in headers and 'Last-Modified' not in headers:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        entry = {'url': url, 'headers': headers, 'body': response.text}
+        path = self._path(url)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp, path)
+        self._evict()
+
+    def _evict(self):
+        entries = [e for e in os.scandir(self.directory) if e.name.endswith('.json')]
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort(key=lambda e: e.stat().st_mtime)
+        for e in entries[:len(entries) - self.max_entries]:
+            try:
+                os.remove(e.path)
+            except OSError:
+                pass
+
+    @staticmethod
+    def validators(entry):
+        headers = {}
+        if 'ETag' in entry['headers']:
+            headers['If-None-Match'] = entry['headers']['ETag']
+        if 'Last-Modified' in entry['headers']:
+            headers['If-Modified-Since'] = entry['headers']['Last-Modified']
+        return headers
+
+    @staticmethod
+    def to_response(entry):
+        response = requests.Response()
+        response.status_code = 200
+        response.url = entry['url']
+        response.headers.update(entry['headers'])
+        response._content = entry['body'].encode('utf-8')
+        response.encoding = 'utf-8'
+        return response
+
+class TokenStore:
+    """API のベースURLごとにログインしたユーザー名とトークンを保存する"""
+
+    def __init__(self, path=TOKEN_FILE):
+        self.path = path
+
+    def _load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, tokens):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        # トークンはパスワードと同じ扱いなので本人だけが読めるようにする
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, 'w', encoding='utf-8') as f:
+            json.dump(tokens, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, self.path)
+
+    def get(self, base_url):
+        """保存したトークンを返す。期限切れなら消して None を返す"""
+        saved = self._load().get(base_url)
+        if saved and saved.get('expires'):
+            expires = datetime.datetime.fromisoformat(saved['expires'])
+            if expires <= datetime.datetime.now(datetime.timezone.utc):
+                self.delete(base_url)
+                return None
+        return saved
+
+    def set(self, base_url, username, token, expires=None):
+        tokens = self._load()
+        tokens[base_url] = {'username': username, 'token': token, 'expires': expires}
+        self._save(tokens)
+
+    def delete(self, base_url):
+        tokens = self._load()
+        if tokens.pop(base_url, None) is not None:
+            self._save(tokens)
+
+class TokenAuth(AuthBase):
+    """Authorization: Token <key> を付ける (サーバーはパスワードのハッシュを計算しなくて済む)"""
+
+    def __init__(self, token):
+        self.token = token
+
+    def __call__(self, request):
+        request.headers['Authorization'] = f'Token {self.token}'
+        return request
+
+class ApiClient:
+    """接続を使い回す API クライアント
+
+    requests.Session の接続プールを使うので、同じサーバーへの呼び出しは
+    TCP 接続 (keep-alive) を再利用する。GET / PUT / PATCH / DELETE は
+    5xx や接続エラーのときに指数バックオフで再試行する。
+    """
+
+    def __init__(self, base_url=BASE_URL, timeout=30.0, retries=3, backoff=0.5, workers=8, cache=None, tokens=None):
+        self.base_url = base_url.rstrip('/')
+        self.cache = cache
+        self.tokens = tokens
+        # (接続, 読み込み) のタイムアウト
+        self.timeout = (min(timeout, 5.0), timeout)
+        self.workers = workers
+        self.session = requests.Session()
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=[500, 502, 503, 504],
+            allowed_methods=['GET', 'HEAD', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'],
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=max(workers, 1))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def url(self, path):
+        if path.startswith(('http://', 'https://')):
+            return path
+        return f'{self.base_url}{path}'
+
+    def request(self, method, path, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        response = self.session.request(method, self.url(path), **kwargs)
+        response.raise_for_status()
+        return response
+
+    def get(self, path, **kwargs):
+        # 認証付き・ストリーミング・キャッシュなしの呼び出しはそのまま送る
+        if self.cache is None or kwargs.get('auth') or kwargs.get('stream'):
+            return self.request('GET', path, **kwargs)
+
+        url = requests.Request('GET', self.url(path), params=kwargs.pop('params', None)).prepare().url
+        entry = self.cache.get(url)
+        headers = dict(kwargs.pop('headers', None) or {})
+        if entry:
+            headers.update(self.cache.validators(entry))
+        kwargs.setdefault('timeout', self.timeout)
+        response = self.session.get(url, headers=headers, **kwargs)
+        if response.status_code == 304 and entry:
+            return self.cache.to_response(entry)
+        response.raise_for_status()
+        self.cache.set(url, response)
+        return response
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def patch(self, path, **kwargs):
+        return self.request('PATCH', path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request('DELETE', path, **kwargs)
+
+    def iter_pages(self, path, auth=None, params=None):
+        """ページネーションされた一覧APIを next リンクに沿って1件ずつ返すジェネレータ"""
+        url = path
+        while url:
+            page = self.get(url, auth=auth, params=params).json()
+            if isinstance(page, list):
+                # ページネーションなしの古いサーバー
+                yield from page
+                return
+            yield from page['results']
+            # next にはクエリ文字列 (cursor, page_size) が含まれている
+            url = page.get('next')
+            params = None
+
+    def run_batch(self, func, items):
+        """func(item) を最大 workers 並列で実行し、(item, 結果または例外) を入力順に返す"""
+        def call(item):
+            try:
+                return item, func(item)
+            except Exception as e:
+                return item, e
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(call, items))
 
 # --- API呼び出し関数 ---
 
@@ -14,6 +250,7 @@ def handle_api_error(e):
         status_code = e.response.status_code
         if status_code in [401, 403]:
             click.echo('エラー: 認証に失敗したか、この操作を行う権限がありません。', err=True)
+            click.echo('(保存したトークンが無効になった場合は climb_rec logout の後にもう一度実行してください)', err=True)
         elif status_code == 404:
             click.echo('エラー: 指定されたリソースが見つかりませんでした (404)。IDを確認してください。', err=True)
         else:
@@ -30,227 +267,549 @@ def handle_api_error(e):
     else:
         click.echo(f'予期せぬエラーが発生しました: {e}', err=True)
 
+def run_for_each(client, ids, func, on_success):
+    """複数のIDに対して func を並列に呼び、結果を入力順に表示する"""
+    for item, result in client.run_batch(func, ids):
+        if isinstance(result, Exception):
+            click.echo(f'ID {item}:', err=True)
+            handle_api_error(result)
+        else:
+            on_success(item, result)
+
 # --- Mountain Functions ---
-def list_mountains():
+def list_mountains(client):
     try:
-        response = requests.get(f'{BASE_URL}/api/mountains/')
-        response.raise_for_status()
-        mountains = response.json()
+        mountains = client.iter_pages('/api/mountains/')
         click.echo('--- 山の一覧 ---')
         for m in mountains:
             click.echo(f"- ID: {m['id']}, 名前: {m['name']}, 都道府県: {m['prefecture']}, 標高: {m['elevation']}m")
     except Exception as e:
         handle_api_error(e)
 
-def get_mountain_detail(mountain_id):
-    try:
-        response = requests.get(f'{BASE_URL}/api/mountains/{mountain_id}/')
-        response.raise_for_status()
-        mountain = response.json()
+def get_mountain_details(client, mountain_ids):
+    def show(mountain_id, mountain):
         click.echo('--- 山の詳細 ---')
         click.echo(json.dumps(mountain, indent=2, ensure_ascii=False))
+
+    run_for_each(client, mountain_ids, lambda i: client.get(f'/api/mountains/{i}/').json(), show)
+
+def nearby_mountains(client, params):
+    try:
+        mountains = client.get('/api/mountains/nearby/', params=params).json()['results']
+        click.echo('--- 近くの山 ---')
+        if not mountains:
+            click.echo('見つかりませんでした。')
+        for m in mountains:
+            distance = f"{m['distance_km']:.1f}km, " if m['distance_km'] is not None else ''
+            click.echo(f"- {distance}ID: {m['id']}, 名前: {m['name']}, 都道府県: {m['prefecture']}, 標高: {m['elevation']}m")
     except Exception as e:
         handle_api_error(e)
 
-def create_mountain(name, prefecture, elevation, auth):
+def create_mountain(client, name, prefecture, elevation, auth, latitude=None, longitude=None):
+    data = {'name': name, 'prefecture': prefecture, 'elevation': elevation}
+    if latitude is not None and longitude is not None:
+        data.update(latitude=latitude, longitude=longitude)
     try:
-        response = requests.post(f'{BASE_URL}/api/mountains/', json={'name': name, 'prefecture': prefecture, 'elevation': elevation}, auth=auth)
-        response.raise_for_status()
+        response = client.post('/api/mountains/', json=data, auth=auth)
         new_mountain = response.json()
         click.echo(f'成功: 新しい山を作成しました。 ID: {new_mountain["id"]}')
     except Exception as e:
         handle_api_error(e)
 
-def update_mountain(mountain_id, data, auth):
+def update_mountain(client, mountain_id, data, auth):
     try:
-        response = requests.patch(f'{BASE_URL}/api/mountains/{mountain_id}/', json=data, auth=auth)
-        response.raise_for_status()
-        updated = response.json()
+        updated = client.patch(f'/api/mountains/{mountain_id}/', json=data, auth=auth).json()
         click.echo(f'成功: ID {mountain_id} の山を更新しました。')
         click.echo(json.dumps(updated, indent=2, ensure_ascii=False))
     except Exception as e:
         handle_api_error(e)
 
-def delete_mountain(mountain_id, auth):
-    try:
-        response = requests.delete(f'{BASE_URL}/api/mountains/{mountain_id}/', auth=auth)
-        response.raise_for_status()
-        click.echo(f'成功: ID {mountain_id} の山を削除しました。')
-    except Exception as e:
-        handle_api_error(e)
+def delete_mountains(client, mountain_ids, auth):
+    run_for_each(
+        client, mountain_ids,
+        lambda i: client.delete(f'/api/mountains/{i}/', auth=auth),
+        lambda i, _: click.echo(f'成功: ID {i} の山を削除しました。'),
+    )
 
 # --- Record Functions ---
-def list_records():
+def list_records(client):
     try:
-        response = requests.get(f'{BASE_URL}/api/records/')
-        response.raise_for_status()
-        records = response.json()
+        # 一覧に出す項目だけを、山の名前を埋め込んで受け取る
+        params = {'fields': 'id,user,mountain,comment', 'expand': 'mountain'}
+        records = client.iter_pages('/api/records/', params=params)
         click.echo('--- 登山記録の一覧 ---')
         for r in records:
-            click.echo(f"- ID: {r['id']}, UserID: {r['user']}, MountainID: {r['mountain']}, Comment: {r['comment'][:20]}...")
+            # ?expand= に対応していない古いサーバーは山のIDを返す
+            mountain = r['mountain']['name'] if isinstance(r['mountain'], dict) else r['mountain']
+            click.echo(f"- ID: {r['id']}, User: {r['user']}, Mountain: {mountain}, Comment: {(r['comment'] or '')[:20]}...")
     except Exception as e:
         handle_api_error(e)
 
-def get_record_detail(record_id):
-    try:
-        response = requests.get(f'{BASE_URL}/api/records/{record_id}/')
-        response.raise_for_status()
-        record = response.json()
+def get_record_details(client, record_ids):
+    def show(record_id, record):
         click.echo('--- 登山記録の詳細 ---')
         click.echo(json.dumps(record, indent=2, ensure_ascii=False))
-    except Exception as e:
-        handle_api_error(e)
 
-def create_record(mountain_id, climb_date, comment, auth):
+    run_for_each(client, record_ids, lambda i: client.get(f'/api/records/{i}/').json(), show)
+
+def create_record(client, mountain_id, climb_date, comment, auth):
     try:
-        response = requests.post(f'{BASE_URL}/api/records/', json={'mountain': mountain_id, 'climb_date': climb_date, 'comment': comment}, auth=auth)
-        response.raise_for_status()
+        response = client.post('/api/records/', json={'mountain': mountain_id, 'climb_date': climb_date, 'comment': comment}, auth=auth)
         new_record = response.json()
         click.echo(f'成功: 新しい登山記録を作成しました。 ID: {new_record["id"]}')
     except Exception as e:
         handle_api_error(e)
 
-def update_record(record_id, data, auth):
-    try:
-        response = requests.patch(f'{BASE_URL}/api/records/{record_id}/', json=data, auth=auth)
-        response.raise_for_status()
-        updated = response.json()
+def update_records(client, record_ids, data, auth):
+    def show(record_id, updated):
         click.echo(f'成功: ID {record_id} の記録を更新しました。')
         click.echo(json.dumps(updated, indent=2, ensure_ascii=False))
+
+    run_for_each(client, record_ids, lambda i: client.patch(f'/api/records/{i}/', json=data, auth=auth).json(), show)
+
+def delete_records(client, record_ids, auth):
+    run_for_each(
+        client, record_ids,
+        lambda i: client.delete(f'/api/records/{i}/', auth=auth),
+        lambda i, _: click.echo(f'成功: ID {i} の記録を削除しました。'),
+    )
+
+def read_record_rows(path, fmt):
+    """CSV または JSONL のファイルから記録を1件ずつ読むジェネレータ"""
+    with open(path, encoding='utf-8', newline='') as f:
+        if fmt == 'csv':
+            for row in csv.DictReader(f):
+                yield {
+                    'mountain': row.get('mountain') or row.get('mountain_id'),
+                    'climb_date': row['climb_date'],
+                    'comment': row.get('comment', ''),
+                }
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+def import_records(client, path, fmt, batch_size, auth):
+    created = failed = 0
+    rows = read_record_rows(path, fmt)
+    offset = 0
+    try:
+        while batch := list(islice(rows, batch_size)):
+            body = ''.join(json.dumps(row, ensure_ascii=False) + '\n' for row in batch)
+            response = client.post(
+                '/api/records/bulk/', data=body.encode('utf-8'), auth=auth,
+                headers={'Content-Type': 'application/x-ndjson; charset=utf-8'},
+            )
+            result = response.json()
+            created += result['created']
+            for error in result['errors']:
+                failed += 1
+                # 行番号はファイル全体での1始まりに直す
+                click.echo(f"{offset + error['row'] + 1} 行目: {json.dumps(error['errors'], ensure_ascii=False)}", err=True)
+            offset += len(batch)
+            click.echo(f'{offset} 件送信しました...')
+        click.echo(f'成功: {created} 件の登山記録を登録しました。 (失敗 {failed} 件)')
     except Exception as e:
         handle_api_error(e)
 
-def delete_record(record_id, auth):
+def export_records(client, path, fmt, filters):
     try:
-        response = requests.delete(f'{BASE_URL}/api/records/{record_id}/', auth=auth)
-        response.raise_for_status()
-        click.echo(f'成功: ID {record_id} の記録を削除しました。')
+        params = {k: v for k, v in filters.items() if v is not None}
+        if fmt == 'csv':
+            params['fmt'] = 'csv'
+        response = client.get('/api/records/export/', params=params, stream=True)
+        size = 0
+        with response, open(path, 'wb') as f:
+            # 受け取った分から順にファイルへ書き出す (全体をメモリに載せない)
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                f.write(chunk)
+                size += len(chunk)
+        click.echo(f'成功: 登山記録を {path} に書き出しました。 ({size:,} バイト)')
+    except Exception as e:
+        handle_api_error(e)
+
+def sync_records(client, path, limit):
+    """path の JSON に山と登山記録の複製を保存し、前回からの変更だけを取得して更新する"""
+    try:
+        with open(path, encoding='utf-8') as f:
+            replica = json.load(f)
+    except FileNotFoundError:
+        replica = {'cursor': None, 'mountains': {}, 'records': {}}
+    try:
+        counts = {'mountains': 0, 'records': 0, 'deleted': 0}
+        while True:
+            params = {'limit': limit}
+            if replica['cursor']:
+                params['cursor'] = replica['cursor']
+            try:
+                # 応答キャッシュは使わない (カーソルごとに内容が変わる)
+                page = client.request('GET', '/api/sync/', params=params).json()
+            except requests.exceptions.HTTPError as e:
+                if e.response.status_code != 410 or not replica['cursor']:
+                    raise
+                # カーソルが古すぎるので最初から取り直す
+                click.echo('前回の同期から時間が経ちすぎているため、最初から同期し直します。')
+                replica = {'cursor': None, 'mountains': {}, 'records': {}}
+                continue
+            for name in ('mountains', 'records'):
+                for item in page[name]:
+                    replica[name][str(item['id'])] = item
+                counts[name] += len(page[name])
+                for pk in page['deleted'][name]:
+                    counts['deleted'] += replica[name].pop(str(pk), None) is not None
+            replica['cursor'] = page['cursor']
+            if not page['has_more']:
+                break
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(replica, f, ensure_ascii=False)
+        os.replace(tmp, path)
+        click.echo(
+            f"成功: 山 {counts['mountains']} 件, 登山記録 {counts['records']} 件を更新し、{counts['deleted']} 件を削除しました。"
+            f" (山 {len(replica['mountains'])} 件, 登山記録 {len(replica['records'])} 件)"
+        )
+    except Exception as e:
+        handle_api_error(e)
+
+def _load_upload_state():
+    try:
+        with open(UPLOAD_STATE_FILE, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_upload_state(state):
+    os.makedirs(os.path.dirname(UPLOAD_STATE_FILE), exist_ok=True)
+    tmp = f'{UPLOAD_STATE_FILE}.{os.getpid()}.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(tmp, UPLOAD_STATE_FILE)
+
+def upload_photo(client, record_id, path, auth, wait=60.0):
+    """写真を分割して送り、登山記録に付ける。途中で失敗しても、もう一度実行すれば続きから送る"""
+    try:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while data := f.read(1024 * 1024):
+                digest.update(data)
+        size = os.path.getsize(path)
+        key = f'{client.base_url} {record_id} {digest.hexdigest()}'
+        state = _load_upload_state()
+
+        upload = None
+        if key in state:
+            try:
+                upload = client.request('GET', f"/api/uploads/{state[key]}/", auth=auth).json()
+            except requests.exceptions.HTTPError as e:
+                if e.response.status_code != 404:
+                    raise
+            if upload and upload['status'] == 'failed':
+                upload = None
+        if upload is None:
+            upload = client.post('/api/uploads/', auth=auth, json={
+                'record': record_id, 'filename': os.path.basename(path), 'size': size, 'sha256': digest.hexdigest(),
+            }).json()
+            state[key] = upload['id']
+            _save_upload_state(state)
+        elif upload['offset']:
+            click.echo(f"前回の続き ({upload['offset']:,} バイト目) から送ります。")
+
+        url = f"/api/uploads/{upload['id']}/"
+        offset = upload['offset']
+        if upload['status'] == 'uploading':
+            with open(path, 'rb') as f, click.progressbar(length=size, label='送信中') as bar:
+                bar.update(offset)
+                while offset < size:
+                    f.seek(offset)
+                    chunk = f.read(upload['chunk_size'])
+                    response = client.session.put(
+                        client.url(url), data=chunk, auth=auth, timeout=client.timeout,
+                        headers={'Upload-Offset': str(offset), 'Content-Type': 'application/offset+octet-stream'},
+                    )
+                    # 再試行した部分が先に届いていたときなどは、サーバーが受け取った位置から続ける
+                    if response.status_code != 409:
+                        response.raise_for_status()
+                    new_offset = response.json()['offset']
+                    bar.update(new_offset - offset)
+                    offset = new_offset
+            upload = client.post(f'{url}complete/', auth=auth).json()
+
+        # 写真の変換はサーバーがリクエストの外で行うので、終わるまで待つ
+        deadline = time.monotonic() + wait
+        while upload['status'] == 'processing' and time.monotonic() < deadline:
+            time.sleep(0.5)
+            upload = client.request('GET', url, auth=auth).json()
+
+        if upload['status'] == 'processing':
+            click.echo('写真はサーバーで処理中です。しばらくしてから rec_detail で確認してください。')
+            return
+        state.pop(key, None)
+        _save_upload_state(state)
+        if upload['status'] == 'done':
+            click.echo(f"成功: 登山記録 {record_id} に写真を付けました。 {upload['image']}")
+        else:
+            click.echo(f"エラー: 写真を処理できませんでした。 {upload['error']}", err=True)
     except Exception as e:
         handle_api_error(e)
 
 # --- User Functions ---
-def list_users(auth):
+def list_users(client, auth):
     try:
-        response = requests.get(f'{BASE_URL}/api/users/', auth=auth)
-        response.raise_for_status()
-        users = response.json()
+        users = client.iter_pages('/api/users/', auth=auth)
         click.echo('--- ユーザーの一覧 ---')
         for u in users:
             click.echo(f"- ID: {u['id']}, ユーザー名: {u['username']}, Email: {u['email']}")
     except Exception as e:
         handle_api_error(e)
 
-def create_user(username, email, password):
+def create_user(client, username, email, password):
     try:
-        response = requests.post(f'{BASE_URL}/api/register/', json={'username': username, 'email': email, 'password': password})
-        response.raise_for_status()
+        response = client.post('/api/register/', json={'username': username, 'email': email, 'password': password})
         new_user = response.json()
         click.echo(f"成功: 新しいユーザー '{new_user['username']}' を作成しました。")
     except Exception as e:
         handle_api_error(e)
 
+def prompt_auth():
+    username = click.prompt('ユーザー名')
+    password = click.prompt('パスワード', hide_input=True)
+    return (username, password)
+
+def login(client, username, password):
+    """トークンを取得して保存し、認証に使うオブジェクトを返す
+
+    トークンに対応していない古いサーバーなら (ユーザー名, パスワード) の Basic 認証を返す。
+    """
+    try:
+        response = client.post('/api/token/', json={'username': username, 'password': password})
+    except requests.exceptions.HTTPError as e:
+        if e.response.status_code == 404:
+            return (username, password)
+        raise
+    data = response.json()
+    if client.tokens is not None:
+        client.tokens.set(client.base_url, username, data['token'], data.get('expires'))
+    return TokenAuth(data['token'])
+
+def get_auth(client):
+    """保存したトークンがあればそれを使い、なければログインしてトークンを保存する"""
+    saved = client.tokens.get(client.base_url) if client.tokens is not None else None
+    if saved:
+        return TokenAuth(saved['token'])
+    username, password = prompt_auth()
+    try:
+        return login(client, username, password)
+    except Exception as e:
+        handle_api_error(e)
+        raise click.exceptions.Exit(1)
+
 # --- CLI Commands ---
 @click.group()
-def cli():
+@click.option('--base-url', default=BASE_URL, show_default=True, help='APIのベースURL (環境変数 CLIMB_REC_BASE_URL)')
+@click.option('--timeout', default=30.0, show_default=True, type=float, help='タイムアウト (秒)')
+@click.option('--retries', default=3, show_default=True, type=int, help='失敗時の再試行回数')
+@click.option('--workers', default=8, show_default=True, type=click.IntRange(1, 64), help='複数IDを処理するときの並列数')
+@click.option('--cache-size', default=256, show_default=True, type=click.IntRange(0), help='応答キャッシュの最大件数 (0で無効)')
+@click.option('--save-token/--no-save-token', default=True, show_default=True,
+              help='ログインで取得したトークンを保存して次回から使う (環境変数 CLIMB_REC_TOKEN_FILE)')
+@click.pass_context
+def cli(ctx, base_url, timeout, retries, workers, cache_size, save_token):
     """登山記録アプリのAPIクライアント"""
-    pass
+    cache = ResponseCache(max_entries=cache_size) if cache_size else None
+    tokens = TokenStore() if save_token else None
+    ctx.obj = ApiClient(base_url, timeout=timeout, retries=retries, workers=workers, cache=cache, tokens=tokens)
+
+# Auth Commands
+@cli.command(name='login', help='ログインしてトークンを保存します。以後のコマンドはパスワードを聞きません。')
+@click.pass_obj
+def login_command(client):
+    username, password = prompt_auth()
+    try:
+        auth = login(client, username, password)
+    except Exception as e:
+        handle_api_error(e)
+        return
+    if isinstance(auth, tuple):
+        click.echo('このサーバーはトークンに対応していません。コマンドごとにパスワードを入力してください。')
+    elif client.tokens is None:
+        click.echo('--no-save-token が指定されているため、トークンは保存しませんでした。')
+    else:
+        click.echo(f"成功: '{username}' としてログインしました。")
+
+@cli.command(name='logout', help='サーバー上のトークンを無効にし、保存したトークンを消します。')
+@click.pass_obj
+def logout_command(client):
+    saved = client.tokens.get(client.base_url) if client.tokens is not None else None
+    if not saved:
+        click.echo('ログインしていません。')
+        return
+    try:
+        client.delete('/api/token/', auth=TokenAuth(saved['token']))
+    except requests.exceptions.HTTPError as e:
+        # 期限切れなどで既に無効なら、手元のトークンを消すだけでよい
+        if e.response.status_code not in (401, 403):
+            handle_api_error(e)
+            return
+    except Exception as e:
+        handle_api_error(e)
+        return
+    client.tokens.delete(client.base_url)
+    click.echo('ログアウトしました。')
 
 # Mountain Commands
 @cli.command(help='山の一覧を表示します。')
-def Mt_list():
-    list_mountains()
+@click.pass_obj
+def Mt_list(client):
+    list_mountains(client)
 
-@cli.command(help='指定したIDの山の詳細を表示します。')
-@click.option('--id', 'mountain_id', required=True, type=int)
-def Mt_detail(mountain_id):
-    get_mountain_detail(mountain_id)
+@cli.command(help='指定したIDの山の詳細を表示します。(--id は複数指定できます)')
+@click.option('--id', 'mountain_ids', required=True, type=int, multiple=True)
+@click.pass_obj
+def Mt_detail(client, mountain_ids):
+    get_mountain_details(client, mountain_ids)
+
+@cli.command(help='指定した地点から近い山を近い順に表示します。(--bbox だけなら範囲内の山を標高の高い順に表示します)')
+@click.option('--lat', type=float, help='緯度')
+@click.option('--lon', type=float, help='経度')
+@click.option('--radius', type=float, help='この km 以内の山だけを表示する')
+@click.option('--bbox', help='西,南,東,北 (経度・緯度) の範囲の山だけを表示する')
+@click.option('--limit', default=20, show_default=True, type=int)
+@click.pass_obj
+def Mt_nearby(client, lat, lon, radius, bbox, limit):
+    if (lat is None or lon is None) and not bbox:
+        click.echo('エラー: --lat と --lon、または --bbox を指定してください。', err=True)
+        return
+    params = {k: v for k, v in {'lat': lat, 'lon': lon, 'radius': radius, 'bbox': bbox, 'limit': limit}.items() if v is not None}
+    nearby_mountains(client, params)
 
 @cli.command(help='新しい山を登録します。')
 @click.option('--name', required=True)
 @click.option('--prefecture', required=True)
 @click.option('--elevation', required=True, type=int)
-def Mt_create(name, prefecture, elevation):
-    username = click.prompt('ユーザー名')
-    password = click.prompt('パスワード', hide_input=True)
-    create_mountain(name, prefecture, elevation, (username, password))
+@click.option('--lat', 'latitude', type=float, help='緯度')
+@click.option('--lon', 'longitude', type=float, help='経度')
+@click.pass_obj
+def Mt_create(client, name, prefecture, elevation, latitude, longitude):
+    create_mountain(client, name, prefecture, elevation, get_auth(client), latitude, longitude)
 
 @cli.command(help='指定したIDの山の情報を更新します。')
 @click.option('--id', 'mountain_id', required=True, type=int)
 @click.option('--name')
 @click.option('--prefecture')
 @click.option('--elevation', type=int)
-def Mt_update(mountain_id, name, prefecture, elevation):
-    data = {k: v for k, v in {'name': name, 'prefecture': prefecture, 'elevation': elevation}.items() if v is not None}
+@click.option('--lat', 'latitude', type=float, help='緯度')
+@click.option('--lon', 'longitude', type=float, help='経度')
+@click.pass_obj
+def Mt_update(client, mountain_id, name, prefecture, elevation, latitude, longitude):
+    data = {
+        k: v for k, v in {
+            'name': name, 'prefecture': prefecture, 'elevation': elevation,
+            'latitude': latitude, 'longitude': longitude,
+        }.items() if v is not None
+    }
     if not data:
         click.echo('エラー: 更新するデータが指定されていません。', err=True)
         return
-    username = click.prompt('ユーザー名')
-    password = click.prompt('パスワード', hide_input=True)
-    update_mountain(mountain_id, data, (username, password))
+    update_mountain(client, mountain_id, data, get_auth(client))
 
-@cli.command(help='指定したIDの山を削除します。')
-@click.option('--id', 'mountain_id', required=True, type=int)
-def Mt_delete(mountain_id):
-    click.confirm(f'本当にID {mountain_id} の山を削除しますか？', abort=True)
-    username = click.prompt('ユーザー名')
-    password = click.prompt('パスワード', hide_input=True)
-    delete_mountain(mountain_id, (username, password))
+@cli.command(help='指定したIDの山を削除します。(--id は複数指定できます)')
+@click.option('--id', 'mountain_ids', required=True, type=int, multiple=True)
+@click.pass_obj
+def Mt_delete(client, mountain_ids):
+    ids = ', '.join(map(str, mountain_ids))
+    click.confirm(f'本当にID {ids} の山を削除しますか？', abort=True)
+    delete_mountains(client, mountain_ids, get_auth(client))
 
 # Record Commands
 @cli.command(help='登山記録の一覧を表示します。')
-def rec_list():
-    list_records()
+@click.pass_obj
+def rec_list(client):
+    list_records(client)
 
-@cli.command(help='指定したIDの登山記録の詳細を表示します。')
-@click.option('--id', 'record_id', required=True, type=int)
-def rec_detail(record_id):
-    get_record_detail(record_id)
+@cli.command(help='指定したIDの登山記録の詳細を表示します。(--id は複数指定できます)')
+@click.option('--id', 'record_ids', required=True, type=int, multiple=True)
+@click.pass_obj
+def rec_detail(client, record_ids):
+    get_record_details(client, record_ids)
 
 @cli.command(help='新しい登山記録を登録します。')
 @click.option('--mountain-id', required=True, type=int)
 @click.option('--date', 'climb_date', required=True, help='YYYY-MM-DD')
 @click.option('--comment', default="")
-def rec_create(mountain_id, climb_date, comment):
-    username = click.prompt('ユーザー名')
-    password = click.prompt('パスワード', hide_input=True)
-    create_record(mountain_id, climb_date, comment, (username, password))
+@click.pass_obj
+def rec_create(client, mountain_id, climb_date, comment):
+    create_record(client, mountain_id, climb_date, comment, get_auth(client))
 
-@cli.command(help='指定したIDの登山記録を更新します。')
-@click.option('--id', 'record_id', required=True, type=int)
+@cli.command(help='指定したIDの登山記録を更新します。(--id は複数指定できます)')
+@click.option('--id', 'record_ids', required=True, type=int, multiple=True)
 @click.option('--date', 'climb_date', help='YYYY-MM-DD')
 @click.option('--comment')
-def rec_update(record_id, climb_date, comment):
+@click.pass_obj
+def rec_update(client, record_ids, climb_date, comment):
     data = {k: v for k, v in {'climb_date': climb_date, 'comment': comment}.items() if v is not None}
     if not data:
         click.echo('エラー: 更新するデータが指定されていません。', err=True)
         return
-    username = click.prompt('ユーザー名')
-    password = click.prompt('パスワード', hide_input=True)
-    update_record(record_id, data, (username, password))
+    update_records(client, record_ids, data, get_auth(client))
+
+@cli.command(help='指定したIDの登山記録を削除します。(--id は複数指定できます)')
+@click.option('--id', 'record_ids', required=True, type=int, multiple=True)
+@click.pass_obj
+def rec_delete(client, record_ids):
+    ids = ', '.join(map(str, record_ids))
+    click.confirm(f'本当にID {ids} の記録を削除しますか？', abort=True)
+    delete_records(client, record_ids, get_auth(client))
 
-@cli.command(help='指定したIDの登山記録を削除します。')
+@cli.command(help='CSV または JSONL ファイルから登山記録をまとめて登録します。')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help='省略時は拡張子から判定')
+@click.option('--batch-size', default=1000, show_default=True, type=int)
+@click.pass_obj
+def rec_import(client, path, fmt, batch_size):
+    fmt = fmt or ('csv' if path.lower().endswith('.csv') else 'jsonl')
+    import_records(client, path, fmt, batch_size, get_auth(client))
+
+@cli.command(help='登山記録を NDJSON または CSV ファイルに書き出します。')
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+@click.option('--format', 'fmt', type=click.Choice(['ndjson', 'csv']), help='省略時は拡張子から判定')
+@click.option('--user', help='ユーザー名で絞り込む')
+@click.option('--mountain-id', type=int, help='山のIDで絞り込む')
+@click.option('--since', help='この日以降に登った記録 (YYYY-MM-DD)')
+@click.option('--until', help='この日までに登った記録 (YYYY-MM-DD)')
+@click.pass_obj
+def rec_export(client, path, fmt, user, mountain_id, since, until):
+    fmt = fmt or ('csv' if path.lower().endswith('.csv') else 'ndjson')
+    export_records(client, path, fmt, {'user': user, 'mountain': mountain_id, 'since': since, 'until': until})
+
+@cli.command(help='山と登山記録の複製を JSON ファイルに保存します。2回目からは前回からの変更だけを取得します。')
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+@click.option('--limit', default=500, show_default=True, type=click.IntRange(1), help='1回の API 呼び出しで取得する件数')
+@click.pass_obj
+def rec_sync(client, path, limit):
+    sync_records(client, path, limit)
+
+@cli.command(help='登山記録に写真を付けます。大きな写真は分割して送り、途中で切れたら続きから送ります。')
 @click.option('--id', 'record_id', required=True, type=int)
-def rec_delete(record_id):
-    click.confirm(f'本当にID {record_id} の記録を削除しますか？', abort=True)
-    username = click.prompt('ユーザー名')
-    password = click.prompt('パスワード', hide_input=True)
-    delete_record(record_id, (username, password))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--wait', default=60.0, show_default=True, type=float, help='サーバーでの写真の処理を待つ秒数')
+@click.pass_obj
+def rec_photo(client, record_id, path, wait):
+    upload_photo(client, record_id, path, get_auth(client), wait)
 
 # User Commands
 @cli.command(name='user_list', help='ユーザーの一覧を表示します。(要管理者権限)')
-def user_list_command():
-    username = click.prompt('ユーザー名')
-    password = click.prompt('パスワード', hide_input=True)
-    list_users((username, password))
+@click.pass_obj
+def user_list_command(client):
+    list_users(client, get_auth(client))
 
 @cli.command(name='user_create', help='新しいユーザーを登録します。')
 @click.option('--username', required=True)
 @click.option('--email', required=True)
-def user_create_command(username, email):
+@click.pass_obj
+def user_create_command(client, username, email):
     password = click.prompt('パスワード', hide_input=True, confirmation_prompt=True)
-    create_user(username, email, password)
+    create_user(client, username, email, password)
 
 
 if __name__ == '__main__':
     cli()
-
@@ -0,0 +1,129 @@
+from django.db.models import Case, CharField, Count, Exists, F, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import ClimbRecord, Mountain
+
+# 山の集計値に影響する記録のフィールド
+TRACKED_FIELDS = ('mountain_id', 'user_id', 'climb_date', 'image')
+
+
+def snapshot(record):
+    return {
+        'mountain_id': record.mountain_id,
+        'user_id': record.user_id,
+        'climb_date': record.climb_date,
+        'image': record.image.name or '',
+    }
+
+
+def original_values(record):
+    """保存前 (DBに入っている) の値を返す。新規作成なら None。"""
+    if record._state.adding:
+        return None
+    loaded = getattr(record, '_loaded_values', {})
+    if all(field in loaded for field in TRACKED_FIELDS):
+        values = {field: loaded[field] for field in TRACKED_FIELDS}
+    else:
+        # only() などで読み込まれた記録は DB から取り直す
+        values = ClimbRecord.objects.filter(pk=record.pk).values(*TRACKED_FIELDS).first()
+        if values is None:
+            return None
+    values['image'] = values['image'] or ''
+    return values
+
+
+def _photos(records):
+    return records.exclude(image='').exclude(image__isnull=True).order_by('-climb_date', '-pk')
+
+
+# updated_at は SQL の Now() ではなく Python の時刻で入れる。
+# auto_now と同じ (マイクロ秒までの) 形式になり、差分同期のカーソル (paplib.sync) で正しく比べられる
+
+def record_added(values, pk):
+    """記録が1件増えたときの差分を山の集計値に反映する"""
+    others = ClimbRecord.objects.filter(mountain_id=values['mountain_id']).exclude(pk=pk)
+    date = values['climb_date']
+    updates = {
+        'record_count': F('record_count') + 1,
+        'climber_count': Case(
+            When(Exists(others.filter(user_id=values['user_id'])), then=F('climber_count')),
+            default=F('climber_count') + 1,
+        ),
+        'last_climbed_on': Case(
+            When(Q(last_climbed_on__isnull=True) | Q(last_climbed_on__lt=date), then=Value(date)),
+            default=F('last_climbed_on'),
+        ),
+    }
+    if values['image']:
+        newer = _photos(others).filter(Q(climb_date__gt=date) | Q(climb_date=date, pk__gt=pk))
+        updates['latest_photo'] = Case(
+            When(Exists(newer), then=F('latest_photo')),
+            default=Value(values['image']),
+            output_field=CharField(),
+        )
+    Mountain.objects.filter(pk=values['mountain_id']).update(**updates, updated_at=timezone.now())
+
+
+def record_removed(values, pk):
+    """記録が1件減ったときの差分を山の集計値に反映する"""
+    others = ClimbRecord.objects.filter(mountain_id=values['mountain_id']).exclude(pk=pk)
+    updates = {
+        'record_count': F('record_count') - 1,
+        'climber_count': Case(
+            When(Exists(others.filter(user_id=values['user_id'])), then=F('climber_count')),
+            default=F('climber_count') - 1,
+        ),
+        # 最新の日付・写真を消したときだけ残りの記録から探し直す
+        'last_climbed_on': Case(
+            When(last_climbed_on=values['climb_date'],
+                 then=Subquery(others.order_by('-climb_date').values('climb_date')[:1])),
+            default=F('last_climbed_on'),
+        ),
+    }
+    if values['image']:
+        updates['latest_photo'] = Case(
+            When(latest_photo=values['image'],
+                 then=Coalesce(Subquery(_photos(others).values('image')[:1]), Value(''))),
+            default=F('latest_photo'),
+            output_field=CharField(),
+        )
+    Mountain.objects.filter(pk=values['mountain_id']).update(**updates, updated_at=timezone.now())
+
+
+def record_saved(record, original):
+    current = snapshot(record)
+    if original == current:
+        return
+    if original is not None:
+        record_removed(original, record.pk)
+    record_added(current, record.pk)
+
+
+def stat_expressions():
+    """記録から集計値を計算する式 (Mountain に対する相関サブクエリ)"""
+    records = ClimbRecord.objects.filter(mountain=OuterRef('pk')).order_by()
+    return {
+        'record_count': Coalesce(
+            Subquery(records.values('mountain').annotate(c=Count('pk')).values('c')), 0),
+        'climber_count': Coalesce(
+            Subquery(records.values('mountain').annotate(c=Count('user', distinct=True)).values('c')), 0),
+        'last_climbed_on': Subquery(records.order_by('-climb_date').values('climb_date')[:1]),
+        'latest_photo': Coalesce(
+            Subquery(_photos(records).values('image')[:1]), Value(''), output_field=CharField()),
+    }
+
+
+def refresh_mountain_stats(mountains=None, batch_size=500):
+    """集計値を記録から計算し直し、ずれていた山の id のリストを返す"""
+    if mountains is None:
+        mountains = Mountain.objects.all()
+    fields = list(stat_expressions())
+    rows = mountains.annotate(
+        **{f'computed_{name}': expression for name, expression in stat_expressions().items()}
+    ).values_list('pk', *fields, *[f'computed_{name}' for name in fields])
+
+    stale = [row[0] for row in rows.iterator() if row[1:1 + len(fields)] != row[1 + len(fields):]]
+    for i in range(0, len(stale), batch_size):
+        Mountain.objects.filter(pk__in=stale[i:i + batch_size]).update(**stat_expressions(), updated_at=timezone.now())
+    return stale
@@ -3,4 +3,9 @@ from django.apps import AppConfig
 
 class PaplibConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'paplib'
\ No newline at end of file
+    name = 'paplib'
+
+    def ready(self):
+        from . import profiling, signals  # noqa: F401
+        if profiling.enabled():
+            profiling.install_template_timer()
@@ -0,0 +1,165 @@
+"""読み込みの多いページと API の非同期版 (ASGI で動かすときに app.urls_async から使う)。
+
+DB には非同期 ORM で問い合わせるので、遅いクライアントに応答を返している間も
+ワーカーのスレッドを占有しない。GET 以外のメソッドやブラウザ向けの画面は同期のビューに任せる。
+"""
+from asgiref.sync import sync_to_async
+from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
+from django.db.models import Count, Max
+from django.http import HttpResponse
+from django.shortcuts import aget_object_or_404, render
+from django.template.loader import render_to_string
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.exceptions import APIException, ValidationError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+
+from . import cache, views
+from .conditional import conditional_response, latest, make_etag, set_validators
+from .filters import filter_records
+from .forms import ClimbRecordForm
+from .models import ClimbRecord, Mountain
+from .pagination import ClimbRecordCursorPagination
+from .serializers import ClimbRecordSerializer, record_shape, shape_records, shape_updated_fields
+
+JSON_MEDIA_TYPE = 'application/json'
+
+_sync_mountain_detail = sync_to_async(views.mountain_detail)
+# {% cache %} はキャッシュを同期の API で読むので (db バックエンドなら ORM)、描画はスレッドで行う
+_render = sync_to_async(render)
+_sync_record_list = sync_to_async(views.ClimbRecordViewSet.as_view({'get': 'list', 'post': 'create'}))
+_sync_record_detail = sync_to_async(views.ClimbRecordViewSet.as_view({
+    'get': 'retrieve', 'put': 'update', 'patch': 'partial_update', 'delete': 'destroy',
+}))
+
+
+async def _load_user(request):
+    # テンプレートのコンテキストプロセッサが同期の ORM でユーザーやセッションを読まないよう、先に読んでおく
+    request.user = await request.auser()
+
+
+def _wants_json(request):
+    """DRF と同じ判定で JSON を返すべきか (ブラウザ向けの画面でないか) を決める"""
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    fmt = request.GET.get('format')
+    if fmt:
+        return fmt == 'json'
+    return request.get_preferred_type([JSON_MEDIA_TYPE, 'text/html']) == JSON_MEDIA_TYPE
+
+
+def _json(data, status=200):
+    return HttpResponse(JSONRenderer().render(data), content_type=JSON_MEDIA_TYPE, status=status)
+
+
+async def _get_page(queryset, per_page, number):
+    """Paginator.get_page の非同期版"""
+    paginator = Paginator(queryset, per_page)
+    # count は cached_property なので、先に非同期で数えた値を入れておく
+    paginator.count = await queryset.acount()
+    try:
+        number = paginator.validate_number(number)
+    except PageNotAnInteger:
+        number = 1
+    except EmptyPage:
+        number = paginator.num_pages
+    bottom = (number - 1) * per_page
+    items = [obj async for obj in queryset[bottom:bottom + per_page].aiterator()]
+    return paginator._get_page(items, number, paginator)
+
+
+async def mountain_list(request):
+    query, sort = views.mountain_list_params(request)
+    key = await cache.amake_key('mountains', 'html', query, sort)
+    items = await cache.aget(key)
+    if items is None:
+        mountains = [m async for m in views.mountain_queryset(query, sort).aiterator()]
+        items = render_to_string('paplib/mountain_list_items.html', {'mountains': mountains})
+        await cache.aset(key, items)
+
+    await _load_user(request)
+    return render(request, 'paplib/mountain_list.html', views.mountain_list_context(items, sort))
+
+
+async def mountain_detail(request, pk):
+    if request.method not in ('GET', 'HEAD'):
+        return await _sync_mountain_detail(request, pk)
+
+    mountain = await aget_object_or_404(Mountain, pk=pk)
+    records = views.mountain_records(mountain)
+    page_obj = await _get_page(records, views.RECORDS_PER_PAGE, request.GET.get('page'))
+    version = views.records_version(page_obj.paginator.count, await views.latest_updates(records).afirst())
+    await _load_user(request)
+    context = views.mountain_detail_context(mountain, page_obj, ClimbRecordForm(), version)
+    return await _render(request, 'paplib/mountain_detail.html', context)
+
+
+@csrf_exempt
+async def record_list(request):
+    if not _wants_json(request):
+        return await _sync_record_list(request)
+
+    # query_params とページのリンクの作り方を同期の API と揃えるため DRF の Request で包む
+    drf_request = Request(request)
+    try:
+        fields, expand = record_shape(drf_request.query_params)
+        queryset = filter_records(shape_records(ClimbRecord.objects.all(), fields, expand), drf_request.query_params)
+    except ValidationError as e:
+        return _json(e.detail, status=e.status_code)
+
+    related = shape_updated_fields(expand)
+    state = await queryset.order_by().aaggregate(
+        last=Max('updated_at'), count=Count('pk'),
+        **{f'related{i}': Max(field) for i, field in enumerate(related)},
+    )
+    lasts = [state['last'], *(state[f'related{i}'] for i in range(len(related)))]
+    etag = make_etag(request.get_full_path(), JSON_MEDIA_TYPE, state['count'], *lasts)
+    # 同期の API と同じく、一覧には Last-Modified を付けない (ConditionalGetMixin)
+    not_modified = conditional_response(request, etag, None)
+    if not_modified is not None:
+        return not_modified
+
+    paginator = ClimbRecordCursorPagination()
+    try:
+        page = await paginator.apaginate_queryset(queryset, drf_request)
+    except APIException as e:
+        # 不正なカーソル (404) など
+        return _json({'detail': e.detail}, status=e.status_code)
+    context = {'request': drf_request, 'fields': fields, 'expand': expand}
+    data = ClimbRecordSerializer(page, many=True, context=context).data
+    response = _json({
+        'next': paginator.get_next_link(),
+        'previous': paginator.get_previous_link(),
+        'results': data,
+    })
+    return set_validators(response, etag, None)
+
+
+@csrf_exempt
+async def record_detail(request, pk):
+    if not _wants_json(request):
+        return await _sync_record_detail(request, pk=pk)
+
+    drf_request = Request(request)
+    try:
+        fields, expand = record_shape(drf_request.query_params)
+    except ValidationError as e:
+        return _json(e.detail, status=e.status_code)
+    lasts = await (
+        ClimbRecord.objects.filter(pk=pk).values_list('updated_at', *shape_updated_fields(expand)).afirst()
+    )
+    if lasts is None:
+        # 404 の応答は同期の API と同じものを返す
+        return await _sync_record_detail(request, pk=pk)
+    etag = make_etag(request.get_full_path(), JSON_MEDIA_TYPE, *lasts)
+    not_modified = conditional_response(request, etag, latest(lasts))
+    if not_modified is not None:
+        return not_modified
+
+    try:
+        record = await shape_records(ClimbRecord.objects.all(), fields, expand).aget(pk=pk)
+    except ClimbRecord.DoesNotExist:
+        return await _sync_record_detail(request, pk=pk)
+    context = {'request': drf_request, 'fields': fields, 'expand': expand}
+    data = ClimbRecordSerializer(record, context=context).data
+    return set_validators(_json(data), etag, latest(lasts))
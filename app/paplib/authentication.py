@@ -0,0 +1,33 @@
+import datetime
+
+from django.conf import settings
+from django.utils import timezone
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+
+def token_expires(token):
+    return token.created + datetime.timedelta(seconds=settings.API_TOKEN_TTL)
+
+
+def issue_token(user):
+    """有効なトークンがあればそれを、なければ (期限切れなら作り直して) 新しいトークンを返す"""
+    token, created = Token.objects.get_or_create(user=user)
+    if not created and token_expires(token) <= timezone.now():
+        token.delete()
+        token = Token.objects.create(user=user)
+    return token
+
+
+class ExpiringTokenAuthentication(TokenAuthentication):
+    """Authorization: Token <key> で認証する。パスワードのハッシュ計算をしないので Basic 認証より速い。
+
+    トークンは発行から API_TOKEN_TTL 秒で無効になる。
+    """
+
+    def authenticate_credentials(self, key):
+        user, token = super().authenticate_credentials(key)
+        if token_expires(token) <= timezone.now():
+            raise exceptions.AuthenticationFailed('トークンの有効期限が切れています。もう一度ログインしてください。')
+        return user, token
@@ -0,0 +1,71 @@
+"""写真のファイルの参照数 (PhotoBlob)。
+
+同じ写真は1つのファイルを共有するので (paplib.storage)、登山記録の保存・削除のたびに参照数を増減し
+(paplib.signals)、0 になったらコミット後にファイルと縮小画像を消す。
+ハッシュを名前にしていない古いファイルは数えていないので消さない (dedupe_photos で移せる)。
+"""
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F
+
+from .images import IMAGE_VARIANTS, variant_name
+from .models import ClimbRecord, PhotoBlob
+from .storage import immutable_key, photo_storage
+
+
+def _counted(name):
+    return bool(name) and immutable_key(name) is not None
+
+
+def retain(name, count=1):
+    if not _counted(name):
+        return
+    if PhotoBlob.objects.filter(name=name).update(refs=F('refs') + count):
+        return
+    try:
+        with transaction.atomic():
+            PhotoBlob.objects.create(name=name, refs=count)
+    except IntegrityError:
+        # 同時に作られた
+        PhotoBlob.objects.filter(name=name).update(refs=F('refs') + count)
+
+
+def release(name):
+    if not _counted(name) or not PhotoBlob.objects.filter(name=name).update(refs=F('refs') - 1):
+        return
+    transaction.on_commit(lambda: _delete_if_unused(name))
+
+
+def _delete_if_unused(name):
+    deleted, _ = PhotoBlob.objects.filter(name=name, refs__lte=0).delete()
+    if deleted:
+        delete_files(name)
+
+
+def delete_files(name, storage=None):
+    """写真と縮小画像のファイルを消す"""
+    storage = storage or photo_storage()
+    for target in [name, *(variant_name(name, variant) for variant in IMAGE_VARIANTS)]:
+        storage.delete(target)
+
+
+def changed(original, current):
+    """記録の写真が original から current に変わった"""
+    if original != current:
+        retain(current)
+        release(original)
+
+
+def rebuild():
+    """登山記録から参照数を数え直し、PhotoBlob の件数を返す。ハッシュを名前にしたファイルだけを数える"""
+    counts = {
+        row['image']: row['refs']
+        for row in ClimbRecord.objects.exclude(image='').exclude(image__isnull=True)
+        .values('image').annotate(refs=Count('pk')).order_by()
+        if _counted(row['image'])
+    }
+    with transaction.atomic():
+        PhotoBlob.objects.all().delete()
+        PhotoBlob.objects.bulk_create(
+            [PhotoBlob(name=name, refs=refs) for name, refs in counts.items()], batch_size=1000,
+        )
+    return len(counts)
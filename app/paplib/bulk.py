@@ -0,0 +1,68 @@
+from itertools import islice
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import ClimbRecord, Mountain
+from .parsers import InvalidLine
+from .serializers import ClimbRecordImportSerializer
+from .signals import records_bulk_created
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def import_records(user, rows, chunk_size=None):
+    """登山記録をまとめて登録する。
+
+    rows は dict のイテラブル (ジェネレータでもよい)。chunk_size 件ずつ検証し、
+    正しい行だけを bulk_create で登録する。不正な行 (NDJSON の読めない行を含む) は登録せず、
+    0 から数えた行番号とエラー内容を返す。途中で止めないので、errors の行だけを送り直せばよい。
+    """
+    chunk_size = chunk_size or getattr(settings, 'RECORD_IMPORT_CHUNK_SIZE', 1000)
+    max_rows = getattr(settings, 'RECORD_IMPORT_MAX_ROWS', 100000)
+    created = 0
+    errors = []
+    offset = 0
+    for chunk in chunked(rows, chunk_size):
+        if offset + len(chunk) > max_rows:
+            errors.append({'row': max_rows, 'errors': {'non_field_errors': [f'一度に登録できるのは {max_rows} 件までです。']}})
+            break
+        records, chunk_errors = _validate_chunk(user, chunk, offset)
+        errors.extend(chunk_errors)
+        if records:
+            with transaction.atomic():
+                records = ClimbRecord.objects.bulk_create(records)
+                records_bulk_created.send(sender=ClimbRecord, records=records)
+            created += len(records)
+        offset += len(chunk)
+    return created, errors
+
+
+def _validate_chunk(user, chunk, offset):
+    # 山の存在確認はチャンクごとに1クエリで行う
+    mountain_ids = set()
+    for row in chunk:
+        try:
+            mountain_ids.add(int(row.get('mountain')))
+        except (AttributeError, TypeError, ValueError):
+            pass
+    existing = set(Mountain.objects.filter(pk__in=mountain_ids).values_list('pk', flat=True))
+
+    records, errors = [], []
+    for i, row in enumerate(chunk, start=offset):
+        if isinstance(row, InvalidLine):
+            errors.append({'row': i, 'errors': {'non_field_errors': [row.message]}})
+            continue
+        if not isinstance(row, dict):
+            errors.append({'row': i, 'errors': {'non_field_errors': ['オブジェクトではありません。']}})
+            continue
+        serializer = ClimbRecordImportSerializer(data=row, context={'mountain_ids': existing})
+        if not serializer.is_valid():
+            errors.append({'row': i, 'errors': serializer.errors})
+            continue
+        records.append(ClimbRecord(user=user, **serializer.validated_data))
+    return records, errors
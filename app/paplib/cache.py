@@ -0,0 +1,113 @@
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+
+HITS_KEY = 'paplib:stats:hits'
+MISSES_KEY = 'paplib:stats:misses'
+
+
+def get_cache():
+    return caches[getattr(settings, 'PAPLIB_CACHE_ALIAS', 'default')]
+
+
+def _version_key(namespace):
+    return f'paplib:{namespace}:version'
+
+
+def namespace_version(namespace):
+    # 版番号のキーが追い出されても古いエントリを拾わないよう、乱数を版番号にする
+    return get_cache().get_or_set(_version_key(namespace), uuid.uuid4().hex, timeout=None)
+
+
+async def anamespace_version(namespace):
+    return await get_cache().aget_or_set(_version_key(namespace), uuid.uuid4().hex, timeout=None)
+
+
+def _key(namespace, version, parts):
+    digest = hashlib.sha256('|'.join(str(part) for part in parts).encode('utf-8')).hexdigest()[:32]
+    return f'paplib:{namespace}:{version}:{digest}'
+
+
+def make_key(namespace, *parts):
+    return _key(namespace, namespace_version(namespace), parts)
+
+
+async def amake_key(namespace, *parts):
+    return _key(namespace, await anamespace_version(namespace), parts)
+
+
+def invalidate(namespace):
+    """名前空間の版番号を変え、その名前空間のエントリをまとめて無効にする"""
+    get_cache().set(_version_key(namespace), uuid.uuid4().hex, timeout=None)
+
+
+def invalidate_mountain(mountain_id):
+    invalidate('mountains')
+    invalidate(f'mountain:{mountain_id}')
+
+
+def invalidate_user_stats(user_id=None):
+    """ユーザーの統計 (paplib.stats) を捨てる。user_id を省略すると全員分"""
+    invalidate('user_stats' if user_id is None else f'user_stats:{user_id}')
+
+
+def _count(key):
+    cache = get_cache()
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, timeout=None)
+
+
+async def _acount(key):
+    cache = get_cache()
+    try:
+        await cache.aincr(key)
+    except ValueError:
+        await cache.aset(key, 1, timeout=None)
+
+
+def _timeout():
+    return getattr(settings, 'PAPLIB_CACHE_TIMEOUT', 600)
+
+
+def fragment_context():
+    """テンプレートの {% cache %} に渡すキャッシュの別名と有効期限"""
+    return {
+        'fragment_cache': getattr(settings, 'PAPLIB_CACHE_ALIAS', 'default'),
+        'fragment_timeout': _timeout(),
+    }
+
+
+def get(key):
+    value = get_cache().get(key)
+    _count(MISSES_KEY if value is None else HITS_KEY)
+    return value
+
+
+def set(key, value):
+    get_cache().set(key, value, timeout=_timeout())
+
+
+# 非同期ビュー (paplib.async_views) 用
+async def aget(key):
+    value = await get_cache().aget(key)
+    await _acount(MISSES_KEY if value is None else HITS_KEY)
+    return value
+
+
+async def aset(key, value):
+    await get_cache().aset(key, value, timeout=_timeout())
+
+
+def stats():
+    values = get_cache().get_many([HITS_KEY, MISSES_KEY])
+    hits, misses = values.get(HITS_KEY, 0), values.get(MISSES_KEY, 0)
+    total = hits + misses
+    return {'hits': hits, 'misses': misses, 'hit_rate': hits / total if total else 0.0}
+
+
+def reset_stats():
+    get_cache().delete_many([HITS_KEY, MISSES_KEY])
@@ -0,0 +1,84 @@
+import hashlib
+
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+
+
+def make_etag(*parts):
+    digest = hashlib.sha256('|'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+    return quote_etag(digest[:32])
+
+
+def latest(values):
+    """None を除いた最新の日時 (なければ None)"""
+    return max((value for value in values if value is not None), default=None)
+
+
+def conditional_response(request, etag, last_modified):
+    """検証値が一致すれば 304 (または 412) の応答を、そうでなければ None を返す"""
+    timestamp = int(last_modified.timestamp()) if last_modified else None
+    return get_conditional_response(request, etag=etag, last_modified=timestamp)
+
+
+def set_validators(response, etag, last_modified):
+    response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    patch_vary_headers(response, ['Accept'])
+    return response
+
+
+class ConditionalGetMixin:
+    """一覧・詳細の GET に ETag / Last-Modified を付け、変更がなければ 304 を返す。
+
+    検証値は updated_at の最大値と件数だけを問い合わせて作るので、
+    304 を返すときはシリアライズも本文のクエリも行わない。
+    応答に関連先の中身も出すときは、get_related_updated_fields() の更新日時も検証値に含める。
+    一覧には Last-Modified を付けない (行の削除や、絞り込みから外れる更新では updated_at の最大値が
+    変わらないので、If-Modified-Since では古い一覧に 304 を返してしまう)。一覧は件数を含む ETag で検証する。
+    """
+    updated_field = 'updated_at'
+    # 直近の 200 応答に付けた (ETag, 最終更新日時)
+    validators = None
+
+    def get_related_updated_fields(self):
+        return []
+
+    def _conditional(self, request, etag, last_modified):
+        return conditional_response(request, etag, last_modified)
+
+    def _with_validators(self, response, etag, last_modified):
+        if response.status_code == 200:
+            self.validators = (etag, last_modified)
+            set_validators(response, etag, last_modified)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        related = self.get_related_updated_fields()
+        state = queryset.order_by().aggregate(
+            last=Max(self.updated_field), count=Count('pk'),
+            **{f'related{i}': Max(field) for i, field in enumerate(related)},
+        )
+        lasts = [state['last'], *(state[f'related{i}'] for i in range(len(related)))]
+        etag = make_etag(request.get_full_path(), request.accepted_media_type, state['count'], *lasts)
+        not_modified = self._conditional(request, etag, None)
+        if not_modified is not None:
+            return not_modified
+        return self._with_validators(super().list(request, *args, **kwargs), etag, None)
+
+    def retrieve(self, request, *args, **kwargs):
+        lookup = {self.lookup_field: kwargs[self.lookup_url_kwarg or self.lookup_field]}
+        lasts = (
+            self.get_queryset().filter(**lookup)
+            .values_list(self.updated_field, *self.get_related_updated_fields()).first()
+        )
+        if lasts is None:
+            # 存在しなければ通常どおり 404 にする
+            return super().retrieve(request, *args, **kwargs)
+        etag = make_etag(request.get_full_path(), request.accepted_media_type, *lasts)
+        not_modified = self._conditional(request, etag, latest(lasts))
+        if not_modified is not None:
+            return not_modified
+        return self._with_validators(super().retrieve(request, *args, **kwargs), etag, latest(lasts))
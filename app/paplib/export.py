@@ -0,0 +1,55 @@
+import csv
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+# 書き出す列 (ClimbRecord.values() のキー, 出力名)
+EXPORT_COLUMNS = [
+    ('id', 'id'),
+    ('user__username', 'user'),
+    ('mountain_id', 'mountain'),
+    ('mountain__name', 'mountain_name'),
+    ('climb_date', 'climb_date'),
+    ('comment', 'comment'),
+    ('image', 'image'),
+    ('created_at', 'created_at'),
+    ('updated_at', 'updated_at'),
+]
+
+
+def export_rows(queryset, chunk_size=2000):
+    """記録を dict で1件ずつ返す。サーバー側カーソルで chunk_size 件ずつ読み込む。"""
+    rows = queryset.order_by('id').values_list(*[column for column, _ in EXPORT_COLUMNS])
+    names = [name for _, name in EXPORT_COLUMNS]
+    for row in rows.iterator(chunk_size=chunk_size):
+        yield dict(zip(names, row))
+
+
+def iter_ndjson(rows):
+    encoder = DjangoJSONEncoder(ensure_ascii=False)
+    for row in rows:
+        yield encoder.encode(row) + '\n'
+
+
+class _Echo:
+    def write(self, value):
+        return value
+
+
+def iter_csv(rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow([name for _, name in EXPORT_COLUMNS])
+    for row in rows:
+        yield writer.writerow(row.values())
+
+
+def buffered(chunks, size=64 * 1024):
+    """小さな文字列をまとめて、ある程度の大きさごとに返す (送信回数を減らす)"""
+    buffer, length = [], 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield ''.join(buffer)
+            buffer, length = [], 0
+    if buffer:
+        yield ''.join(buffer)
@@ -0,0 +1,103 @@
+import datetime
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from rest_framework.exceptions import ValidationError
+
+
+def _parse(params, name, parser):
+    value = params.get(name)
+    if not value:
+        return None
+    parsed = parser(value)
+    if parsed is None:
+        raise ValidationError({name: [f'日付の形式が正しくありません: {value}']})
+    return parsed
+
+
+def _parse_datetime(value):
+    try:
+        parsed = parse_datetime(value)
+        if parsed is None and (date := parse_date(value)):
+            parsed = datetime.datetime.combine(date, datetime.time())
+    except ValueError:
+        return None
+    if parsed is not None and timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def _parse_date(value):
+    try:
+        return parse_date(value)
+    except ValueError:
+        return None
+
+
+def filter_records(queryset, params):
+    """クエリパラメータで登山記録を絞り込む。
+
+    user (ユーザー名), mountain (山のID), since / until (登った日の範囲, 両端を含む),
+    updated_since (この日時以降に更新された記録)
+    """
+    if params.get('user'):
+        queryset = queryset.filter(user__username=params['user'])
+    if params.get('mountain'):
+        try:
+            queryset = queryset.filter(mountain_id=int(params['mountain']))
+        except ValueError:
+            raise ValidationError({'mountain': ['山のIDは整数で指定してください。']})
+    since = _parse(params, 'since', _parse_date)
+    if since:
+        queryset = queryset.filter(climb_date__gte=since)
+    until = _parse(params, 'until', _parse_date)
+    if until:
+        queryset = queryset.filter(climb_date__lte=until)
+    updated_since = _parse(params, 'updated_since', _parse_datetime)
+    if updated_since:
+        queryset = queryset.filter(updated_at__gte=updated_since)
+    return queryset
+
+
+def _parse_float(params, name, low, high):
+    value = params.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        parsed = float(value)
+    except ValueError:
+        parsed = None
+    if parsed is None or not low <= parsed <= high:
+        raise ValidationError({name: [f'{low}〜{high} の数値で指定してください: {value}']})
+    return parsed
+
+
+def nearby_params(params):
+    """近くの山の検索のクエリパラメータを読む。
+
+    lat / lon (中心), radius (中心からの km), bbox (西,南,東,北 の経度・緯度) のうち、
+    lat と lon か bbox のどちらかは必須。limit (件数) は API_MAX_PAGE_SIZE まで。
+    """
+    lat = _parse_float(params, 'lat', -90, 90)
+    lon = _parse_float(params, 'lon', -180, 180)
+    if (lat is None) != (lon is None):
+        raise ValidationError({'lat': ['lat と lon は一緒に指定してください。']})
+    radius = _parse_float(params, 'radius', 0, 20000)
+    bbox = None
+    if params.get('bbox'):
+        try:
+            west, south, east, north = (float(v) for v in params['bbox'].split(','))
+        except ValueError:
+            raise ValidationError({'bbox': ['西,南,東,北 の4つの数値で指定してください。']})
+        if not (-180 <= west <= 180 and -180 <= east <= 180 and -90 <= south <= north <= 90):
+            raise ValidationError({'bbox': ['経度は -180〜180、緯度は -90〜90 (南 ≦ 北) で指定してください。']})
+        bbox = (south, west, north, east)
+    if lat is None and bbox is None:
+        raise ValidationError({'lat': ['lat と lon、または bbox を指定してください。']})
+    if radius is not None and lat is None:
+        raise ValidationError({'radius': ['radius は lat と lon と一緒に指定してください。']})
+    limit = params.get('limit') or '20'
+    if not limit.isdigit() or not 1 <= int(limit) <= settings.API_MAX_PAGE_SIZE:
+        raise ValidationError({'limit': [f'1〜{settings.API_MAX_PAGE_SIZE} の整数で指定してください。']})
+    return {'lat': lat, 'lon': lon, 'radius': radius, 'bbox': bbox, 'limit': int(limit)}
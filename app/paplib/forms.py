@@ -12,4 +12,4 @@ class ClimbRecordForm(forms.ModelForm):
 class MountainForm(forms.ModelForm):
     class Meta:
         model = Mountain
-        fields = ['name', 'prefecture', 'elevation']
\ No newline at end of file
+        fields = ['name', 'name_kana', 'prefecture', 'elevation', 'latitude', 'longitude']
\ No newline at end of file
@@ -0,0 +1,126 @@
+"""山の位置 (緯度・経度) による検索。
+
+緯度・経度を CELL_DEGREES 度ごとの格子に分け、山がどの升目にあるかを Mountain.geo_cell に入れておく
+(Mountain.save() が緯度・経度から計算する)。升目の番号は同じ緯度の行で連続するので、
+範囲内の山は「行ごとの geo_cell の範囲」を索引で引くだけで候補が絞れ、山の総数によらず
+範囲の広さに見合った行だけを読む。候補は最後に緯度・経度と大円距離 (haversine) で確かめる。
+"""
+import heapq
+import math
+
+from django.db.models import Q
+
+EARTH_RADIUS_KM = 6371.0088
+
+# 升目の大きさ (度)。変えると保存済みの geo_cell が合わなくなるので設定にはしない
+CELL_DEGREES = 0.1
+ROWS = round(180 / CELL_DEGREES)
+COLUMNS = round(360 / CELL_DEGREES)
+
+# 1回の問い合わせで行ごとに引く範囲の上限。超えたら緯度の帯全体を1つの範囲で引く
+MAX_RANGES = 200
+
+# 件数だけを指定した近傍検索で、最初に探す半径 (km)。足りなければ倍々に広げる
+START_RADIUS_KM = 10.0
+MAX_RADIUS_KM = math.pi * EARTH_RADIUS_KM
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """2点間の大円距離 (km)"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _row(lat):
+    return min(max(math.floor((lat + 90) / CELL_DEGREES), 0), ROWS - 1)
+
+
+def _column(lon):
+    return math.floor((lon + 180) / CELL_DEGREES) % COLUMNS
+
+
+def cell_of(lat, lon):
+    """緯度・経度の升目の番号 (どちらかがなければ None)"""
+    if lat is None or lon is None:
+        return None
+    return _row(lat) * COLUMNS + _column(lon)
+
+
+def bounding_box(lat, lon, radius_km):
+    """中心から radius_km 以内を囲む (南, 西, 北, 東)。日付変更線をまたぐときは 西 > 東 になる"""
+    angle = math.degrees(radius_km / EARTH_RADIUS_KM)
+    south, north = lat - angle, lat + angle
+    if south <= -90 or north >= 90 or radius_km >= MAX_RADIUS_KM / 2:
+        # 極を含むと経度は全周になる
+        return max(south, -90.0), -180.0, min(north, 90.0), 180.0
+    spread = math.degrees(math.asin(math.sin(radius_km / EARTH_RADIUS_KM) / math.cos(math.radians(lat))))
+    west, east = lon - spread, lon + spread
+    if west < -180:
+        west += 360
+    if east > 180:
+        east -= 360
+    return south, west, north, east
+
+
+def _longitude_q(west, east):
+    if west <= east:
+        return Q(longitude__gte=west, longitude__lte=east)
+    return Q(longitude__gte=west) | Q(longitude__lte=east)
+
+
+def within_box(queryset, south, west, north, east):
+    """(南, 西, 北, 東) の範囲にある山に絞り込む"""
+    first, last = _row(south), _row(north)
+    # 東端がちょうど 180 度なら最後の列まで (_column(180) は 0 に戻ってしまう)
+    east_column = COLUMNS - 1 if east >= 180 else _column(east)
+    if west <= east and east - west < 360 - CELL_DEGREES:
+        columns = [(_column(west), east_column)]
+    elif west > east:
+        columns = [(_column(west), COLUMNS - 1), (0, east_column)]
+    else:
+        columns = [(0, COLUMNS - 1)]
+    if (last - first + 1) * len(columns) <= MAX_RANGES:
+        cells = Q()
+        for row in range(first, last + 1):
+            for start, end in columns:
+                cells |= Q(geo_cell__range=(row * COLUMNS + start, row * COLUMNS + end))
+    else:
+        cells = Q(geo_cell__range=(first * COLUMNS, last * COLUMNS + COLUMNS - 1))
+    return queryset.filter(cells, Q(latitude__gte=south, latitude__lte=north), _longitude_q(west, east))
+
+
+def _within_radius(queryset, lat, lon, radius_km):
+    """radius_km 以内の山の (距離, id) のリスト。緯度・経度だけを読む"""
+    candidates = within_box(queryset, *bounding_box(lat, lon, radius_km)).values_list('pk', 'latitude', 'longitude')
+    found = []
+    for pk, mlat, mlon in candidates:
+        distance = haversine_km(lat, lon, mlat, mlon)
+        if distance <= radius_km:
+            found.append((distance, pk))
+    return found
+
+
+def nearby(queryset, lat, lon, radius_km=None, limit=20):
+    """(lat, lon) から近い順に最大 limit 件の山を返す。各山の distance_km に距離を入れる。
+
+    radius_km を省略すると、limit 件見つかるまで探す半径を広げる (見つかった範囲の内側は
+    すべて調べているので、近い順の結果は全件を調べた場合と同じになる)。
+    """
+    if radius_km is not None:
+        found = _within_radius(queryset, lat, lon, radius_km)
+    else:
+        radius_km = START_RADIUS_KM
+        while True:
+            found = _within_radius(queryset, lat, lon, radius_km)
+            if len(found) >= limit or radius_km >= MAX_RADIUS_KM:
+                break
+            radius_km = min(radius_km * 2, MAX_RADIUS_KM)
+    nearest = heapq.nsmallest(limit, found)
+    mountains = queryset.in_bulk([pk for _, pk in nearest])
+    results = []
+    for distance, pk in nearest:
+        mountain = mountains[pk]
+        mountain.distance_km = round(distance, 3)
+        results.append(mountain)
+    return results
@@ -0,0 +1,67 @@
+import posixpath
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps
+
+from .profiling import section
+from .storage import photo_storage
+
+# 生成する縮小画像の種類と最大サイズ (幅, 高さ)
+IMAGE_VARIANTS = {
+    'thumb': (320, 320),
+    'medium': (1024, 1024),
+}
+
+_EXTENSIONS = {'JPEG': 'jpg', 'WEBP': 'webp'}
+
+
+def variant_format():
+    return getattr(settings, 'IMAGE_VARIANT_FORMAT', 'JPEG').upper()
+
+
+def variant_name(name, variant):
+    """元画像のファイル名から縮小画像のファイル名を決める。
+
+    photos/abc.jpeg -> photos/variants/abc_thumb.jpg
+    ファイル名だけで決まるので、URLの生成にストレージへの問い合わせは不要。
+    """
+    directory, filename = posixpath.split(name)
+    stem = posixpath.splitext(filename)[0]
+    ext = _EXTENSIONS[variant_format()]
+    return posixpath.join(directory, 'variants', f'{stem}_{variant}.{ext}')
+
+
+def variant_url(name, variant, storage=None):
+    if not name:
+        return None
+    with section('img'):
+        return (storage or photo_storage()).url(variant_name(name, variant))
+
+
+def generate_variants(name, storage=None, force=False):
+    """元画像から全ての縮小画像を作成し、作成したファイル名のリストを返す"""
+    storage = storage or photo_storage()
+    targets = {v: variant_name(name, v) for v in IMAGE_VARIANTS}
+    if not force:
+        targets = {v: n for v, n in targets.items() if not storage.exists(n)}
+    if not targets:
+        return []
+
+    fmt = variant_format()
+    with storage.open(name, 'rb') as f:
+        original = Image.open(f)
+        original = ImageOps.exif_transpose(original)
+        original = original.convert('RGB')
+
+    created = []
+    for variant, target in targets.items():
+        image = original.copy()
+        image.thumbnail(IMAGE_VARIANTS[variant], Image.Resampling.LANCZOS)
+        buffer = BytesIO()
+        image.save(buffer, format=fmt, quality=85, optimize=True)
+        if storage.exists(target):
+            storage.delete(target)
+        created.append(storage.save(target, ContentFile(buffer.getvalue())))
+    return created
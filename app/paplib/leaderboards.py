@@ -0,0 +1,173 @@
+"""ランキング (/api/leaderboards/)。
+
+LeaderboardEntry に (範囲, 年, ユーザー) ごとの登山回数・登った山の数・標高の合計を保存しておき、
+読むときは指標の索引を上から順にたどるだけにする。記録の保存・削除では、その記録が数えられる
+範囲と年の行だけを計算し直す (paplib.signals)。rebuild_leaderboards コマンドで全体を作り直せる。
+"""
+import functools
+import operator
+from collections import defaultdict
+
+from django.core import signing
+from django.db import transaction
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import Coalesce, ExtractYear
+
+from .models import ClimbRecord, LeaderboardEntry, Mountain
+from .tasks import task
+
+OVERALL = ''
+ALL_TIME = 0
+CURSOR_SALT = 'paplib.leaderboards'
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def prefecture_scope(name):
+    return f'p:{name}'
+
+
+def mountain_scope(pk):
+    return f'm:{pk}'
+
+
+def scopes(mountain_id, prefecture, year):
+    """その山・年の記録が数えられる (範囲, 年) の組を返す。山ごとのランキングは全期間だけ"""
+    keys = {(OVERALL, ALL_TIME), (OVERALL, year), (mountain_scope(mountain_id), ALL_TIME)}
+    if prefecture is not None:
+        keys |= {(prefecture_scope(prefecture), ALL_TIME), (prefecture_scope(prefecture), year)}
+    return keys
+
+
+def _condition(scope, year):
+    condition = Q()
+    if scope.startswith('p:'):
+        condition &= Q(mountain__prefecture=scope[2:])
+    elif scope.startswith('m:'):
+        condition &= Q(mountain_id=int(scope[2:]))
+    if year:
+        condition &= Q(climb_date__year=year)
+    return condition
+
+
+def refresh(user_id, keys):
+    """user_id の keys ((範囲, 年) の組) の行を記録から計算し直す。集計は1クエリにまとめる"""
+    keys = sorted(keys)
+    if not keys:
+        return
+    expressions = {}
+    for i, (scope, year) in enumerate(keys):
+        condition = _condition(scope, year)
+        expressions[f'climbs_{i}'] = Count('pk', filter=condition)
+        expressions[f'peaks_{i}'] = Count('mountain', filter=condition, distinct=True)
+        expressions[f'elevation_{i}'] = Coalesce(Sum('mountain__elevation', filter=condition), 0)
+    totals = ClimbRecord.objects.filter(user_id=user_id).aggregate(**expressions)
+
+    entries, empty = [], []
+    for i, (scope, year) in enumerate(keys):
+        if totals[f'climbs_{i}']:
+            entries.append(LeaderboardEntry(
+                scope=scope, year=year, user_id=user_id,
+                **{metric: totals[f'{metric}_{i}'] for metric in LeaderboardEntry.METRICS},
+            ))
+        else:
+            empty.append(Q(scope=scope, year=year))
+    if entries:
+        LeaderboardEntry.objects.bulk_create(
+            entries, update_conflicts=True, unique_fields=['scope', 'year', 'user'],
+            update_fields=list(LeaderboardEntry.METRICS),
+        )
+    if empty:
+        LeaderboardEntry.objects.filter(functools.reduce(operator.or_, empty), user_id=user_id).delete()
+
+
+def records_changed(*snapshots):
+    """保存・削除された記録の前後の値 (paplib.aggregates.snapshot, なければ None) から関係する行を更新する"""
+    snapshots = [values for values in snapshots if values]
+    prefectures = dict(
+        Mountain.objects.filter(pk__in={values['mountain_id'] for values in snapshots})
+        .values_list('pk', 'prefecture')
+    )
+    keys = defaultdict(set)
+    for values in snapshots:
+        keys[values['user_id']] |= scopes(
+            values['mountain_id'], prefectures.get(values['mountain_id']), values['climb_date'].year,
+        )
+    for user_id, user_keys in keys.items():
+        refresh(user_id, user_keys)
+
+
+def rebuild(user_ids=None, batch_size=500):
+    """user_ids (省略時は全員) の行を記録から作り直し、作った行数を返す"""
+    if user_ids is None:
+        LeaderboardEntry.objects.all().delete()
+        user_ids = ClimbRecord.objects.order_by('user_id').values_list('user_id', flat=True).distinct()
+    user_ids = list(user_ids)
+    created = 0
+    for i in range(0, len(user_ids), batch_size):
+        batch = user_ids[i:i + batch_size]
+        rows = (
+            ClimbRecord.objects.filter(user_id__in=batch)
+            .annotate(year=ExtractYear('climb_date'))
+            .values('user_id', 'year', 'mountain_id', 'mountain__prefecture', 'mountain__elevation')
+            .annotate(climbs=Count('pk'))
+            .order_by()
+        )
+        totals = defaultdict(lambda: {'climbs': 0, 'elevation': 0, 'peaks': set()})
+        for row in rows.iterator():
+            for scope, year in scopes(row['mountain_id'], row['mountain__prefecture'], row['year']):
+                entry = totals[(scope, year, row['user_id'])]
+                entry['climbs'] += row['climbs']
+                entry['elevation'] += row['mountain__elevation'] * row['climbs']
+                entry['peaks'].add(row['mountain_id'])
+        entries = [
+            LeaderboardEntry(
+                scope=scope, year=year, user_id=user_id,
+                climbs=entry['climbs'], peaks=len(entry['peaks']), elevation=entry['elevation'],
+            )
+            for (scope, year, user_id), entry in totals.items()
+        ]
+        with transaction.atomic():
+            LeaderboardEntry.objects.filter(user_id__in=batch).delete()
+            LeaderboardEntry.objects.bulk_create(entries, batch_size=1000)
+        created += len(entries)
+    return created
+
+
+@task()
+def rebuild_users(user_ids):
+    """タスクキューから rebuild する (引数は JSON にするのでリスト)"""
+    rebuild(user_ids)
+
+
+def page(metric, scope, year, size, cursor=None):
+    """ランキングの1ページを [(順位, LeaderboardEntry), ...] と次のページのカーソル (なければ None) で返す。
+
+    順位 (同じ値なら同じ順位) はカーソルで引き継ぐので、どのページも size + 1 件を読むだけで済む。
+    """
+    queryset = LeaderboardEntry.objects.filter(scope=scope, year=year).select_related('user')
+    previous, position, rank = None, 0, 0
+    if cursor:
+        try:
+            previous, user_id, position, rank = signing.loads(cursor, salt=CURSOR_SALT)
+        except (signing.BadSignature, TypeError, ValueError):
+            raise InvalidCursor
+        # (値の降順, ユーザーIDの昇順) で前のページの最後より後ろ
+        queryset = queryset.filter(**{f'{metric}__lte': previous}).exclude(**{metric: previous, 'user_id__lte': user_id})
+    entries = list(queryset.order_by(f'-{metric}', 'user_id')[:size + 1])
+
+    results = []
+    for entry in entries[:size]:
+        position += 1
+        value = getattr(entry, metric)
+        if value != previous:
+            rank = position
+        previous = value
+        results.append((rank, entry))
+    next_cursor = None
+    if len(entries) > size:
+        last = entries[size - 1]
+        next_cursor = signing.dumps([getattr(last, metric), last.user_id, position, rank], salt=CURSOR_SALT)
+    return results, next_cursor
@@ -0,0 +1,149 @@
+import asyncio
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.test.utils import override_settings
+
+HOST = 'testserver'
+
+
+class Command(BaseCommand):
+    help = ('同時接続数ごとに、WSGI (スレッド数固定のワーカー1つ) と ASGI (非同期ビュー) の'
+            'スループットと応答時間を比べます。サーバーは起動せず、アプリを直接呼び出して'
+            '遅いクライアント (応答の受け取りに --client-delay 秒かかる) を再現します。')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='/api/records/', help='計測する URL (クエリ文字列を含めてよい)')
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 10, 50, 200])
+        parser.add_argument('--requests', type=int, default=400, help='1回の計測で送るリクエスト数')
+        parser.add_argument('--client-delay', type=float, default=0.1,
+                            help='クライアントが応答を受け取り終えるまでの秒数')
+        parser.add_argument('--wsgi-threads', type=int, default=8,
+                            help='WSGI ワーカーのスレッド数 (gunicorn --threads 相当)')
+
+    def handle(self, *args, url, concurrency, requests, client_delay, wsgi_threads, **options):
+        parts = urlsplit(url)
+        path, query = parts.path, parts.query
+        rows = []
+        with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, HOST]):
+            for clients in concurrency:
+                with override_settings(ROOT_URLCONF='app.urls'):
+                    rows.append(('wsgi', clients, *self._run_wsgi(path, query, clients, requests,
+                                                                  client_delay, wsgi_threads)))
+                with override_settings(ROOT_URLCONF='app.urls_async'):
+                    rows.append(('asgi', clients, *asyncio.run(self._run_asgi(path, query, clients, requests,
+                                                                              client_delay))))
+                connections.close_all()
+
+        self.stdout.write(f'\n{url}  リクエスト {requests} 件, 応答の受け取り {client_delay:g} 秒, '
+                          f'WSGI スレッド {wsgi_threads}')
+        for mode, clients, elapsed, latencies, errors in rows:
+            p95 = statistics.quantiles(latencies, n=20)[-1] if len(latencies) > 1 else latencies[0]
+            self.stdout.write(
+                f'{mode}  同時 {clients:4d}  {len(latencies) / elapsed:8.1f} req/s  '
+                f'p50 {statistics.median(latencies):8.1f} ms  p95 {p95:8.1f} ms  エラー {errors}'
+            )
+
+    def _run_wsgi(self, path, query, clients, requests, client_delay, threads):
+        """クライアント clients 人が順にリクエストを送り、ワーカーのスレッドが空くのを待って処理される"""
+        handler = WSGIHandler()
+        workers = threading.BoundedSemaphore(threads)
+        remaining = iter(range(requests))
+        lock = threading.Lock()
+        latencies, errors = [], []
+
+        def client():
+            while True:
+                with lock:
+                    if next(remaining, None) is None:
+                        return
+                start = time.perf_counter()
+                with workers:
+                    status = []
+                    environ = self._environ(path, query)
+                    body = handler(environ, lambda s, headers, exc_info=None: status.append(s))
+                    try:
+                        b''.join(body)
+                        # 遅いクライアントへの送信が終わるまでワーカーのスレッドは埋まったまま
+                        time.sleep(client_delay)
+                    finally:
+                        body.close()
+                latencies.append((time.perf_counter() - start) * 1000)
+                if not status[0].startswith('200'):
+                    errors.append(status[0])
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=clients) as pool:
+            for future in [pool.submit(client) for _ in range(clients)]:
+                future.result()
+        return time.perf_counter() - start, latencies, len(errors)
+
+    async def _run_asgi(self, path, query, clients, requests, client_delay):
+        handler = ASGIHandler()
+        remaining = iter(range(requests))
+        latencies, errors = [], []
+
+        async def client():
+            while next(remaining, None) is not None:
+                start = time.perf_counter()
+                status = await self._asgi_request(handler, path, query, client_delay)
+                latencies.append((time.perf_counter() - start) * 1000)
+                if status != 200:
+                    errors.append(status)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(clients)))
+        return time.perf_counter() - start, latencies, len(errors)
+
+    async def _asgi_request(self, handler, path, query, client_delay):
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+            'method': 'GET', 'scheme': 'http', 'path': path, 'raw_path': path.encode(),
+            'query_string': query.encode(), 'root_path': '',
+            'headers': [(b'host', HOST.encode()), (b'accept', b'application/json')],
+            'client': ('127.0.0.1', 50000), 'server': (HOST, 80),
+        }
+        sent = False
+        disconnected = asyncio.Event()
+        status = None
+
+        async def receive():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+            # 応答を返し終えるまで切断しない
+            await disconnected.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            elif message['type'] == 'http.response.body' and not message.get('more_body'):
+                # 遅いクライアントへの送信を待つ間、イベントループは他のリクエストを処理できる
+                await asyncio.sleep(client_delay)
+
+        await handler(scope, receive, send)
+        disconnected.set()
+        return status
+
+    def _environ(self, path, query):
+        return {
+            'REQUEST_METHOD': 'GET', 'SCRIPT_NAME': '', 'PATH_INFO': path, 'QUERY_STRING': query,
+            'SERVER_NAME': HOST, 'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1',
+            'HTTP_HOST': HOST, 'HTTP_ACCEPT': 'application/json',
+            'wsgi.version': (1, 0), 'wsgi.url_scheme': 'http', 'wsgi.input': BytesIO(b''),
+            'wsgi.errors': sys.stderr, 'wsgi.multithread': True, 'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
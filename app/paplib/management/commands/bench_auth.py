@@ -0,0 +1,73 @@
+import base64
+import datetime
+import statistics
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from paplib.models import ClimbRecord, Mountain
+
+USERNAME = 'bench_auth'
+PASSWORD = 'bench-auth-password'
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = ('Basic 認証とトークン認証で、認証付きの書き込み (登山記録の更新) の速さを比べます。'
+            '計測用のユーザーと記録は最後に取り消します。')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=50, help='認証方式ごとのリクエスト数')
+
+    def handle(self, *args, requests, **options):
+        if requests < 1:
+            raise CommandError('--requests は1以上にしてください。')
+        results = {}
+        try:
+            # Basic 認証のリクエストはどれも遅いので slow log には書かない
+            with transaction.atomic(), override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'],
+                                                         PAPLIB_SLOW_REQUEST_MS=float('inf')):
+                user = User.objects.create_user(USERNAME, password=PASSWORD)
+                mountain = Mountain.objects.create(name='計測用の山', prefecture='東京都', elevation=1)
+                record = ClimbRecord.objects.create(user=user, mountain=mountain, climb_date=datetime.date(2025, 1, 1))
+                url = reverse('climbrecord-detail', args=[record.pk])
+                client = Client()
+
+                basic = base64.b64encode(f'{USERNAME}:{PASSWORD}'.encode()).decode()
+                response = client.post(reverse('api-token'), {'username': USERNAME, 'password': PASSWORD})
+                if response.status_code != 200:
+                    raise CommandError(f'トークンを取得できませんでした ({response.status_code})')
+                token = response.json()['token']
+
+                for name, header in (('basic', f'Basic {basic}'), ('token', f'Token {token}')):
+                    results[name] = self._measure(client, url, header, requests)
+                raise Rollback
+        except Rollback:
+            pass
+
+        for name, (rate, p50, p95) in results.items():
+            self.stdout.write(f'{name:6s} {rate:8.1f} req/s  p50 {p50:8.2f} ms  p95 {p95:8.2f} ms')
+        self.stdout.write(f'トークン認証は Basic 認証の {results["token"][0] / results["basic"][0]:.1f} 倍')
+
+    def _measure(self, client, url, header, requests):
+        latencies = []
+        start = time.perf_counter()
+        for i in range(requests):
+            began = time.perf_counter()
+            response = client.patch(url, {'comment': f'計測 {i}'}, content_type='application/json',
+                                    headers={'authorization': header})
+            latencies.append((time.perf_counter() - began) * 1000)
+            if response.status_code != 200:
+                raise CommandError(f'更新に失敗しました ({response.status_code})')
+        elapsed = time.perf_counter() - start
+        p95 = statistics.quantiles(latencies, n=20)[-1] if len(latencies) > 1 else latencies[0]
+        return requests / elapsed, statistics.median(latencies), p95
@@ -0,0 +1,292 @@
+import datetime
+import json
+import platform
+import statistics
+import subprocess
+import time
+import tracemalloc
+
+import django
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import URLResolver, get_resolver, reverse
+
+from paplib import cache
+from paplib.models import ClimbRecord, Mountain
+
+# URL 名の先頭と、pk に使う計測用オブジェクト
+PK_SAMPLES = [('mountain', 'mountain'), ('climbrecord', 'record'), ('record', 'record'), ('user', 'user')]
+
+# 全件を返すと1回の計測が長くなりすぎるものは絞り込む (クエリパラメータ名, 計測用オブジェクト)
+ENDPOINT_PARAMS = {
+    'climbrecord-export': {'mountain': 'mountain'},
+    'mountain-nearby': {'lat': 'latitude', 'lon': 'longitude'},
+}
+
+# 同じ URL をパラメータを変えて別に測るもの {結果の名前: (URL 名, パラメータ)}
+ENDPOINT_VARIANTS = {
+    'mountain-nearby:bbox': ('mountain-nearby', {'bbox': 'bbox'}),
+}
+
+# ?bbox= の計測に使う、計測用の山を中心にした範囲の半分の幅 (度)
+BBOX_DEGREES = 0.5
+
+
+def paplib_endpoints():
+    """paplib のビューを指す名前付き URL を {名前: (URL の引数名, GET できるか)} で返す"""
+    endpoints = {}
+
+    def walk(patterns):
+        for pattern in patterns:
+            if isinstance(pattern, URLResolver):
+                walk(pattern.url_patterns)
+                continue
+            callback = pattern.callback
+            view = getattr(callback, 'cls', None) or getattr(callback, 'view_class', None) or callback
+            if not pattern.name or not view.__module__.startswith('paplib.'):
+                continue
+            params = set(pattern.pattern.regex.groupindex)
+            # ルーターが作る .json などの別名は除く
+            if 'format' in params:
+                continue
+            if hasattr(callback, 'actions'):
+                allows_get = 'get' in callback.actions
+            elif hasattr(callback, 'view_class'):
+                allows_get = hasattr(view, 'get')
+            else:
+                allows_get = True
+            endpoints.setdefault(pattern.name, (params, allows_get))
+
+    walk(get_resolver().url_patterns)
+    return endpoints
+
+
+def _summary(values):
+    if len(values) == 1:
+        value = values[0]
+        return {'mean': value, 'p50': value, 'p90': value, 'p95': value, 'p99': value, 'max': value}
+    cuts = statistics.quantiles(values, n=100, method='inclusive')
+    return {
+        'mean': statistics.mean(values),
+        'p50': cuts[49], 'p90': cuts[89], 'p95': cuts[94], 'p99': cuts[98],
+        'max': max(values),
+    }
+
+
+def _git_commit():
+    try:
+        result = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True, text=True, check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip()
+
+
+class Command(BaseCommand):
+    help = ('paplib の全ての画面と API (GET) について、応答時間の分位点・クエリ数・最大メモリ使用量を測り、'
+            'JSON に書き出します。--compare で以前の結果と比べられます。')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=30, help='1つの URL を計測する回数')
+        parser.add_argument('--warmup', type=int, default=3, help='計測前に捨てるリクエストの回数')
+        parser.add_argument('--user', help='ログインするユーザー名 (省略時は記録の最も多いユーザー)')
+        parser.add_argument('--staff', help='--user では 403 になる管理者用の URL でログインするユーザー名 '
+                                            '(省略時は最初の is_staff のユーザー)')
+        parser.add_argument('--anonymous', action='store_true', help='ログインせずに計測する')
+        parser.add_argument('--cold', action='store_true', help='リクエストごとにキャッシュを空にする')
+        parser.add_argument('--only', nargs='+', metavar='NAME', help='計測する URL 名')
+        parser.add_argument('--output', help='結果の JSON ファイル (省略時は bench_endpoints_<日時>.json)')
+        parser.add_argument('--compare', metavar='FILE', help='比較する以前の結果の JSON ファイル')
+
+    def handle(self, *args, repeat, warmup, user, staff, anonymous, cold, only, output, compare, **options):
+        if repeat < 1:
+            raise CommandError('--repeat は1以上にしてください。')
+        samples = self._samples(user)
+        client, staff_client = Client(), None
+        if not anonymous:
+            client.force_login(samples['user_obj'])
+            staff_user = self._staff(staff)
+            if staff_user is not None:
+                staff_client = Client()
+                staff_client.force_login(staff_user)
+
+        results, skipped, failed = {}, [], {}
+        with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+            for name, (params, allows_get) in sorted(paplib_endpoints().items()):
+                if only and name not in only:
+                    continue
+                kwargs = self._kwargs(name, params, samples)
+                if not allows_get or kwargs is None:
+                    skipped.append(name)
+                    continue
+                url = reverse(name, kwargs=kwargs)
+                variants = {name: ENDPOINT_PARAMS.get(name, {})}
+                variants.update({label: p for label, (n, p) in ENDPOINT_VARIANTS.items() if n == name})
+                for label, query_params in variants.items():
+                    if any(key not in samples for key in query_params.values()):
+                        skipped.append(label)
+                        continue
+                    query = {param: samples[key] for param, key in query_params.items()}
+                    # エラーの応答を測っても意味がないので、2xx を返すことを先に確かめる
+                    login = 'anon' if anonymous else 'user'
+                    status = client.get(url, query).status_code
+                    if status == 403 and staff_client is not None:
+                        login, status = 'staff', staff_client.get(url, query).status_code
+                    if not 200 <= status < 300:
+                        failed[label] = status
+                        continue
+                    results[label] = self._measure(
+                        staff_client if login == 'staff' else client, url, query, repeat, warmup, cold,
+                    )
+                    results[label]['login'] = login
+                    self._write_row(label, results[label])
+
+        if skipped:
+            self.stdout.write(f'計測しなかった URL (GET できない・引数を決められない): {", ".join(skipped)}')
+        if failed:
+            self.stdout.write(self.style.WARNING(
+                '2xx を返さなかったので計測しなかった URL: '
+                + ', '.join(f'{name} ({status})' for name, status in failed.items())
+            ))
+
+        report = {
+            'created_at': datetime.datetime.now().astimezone().isoformat(timespec='seconds'),
+            'git_commit': _git_commit(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'dataset': {
+                'mountains': Mountain.objects.count(),
+                'users': User.objects.count(),
+                'records': ClimbRecord.objects.count(),
+            },
+            'options': {
+                'repeat': repeat, 'warmup': warmup, 'cold': cold,
+                'user': None if anonymous else samples['user_obj'].username,
+                'staff': staff_user.username if staff_client is not None else None,
+            },
+            'endpoints': results,
+            'failed': failed,
+        }
+        output = output or f'bench_endpoints_{datetime.datetime.now():%Y%m%d-%H%M%S}.json'
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        self.stdout.write(self.style.SUCCESS(f'結果を {output} に書き出しました'))
+
+        if compare:
+            self._compare(compare, results)
+
+    def _samples(self, username):
+        if username:
+            user = User.objects.filter(username=username).first()
+            if user is None:
+                raise CommandError(f'ユーザーが見つかりません: {username}')
+        else:
+            user = User.objects.annotate(n=Count('climbrecord')).order_by('-n', 'id').first()
+        mountain = Mountain.objects.order_by('-record_count', 'id').first()
+        record = ClimbRecord.objects.filter(user=user).order_by('-climb_date', '-id').first() if user else None
+        if user is None or mountain is None or record is None:
+            raise CommandError('計測用のデータがありません。先に seed_data を実行してください。')
+        samples = {'user_obj': user, 'user': user.pk, 'mountain': mountain.pk, 'record': record.pk}
+        # 近くの山の検索は、位置のある山のうち最も記録の多い山の周りで測る
+        located = (
+            Mountain.objects.exclude(latitude=None).exclude(longitude=None)
+            .order_by('-record_count', 'id').first()
+        )
+        if located is not None:
+            lat, lon = located.latitude, located.longitude
+            samples.update(latitude=lat, longitude=lon, bbox=','.join(f'{v:.4f}' for v in (
+                lon - BBOX_DEGREES, lat - BBOX_DEGREES, lon + BBOX_DEGREES, lat + BBOX_DEGREES,
+            )))
+        return samples
+
+    def _staff(self, username):
+        if username:
+            user = User.objects.filter(username=username, is_staff=True).first()
+            if user is None:
+                raise CommandError(f'管理者のユーザーが見つかりません: {username}')
+            return user
+        return User.objects.filter(is_staff=True, is_active=True).order_by('id').first()
+
+    def _kwargs(self, name, params, samples):
+        if not params:
+            return {}
+        if params != {'pk'}:
+            return None
+        for prefix, key in PK_SAMPLES:
+            if name.startswith(prefix):
+                return {'pk': samples[key]}
+        return None
+
+    def _measure(self, client, url, query, repeat, warmup, cold):
+        def fetch():
+            response = client.get(url, query)
+            if response.streaming:
+                size = sum(len(chunk) for chunk in response.streaming_content)
+            else:
+                size = len(response.content)
+            return response, size
+
+        for _ in range(warmup):
+            fetch()
+
+        latencies, queries = [], []
+        for _ in range(repeat):
+            if cold:
+                cache.get_cache().clear()
+            with CaptureQueriesContext(connection) as ctx:
+                start = time.perf_counter()
+                response, size = fetch()
+                latencies.append((time.perf_counter() - start) * 1000)
+            queries.append(len(ctx.captured_queries))
+
+        # tracemalloc は処理を遅くするので、応答時間とは別の1回で測る
+        if cold:
+            cache.get_cache().clear()
+        tracemalloc.start()
+        try:
+            fetch()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        return {
+            'url': url,
+            'params': query,
+            'status': response.status_code,
+            'bytes': size,
+            'latency_ms': _summary(latencies),
+            'queries': {'median': statistics.median(queries), 'max': max(queries)},
+            'peak_memory_kib': round(peak / 1024, 1),
+        }
+
+    def _write_row(self, name, result):
+        latency = result['latency_ms']
+        self.stdout.write(
+            f'{name:28s} {result["status"]} {result["login"]:5s}  p50 {latency["p50"]:8.2f} ms  p95 {latency["p95"]:8.2f} ms  '
+            f'クエリ {result["queries"]["max"]:3d}  メモリ {result["peak_memory_kib"]:9.1f} KiB'
+        )
+
+    def _compare(self, path, results):
+        with open(path, encoding='utf-8') as f:
+            previous = json.load(f)['endpoints']
+        self.stdout.write(f'\n{path} との比較 (前回 → 今回)')
+        for name, result in results.items():
+            before = previous.get(name)
+            if before is None:
+                self.stdout.write(f'{name:28s} (前回の結果なし)')
+                continue
+            parts = []
+            for key in ('p50', 'p95'):
+                old, new = before['latency_ms'][key], result['latency_ms'][key]
+                change = f'{(new - old) / old:+.0%}' if old else '-'
+                parts.append(f'{key} {old:.2f} → {new:.2f} ms ({change})')
+            parts.append(f'クエリ {before["queries"]["max"]} → {result["queries"]["max"]}')
+            parts.append(f'メモリ {before["peak_memory_kib"]} → {result["peak_memory_kib"]} KiB')
+            self.stdout.write(f'{name:28s} ' + '  '.join(parts))
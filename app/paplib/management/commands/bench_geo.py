@@ -0,0 +1,74 @@
+import heapq
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from paplib import geo
+from paplib.models import Mountain
+from paplib.synthetic import JAPAN_LATITUDE, JAPAN_LONGITUDE, mountain_objects
+
+
+def brute_force(queryset, lat, lon, radius_km, limit):
+    """全ての山の距離を計算して近い順に limit 件の id を返す (比較用)"""
+    distances = (
+        (geo.haversine_km(lat, lon, mlat, mlon), pk)
+        for pk, mlat, mlon in (
+            queryset.exclude(latitude=None).exclude(longitude=None)
+            .values_list('pk', 'latitude', 'longitude').iterator(chunk_size=10000)
+        )
+    )
+    if radius_km is not None:
+        distances = (item for item in distances if item[0] <= radius_km)
+    return [pk for _, pk in heapq.nsmallest(limit, distances)]
+
+
+def grid(queryset, lat, lon, radius_km, limit):
+    return [m.pk for m in geo.nearby(queryset, lat, lon, radius_km, limit)]
+
+
+class Command(BaseCommand):
+    help = ('近くの山の検索を、全件の距離計算 (brute) と升目の索引 (grid) で比較します。'
+            '--mountains に複数の件数を渡すと件数ごとに測ります。データは最後にロールバックされます。')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mountains', type=int, nargs='+', default=[10000, 100000, 300000])
+        parser.add_argument('--queries', type=int, default=50)
+        parser.add_argument('--radius', type=float, default=30.0, help='半径検索の半径 (km)')
+        parser.add_argument('--limit', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, mountains, queries, radius, limit, seed, **options):
+        for count in mountains:
+            rng = random.Random(seed)
+            with transaction.atomic():
+                self.stdout.write(f'{count} 件の山を作成しています...')
+                Mountain.objects.bulk_create(mountain_objects(rng, count), batch_size=5000)
+                centers = [(rng.uniform(*JAPAN_LATITUDE), rng.uniform(*JAPAN_LONGITUDE)) for _ in range(queries)]
+                queryset = Mountain.objects.all()
+                for kind, radius_km in (('radius', radius), ('nearest', None)):
+                    answers = {}
+                    for label, search in (('brute', brute_force), ('grid', grid)):
+                        timings, answers[label] = self._measure(search, queryset, centers, radius_km, limit)
+                        self._write_row(f'{count:>7d} {kind}/{label}', timings)
+                    mismatches = sum(a != b for a, b in zip(answers['brute'], answers['grid']))
+                    if mismatches:
+                        self.stderr.write(f'結果が全件の計算と一致しない検索: {mismatches} 件')
+                transaction.set_rollback(True)
+
+    def _measure(self, search, queryset, centers, radius_km, limit):
+        timings, answers = [], []
+        for lat, lon in centers:
+            start = time.perf_counter()
+            answers.append(search(queryset, lat, lon, radius_km, limit))
+            timings.append((time.perf_counter() - start) * 1000)
+        return timings, answers
+
+    def _write_row(self, label, timings):
+        self.stdout.write(
+            f'{label:24s} mean {statistics.mean(timings):9.2f} ms  '
+            f'p50 {statistics.median(timings):9.2f} ms  '
+            f'p95 {statistics.quantiles(timings, n=20)[-1]:9.2f} ms'
+        )
@@ -0,0 +1,55 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from paplib.models import Mountain
+from paplib.search import index_mountains, search_mountains
+from paplib.synthetic import NAME_PARTS, SUFFIXES, mountain_objects
+
+
+class Command(BaseCommand):
+    help = '山の検索を name__icontains と n-gram 索引で比較します。データは最後にロールバックされます。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mountains', type=int, default=100000)
+        parser.add_argument('--queries', type=int, default=200)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, mountains, queries, seed, **options):
+        rng = random.Random(seed)
+        with transaction.atomic():
+            self.stdout.write(f'{mountains} 件の山を作成しています...')
+            objs = mountain_objects(rng, mountains)
+            created = Mountain.objects.bulk_create(objs, batch_size=5000)
+            index_mountains(created)
+
+            # 候補の多い部分一致と、絞り込まれる山名そのものを別々に測る
+            term_sets = {
+                'fragment': [rng.choice(NAME_PARTS)[0] + rng.choice(SUFFIXES)[0] for _ in range(queries)],
+                'name': [rng.choice(created).name for _ in range(queries)],
+            }
+            base = Mountain.objects.order_by('name')
+            results = {}
+            for kind, terms in term_sets.items():
+                results[f'icontains/{kind}'] = self._measure(terms, lambda q: base.filter(name__icontains=q))
+                results[f'ngram/{kind}'] = self._measure(terms, lambda q: search_mountains(q, base))
+            transaction.set_rollback(True)
+
+        for label, timings in results.items():
+            self.stdout.write(
+                f'{label:20s} mean {statistics.mean(timings):8.2f} ms  '
+                f'p50 {statistics.median(timings):8.2f} ms  '
+                f'p95 {statistics.quantiles(timings, n=20)[-1]:8.2f} ms'
+            )
+
+    def _measure(self, terms, search):
+        timings = []
+        for term in terms:
+            start = time.perf_counter()
+            # 1ページ目 (50件) を取得するまでの時間
+            list(search(term)[:50])
+            timings.append((time.perf_counter() - start) * 1000)
+        return timings
@@ -0,0 +1,169 @@
+import datetime
+import random
+import statistics
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+
+import django
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, close_old_connections, connections, transaction
+
+from paplib.aggregates import refresh_mountain_stats
+from paplib.models import ClimbRecord, Mountain
+
+# 負荷の種類ごとの書き込みの割合
+WORKLOADS = {'read': 0.0, 'write': 1.0, 'mixed': 0.2}
+
+
+def _configure(config):
+    """このプロセスの default 接続をベンチマーク用の設定に差し替える"""
+    connections.close_all()
+    current = connections.settings['default']
+    current.clear()
+    current.update(config)
+    # 古い設定で作られた接続オブジェクトを捨てる
+    if hasattr(connections._connections, 'default'):
+        del connections['default']
+
+
+def _init_process(config):
+    django.setup()
+    _configure(config)
+
+
+def _read(rng, user_ids, mountain_ids):
+    # 山の詳細ページの1ページ目と同じ問い合わせ
+    records = (
+        ClimbRecord.objects.filter(mountain_id=rng.choice(mountain_ids))
+        .select_related('user').order_by('-climb_date', '-id')
+    )
+    list(records[:10])
+
+
+def _write(rng, user_ids, mountain_ids):
+    # 記録と山の集計値の更新をひとつのトランザクションで行う
+    with transaction.atomic():
+        ClimbRecord.objects.create(
+            user_id=rng.choice(user_ids),
+            mountain_id=rng.choice(mountain_ids),
+            climb_date=datetime.date(2024, 1, 1) + datetime.timedelta(days=rng.randrange(365)),
+            comment='bench',
+        )
+
+
+def _run(workload, start_at, duration, seed, user_ids, mountain_ids):
+    rng = random.Random(seed)
+    write_ratio = WORKLOADS[workload]
+    time.sleep(max(0.0, start_at - time.time()))
+    end = start_at + duration
+    latencies, errors = [], 0
+    while time.time() < end:
+        operation = _write if rng.random() < write_ratio else _read
+        start = time.perf_counter()
+        try:
+            operation(rng, user_ids, mountain_ids)
+        except OperationalError:
+            # "database is locked" など
+            errors += 1
+        else:
+            latencies.append((time.perf_counter() - start) * 1000)
+        finally:
+            # リクエストの終わりと同じく、CONN_MAX_AGE に従って接続を閉じる
+            close_old_connections()
+    connections.close_all()
+    return latencies, errors
+
+
+class Command(BaseCommand):
+    help = ('SQLite の設定 (SQLITE_PROFILES) ごとに、複数スレッド・複数プロセスでの'
+            '読み込み・書き込みのスループットを測ります。一時ファイルのDBを使うので既存のデータは変わりません。')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profiles', nargs='+', default=list(settings.SQLITE_PROFILES))
+        parser.add_argument('--modes', nargs='+', choices=['thread', 'process'], default=['thread', 'process'])
+        parser.add_argument('--workloads', nargs='+', choices=list(WORKLOADS), default=list(WORKLOADS))
+        parser.add_argument('--workers', type=int, default=8)
+        parser.add_argument('--duration', type=float, default=5.0, help='1回の計測時間 (秒)')
+        parser.add_argument('--mountains', type=int, default=200)
+        parser.add_argument('--records', type=int, default=20000)
+
+    def handle(self, *args, profiles, modes, workloads, workers, duration, mountains, records, **options):
+        unknown = set(profiles) - set(settings.SQLITE_PROFILES)
+        if unknown:
+            raise CommandError(f'不明なプロファイル: {", ".join(sorted(unknown))}')
+        if connections.settings['default']['ENGINE'] != 'django.db.backends.sqlite3':
+            raise CommandError('SQLite 以外のデータベースでは実行できません。')
+
+        original = dict(connections.settings['default'])
+        rows = []
+        try:
+            for profile in profiles:
+                with tempfile.TemporaryDirectory() as tmp:
+                    config = {
+                        **original, 'CONN_MAX_AGE': 0, 'CONN_HEALTH_CHECKS': False, 'OPTIONS': {},
+                        **settings.SQLITE_PROFILES[profile], 'NAME': str(Path(tmp) / 'bench.sqlite3'),
+                    }
+                    _configure(config)
+                    self.stdout.write(f'[{profile}] テストデータを作成しています...')
+                    user_ids, mountain_ids = self._seed(mountains, records)
+                    connections.close_all()
+
+                    for mode in modes:
+                        for workload in workloads:
+                            latencies, errors = self._measure(
+                                config, mode, workload, workers, duration, user_ids, mountain_ids,
+                            )
+                            rows.append((profile, mode, workload, latencies, errors))
+                    connections.close_all()
+        finally:
+            _configure(original)
+
+        self.stdout.write(f'\n{workers} 並列, 各 {duration:g} 秒')
+        for profile, mode, workload, latencies, errors in rows:
+            p95 = statistics.quantiles(latencies, n=20)[-1] if len(latencies) > 1 else 0.0
+            self.stdout.write(
+                f'{profile:8s} {mode:8s} {workload:6s} '
+                f'{len(latencies) / duration:9.1f} ops/s  p95 {p95:8.2f} ms  エラー {errors}'
+            )
+
+    def _seed(self, mountains, records):
+        call_command('migrate', verbosity=0)
+        rng = random.Random(0)
+        users = User.objects.bulk_create([User(username=f'bench{i}') for i in range(20)])
+        created = Mountain.objects.bulk_create([
+            Mountain(name=f'山{i}', prefecture='長野県', elevation=rng.randint(100, 3776))
+            for i in range(mountains)
+        ])
+        ClimbRecord.objects.bulk_create([
+            ClimbRecord(
+                user=rng.choice(users), mountain=rng.choice(created),
+                climb_date=datetime.date(2020, 1, 1) + datetime.timedelta(days=rng.randrange(1500)),
+            )
+            for _ in range(records)
+        ], batch_size=2000)
+        refresh_mountain_stats()
+        return [u.pk for u in users], [m.pk for m in created]
+
+    def _measure(self, config, mode, workload, workers, duration, user_ids, mountain_ids):
+        if mode == 'thread':
+            pool = ThreadPoolExecutor(max_workers=workers)
+        else:
+            pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_process, initargs=(config,))
+        with pool:
+            # プロセスの起動時間を計測に含めないよう、少し先の時刻に一斉に始める
+            start_at = time.time() + (0.5 if mode == 'thread' else 3.0)
+            futures = [
+                pool.submit(_run, workload, start_at, duration, seed, user_ids, mountain_ids)
+                for seed in range(workers)
+            ]
+            latencies, errors = [], 0
+            for future in futures:
+                worker_latencies, worker_errors = future.result()
+                latencies.extend(worker_latencies)
+                errors += worker_errors
+        return latencies, errors
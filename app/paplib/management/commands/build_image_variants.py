@@ -0,0 +1,48 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from paplib.images import generate_variants
+from paplib.models import ClimbRecord
+
+
+def _build(name, force):
+    return name, generate_variants(name, force=force)
+
+
+class Command(BaseCommand):
+    help = ('既存の登山記録の写真から縮小画像 (thumb / medium) を作成します。'
+            '作成済みの写真も含め、縮小画像のある記録は縮小画像の URL を出すようになります。')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None, help='プロセス数 (省略時はCPU数)')
+        parser.add_argument('--force', action='store_true', help='作成済みの縮小画像も作り直す')
+
+    def handle(self, *args, workers, force, **options):
+        names = list(
+            ClimbRecord.objects.exclude(image='').exclude(image__isnull=True)
+            .values_list('image', flat=True).distinct()
+        )
+        # 子プロセスにDB接続を引き継がない
+        connections.close_all()
+
+        created = failed = 0
+        with ProcessPoolExecutor(max_workers=workers, initializer=django.setup) as pool:
+            futures = [pool.submit(_build, name, force) for name in names]
+            for future in as_completed(futures):
+                try:
+                    name, files = future.result()
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write(f'失敗: {e}')
+                    continue
+                created += len(files)
+                ClimbRecord.mark_variants_ready(name)
+                if files:
+                    self.stdout.write(f'{name}: {len(files)} 件作成')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'{len(names)} 枚の写真を処理しました (作成 {created} 件, 失敗 {failed} 件)'
+        ))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from paplib import cache
+
+
+class Command(BaseCommand):
+    help = ('山の一覧・API キャッシュのヒット数とミス数を表示します。'
+            ' (locmem はプロセスごとに別なので、file / db バックエンドで使ってください)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='表示後にカウンタを0に戻す')
+
+    def handle(self, *args, reset, **options):
+        stats = cache.stats()
+        self.stdout.write(f"ヒット: {stats['hits']}  ミス: {stats['misses']}  ヒット率: {stats['hit_rate']:.1%}")
+        if reset:
+            cache.reset_stats()
+            self.stdout.write('カウンタをリセットしました。')
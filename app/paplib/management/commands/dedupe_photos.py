@@ -0,0 +1,90 @@
+import posixpath
+
+from django.core.files import File
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from paplib import blobs, cache
+from paplib.images import generate_variants
+from paplib.models import ClimbRecord, Mountain
+from paplib.storage import content_hash, immutable_key, photo_storage
+
+
+class Command(BaseCommand):
+    help = ('登山記録の写真を内容のハッシュの名前に移し、同じ写真を1つのファイルにまとめます。'
+            '最後に写真の参照数を数え直します。')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='移さずに、まとめられる件数とサイズだけを表示する')
+        parser.add_argument('--delete-orphans', action='store_true',
+                            help='どの記録からも使われていない photos/ 以下のファイルも消す')
+
+    def handle(self, *args, dry_run, delete_orphans, **options):
+        storage = photo_storage()
+        names = set(
+            ClimbRecord.objects.exclude(image='').exclude(image__isnull=True)
+            .values_list('image', flat=True).distinct()
+        )
+
+        # 古い名前 -> ハッシュの名前 (--dry-run ではハッシュだけ)
+        renamed, sizes, missing = {}, {}, 0
+        for name in sorted(names):
+            if immutable_key(name):
+                continue
+            if not storage.exists(name):
+                missing += 1
+                self.stderr.write(f'見つかりません: {name}')
+                continue
+            with storage.open(name, 'rb') as f:
+                content = File(f, posixpath.basename(name))
+                renamed[name] = content_hash(content) if dry_run else storage.save(name, content)
+            sizes[renamed[name]] = sizes[name] = storage.size(name)
+        saved = sum(sizes[name] for name in renamed) - sum(sizes[name] for name in set(renamed.values()))
+
+        if dry_run:
+            self.stdout.write(
+                f'{len(renamed)} 枚の写真は {len(set(renamed.values()))} 個のファイルにまとめられ、'
+                f'{saved:,} バイト減らせます (見つからない写真 {missing} 枚)'
+            )
+            return
+
+        now = timezone.now()
+        mountain_ids = set()
+        with transaction.atomic():
+            for old, new in renamed.items():
+                # 差分同期 (paplib.sync) で新しい URL が伝わるよう更新日時も進める
+                ClimbRecord.objects.filter(image=old).update(image=new, image_variants_ready=False, updated_at=now)
+                mountains = Mountain.objects.filter(latest_photo=old)
+                mountain_ids |= set(mountains.values_list('pk', flat=True))
+                mountains.update(latest_photo=new, updated_at=now)
+            count = blobs.rebuild()
+        for mountain_id in mountain_ids:
+            cache.invalidate_mountain(mountain_id)
+
+        for old, new in renamed.items():
+            blobs.delete_files(old, storage)
+            generate_variants(new, storage=storage)
+            ClimbRecord.mark_variants_ready(new)
+
+        orphans = 0
+        if delete_orphans:
+            used = set(ClimbRecord.objects.exclude(image='').exclude(image__isnull=True)
+                       .values_list('image', flat=True))
+            for name in _walk(storage, 'photos'):
+                if posixpath.basename(posixpath.dirname(name)) != 'variants' and name not in used:
+                    blobs.delete_files(name, storage)
+                    orphans += 1
+
+        self.stdout.write(self.style.SUCCESS(
+            f'{len(renamed)} 枚の写真を {len(set(renamed.values()))} 個のファイルに移し、{saved:,} バイト減らしました'
+            f' (見つからない写真 {missing} 枚, 消した未使用のファイル {orphans} 個, 参照数 {count} 件)'
+        ))
+
+
+def _walk(storage, directory):
+    directories, files = storage.listdir(directory)
+    for name in files:
+        yield posixpath.join(directory, name)
+    for name in directories:
+        yield from _walk(storage, posixpath.join(directory, name))
@@ -0,0 +1,33 @@
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from paplib import uploads
+from paplib.models import PhotoUpload
+
+
+class Command(BaseCommand):
+    help = ('タスクが失敗するなどして処理中のまま残った写真のアップロードを処理し、'
+            '期限切れのアップロードと一時ファイルを消します。')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stale-minutes', type=int, default=10,
+                            help='処理中のままこの分数が経ったものを処理し直す')
+        parser.add_argument('--hours', type=int, default=settings.PHOTO_UPLOAD_EXPIRE_HOURS,
+                            help='この時間より古いアップロードを消す (既定は PHOTO_UPLOAD_EXPIRE_HOURS)')
+
+    def handle(self, *args, stale_minutes, hours, **options):
+        stale = PhotoUpload.objects.filter(
+            status=PhotoUpload.PROCESSING,
+            updated_at__lt=timezone.now() - datetime.timedelta(minutes=stale_minutes),
+        ).values_list('pk', flat=True)
+        processed = 0
+        for upload_id in list(stale):
+            uploads.process(upload_id)
+            processed += 1
+        pruned = uploads.prune(hours)
+        self.stdout.write(self.style.SUCCESS(
+            f'{processed} 件の写真を処理し、{hours} 時間より古いアップロードを {pruned} 件消しました'
+        ))
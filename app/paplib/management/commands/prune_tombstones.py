@@ -0,0 +1,17 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from paplib.sync import prune_tombstones
+
+
+class Command(BaseCommand):
+    help = ('差分同期用の削除の記録 (Tombstone) のうち、古いものを消します。'
+            'これより古いカーソルを持つクライアントは最初から同期し直すことになります。')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.SYNC_TOMBSTONE_DAYS,
+                            help='残す日数 (既定は SYNC_TOMBSTONE_DAYS)')
+
+    def handle(self, *args, days, **options):
+        deleted = prune_tombstones(days)
+        self.stdout.write(self.style.SUCCESS(f'{days} 日より古い削除の記録を {deleted} 件消しました'))
@@ -0,0 +1,20 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from paplib.leaderboards import rebuild
+
+
+class Command(BaseCommand):
+    help = 'ランキング (LeaderboardEntry) を登山記録から作り直します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', dest='user_ids', type=int, nargs='*', help='対象のユーザーID (省略時はすべて)')
+        parser.add_argument('--batch-size', type=int, default=500, help='1回にまとめて集計するユーザー数')
+
+    def handle(self, *args, user_ids, batch_size, **options):
+        started = time.perf_counter()
+        created = rebuild(user_ids or None, batch_size=batch_size)
+        self.stdout.write(self.style.SUCCESS(
+            f'ランキングの行を {created} 件作成しました ({time.perf_counter() - started:.1f} 秒)'
+        ))
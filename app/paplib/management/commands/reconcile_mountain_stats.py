@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from paplib.aggregates import refresh_mountain_stats
+from paplib.models import Mountain
+
+
+class Command(BaseCommand):
+    help = '山ごとの集計値 (記録数・登山者数・最終登山日・最新の写真) を登山記録から計算し直します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--id', dest='mountain_ids', type=int, nargs='*', help='対象の山のID (省略時はすべて)')
+
+    def handle(self, *args, mountain_ids, **options):
+        mountains = Mountain.objects.all()
+        if mountain_ids:
+            mountains = mountains.filter(pk__in=mountain_ids)
+        stale = refresh_mountain_stats(mountains)
+        for pk in stale:
+            self.stdout.write(f'修正: 山 ID {pk}')
+        self.stdout.write(self.style.SUCCESS(f'{len(stale)} 件の山の集計値を修正しました。'))
@@ -0,0 +1,111 @@
+import multiprocessing
+import os
+import signal
+import socket
+import statistics
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+
+from paplib import tasks
+
+
+def _run_in_thread(task_id, token):
+    try:
+        return tasks.execute(task_id, token)
+    finally:
+        # スレッドごとの DB 接続を残さない
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = ('DB のタスクキュー (paplib.tasks) からタスクを取り出して、スレッドまたはプロセスのプールで実行します。'
+            '処理件数・1秒あたりの件数・待ち時間・実行時間を定期的に表示します。')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=4, help='同時に実行するタスクの数')
+        parser.add_argument('--pool', choices=['thread', 'process'], default='thread',
+                            help='thread は I/O 待ちの多いタスク、process は画像処理など CPU を使うタスク向け')
+        parser.add_argument('--poll-interval', type=float, default=1.0, help='キューが空のときに待つ秒数')
+        parser.add_argument('--stats-interval', type=float, default=30.0, help='処理状況を表示する間隔 (秒)')
+        parser.add_argument('--burst', action='store_true', help='キューが空になったら終わる')
+
+    def handle(self, *args, concurrency, pool, poll_interval, stats_interval, burst, **options):
+        if concurrency < 1:
+            raise CommandError('--concurrency は1以上にしてください。')
+        worker = f'{socket.gethostname()}:{os.getpid()}'
+        if pool == 'process':
+            # 子プロセスに DB 接続を引き継がない (fork でなく spawn で起動し、django.setup() からやり直す)
+            connections.close_all()
+            executor = ProcessPoolExecutor(concurrency, mp_context=multiprocessing.get_context('spawn'),
+                                           initializer=django.setup)
+            run = tasks.execute
+        else:
+            executor = ThreadPoolExecutor(concurrency, thread_name_prefix='task')
+            run = _run_in_thread
+
+        self.stopping = False
+        signal.signal(signal.SIGTERM, self._stop)
+        self.stdout.write(f'ワーカー {worker} を開始しました ({pool} × {concurrency})')
+        self._reset_stats()
+        started = last_report = time.monotonic()
+        running = set()
+        try:
+            while not self.stopping:
+                free = concurrency - len(running)
+                claimed = tasks.claim(worker, free) if free else []
+                running |= {executor.submit(run, t.pk, token) for t, token in claimed}
+                if not running:
+                    if burst:
+                        break
+                    time.sleep(poll_interval)
+                else:
+                    done, running = wait(running, timeout=poll_interval, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self._record(future)
+                if time.monotonic() - last_report >= stats_interval:
+                    self._report(time.monotonic() - last_report)
+                    self._reset_stats()
+                    last_report = time.monotonic()
+        except KeyboardInterrupt:
+            self.stdout.write('止めています。実行中のタスクが終わるのを待ちます...')
+        finally:
+            for future in wait(running).done:
+                self._record(future)
+            executor.shutdown()
+            self._report(time.monotonic() - last_report)
+            self.stdout.write(f'ワーカー {worker} を終了しました ({time.monotonic() - started:.1f} 秒)')
+
+    def _stop(self, signum, frame):
+        self.stopping = True
+
+    def _reset_stats(self):
+        self.counts = {'done': 0, 'retry': 0, 'failed': 0, 'lost': 0}
+        self.waits, self.durations = [], []
+
+    def _record(self, future):
+        try:
+            outcome, waited, duration = future.result()
+        except Exception as e:
+            # プロセスが落ちたなど。タスクは期限が切れたら別のワーカーが実行し直す
+            self.stderr.write(f'タスクを実行できませんでした: {e!r}')
+            self.counts['lost'] += 1
+            return
+        self.counts[outcome] += 1
+        self.waits.append(waited)
+        self.durations.append(duration * 1000)
+        if outcome == 'failed':
+            self.stderr.write('タスクが失敗しました (Task.last_error を確認してください)')
+
+    def _report(self, elapsed):
+        processed = sum(self.counts.values())
+        line = (f'{processed} 件 ({processed / elapsed if elapsed else 0:.1f} 件/秒): '
+                f'成功 {self.counts["done"]}, 再試行 {self.counts["retry"]}, 失敗 {self.counts["failed"]}')
+        if self.durations:
+            p95 = statistics.quantiles(self.durations, n=20)[-1] if len(self.durations) > 1 else self.durations[0]
+            line += (f'  実行時間 p50 {statistics.median(self.durations):.1f} ms / p95 {p95:.1f} ms'
+                     f'  待ち時間 p50 {statistics.median(self.waits):.2f} 秒')
+        self.stdout.write(f'{line}  残り {tasks.pending()} 件')
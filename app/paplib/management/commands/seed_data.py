@@ -0,0 +1,111 @@
+import datetime
+import random
+import time
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from paplib import blobs, cache, leaderboards
+from paplib.aggregates import refresh_mountain_stats
+from paplib.bulk import chunked
+from paplib.images import generate_variants
+from paplib.models import ClimbRecord, Mountain
+from paplib.search import index_mountains
+from paplib.storage import photo_storage
+from paplib.synthetic import COMMENTS, mountain_objects, photo_bytes, popularity
+
+# 作成するユーザー名は seed_00001 のようになる
+USERNAME_PREFIX = 'seed_'
+# 登山日は LAST_DATE までの10年に散らばらせる (実行日によってデータが変わらないよう固定)
+LAST_DATE = datetime.date(2025, 12, 31)
+DATE_RANGE_DAYS = 3650
+
+
+class Command(BaseCommand):
+    help = ('性能測定用の合成データ (山・ユーザー・登山記録・写真) を作成します。'
+            '同じ --seed と件数なら同じデータになります。')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mountains', type=int, default=1000)
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--records', type=int, default=1000000)
+        parser.add_argument('--photos', type=int, default=0, help='作成する写真の枚数 (記録で使い回す)')
+        parser.add_argument('--photo-ratio', type=float, default=0.1, help='写真付きにする記録の割合')
+        parser.add_argument('--skew', type=float, default=1.1, help='山とユーザーの人気の偏り (Zipf 分布の指数)')
+        parser.add_argument('--password', default='password', help='作成するユーザーのパスワード')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--flush', action='store_true', help='作成前にDBの全データを消す')
+
+    def handle(self, *args, mountains, users, records, photos, photo_ratio, skew, password,
+               batch_size, seed, flush, **options):
+        if flush:
+            call_command('flush', interactive=False, verbosity=0)
+        rng = random.Random(seed)
+        started = time.perf_counter()
+
+        self.stdout.write(f'ユーザー {users} 人を作成しています...')
+        # ハッシュ化は遅いので全員同じパスワードのハッシュを使う
+        password_hash = make_password(password)
+        user_objs = User.objects.bulk_create([
+            User(username=f'{USERNAME_PREFIX}{i:05d}', password=password_hash) for i in range(1, users + 1)
+        ], batch_size=batch_size)
+
+        self.stdout.write(f'山 {mountains} 件を作成しています...')
+        mountain_objs = Mountain.objects.bulk_create(mountain_objects(rng, mountains), batch_size=batch_size)
+        for chunk in chunked(mountain_objs, batch_size):
+            index_mountains(chunk)
+
+        photo_names = [self._create_photo(rng, i) for i in range(photos)]
+        if photo_names:
+            self.stdout.write(f'写真 {len(photo_names)} 枚を作成しました')
+
+        self.stdout.write(f'登山記録 {records} 件を作成しています...')
+        user_ids, user_weights = popularity(rng, [u.pk for u in user_objs], skew)
+        mountain_ids, mountain_weights = popularity(rng, [m.pk for m in mountain_objs], skew)
+        created = 0
+        while created < records:
+            size = min(batch_size, records - created)
+            picked_users = rng.choices(user_ids, cum_weights=user_weights, k=size)
+            picked_mountains = rng.choices(mountain_ids, cum_weights=mountain_weights, k=size)
+            batch = [
+                ClimbRecord(
+                    user_id=user_id,
+                    mountain_id=mountain_id,
+                    climb_date=LAST_DATE - datetime.timedelta(days=rng.randrange(DATE_RANGE_DAYS)),
+                    comment=rng.choice(COMMENTS),
+                    image=rng.choice(photo_names) if photo_names and rng.random() < photo_ratio else '',
+                )
+                for user_id, mountain_id in zip(picked_users, picked_mountains)
+            ]
+            # 縮小画像は写真を作るときに作ってある
+            for record in batch:
+                record.image_variants_ready = bool(record.image)
+            with transaction.atomic():
+                ClimbRecord.objects.bulk_create(batch)
+            created += size
+            if created % (batch_size * 20) == 0 or created == records:
+                self.stdout.write(f'  {created} / {records}')
+
+        # bulk_create ではシグナルが送られないので、集計値はまとめて計算する
+        self.stdout.write('山の集計値を計算しています...')
+        refresh_mountain_stats()
+        self.stdout.write('ランキングを作成しています...')
+        leaderboards.rebuild()
+        blobs.rebuild()
+        # 作り直したデータが古いキャッシュに隠れないようにする
+        cache.get_cache().clear()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'作成しました: 山 {mountains} 件, ユーザー {users} 人, 記録 {records} 件, 写真 {len(photo_names)} 枚 '
+            f'({time.perf_counter() - started:.1f} 秒)'
+        ))
+
+    def _create_photo(self, rng, index):
+        name = photo_storage().save(f'photos/seed_{index:04d}.jpg', ContentFile(photo_bytes(rng)))
+        generate_variants(name)
+        return name
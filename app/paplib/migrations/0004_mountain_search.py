@@ -0,0 +1,46 @@
+# Generated by Django 5.2.5 on 2026-10-18 06:22
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def build_index(apps, schema_editor):
+    from paplib.search import index_grams
+
+    Mountain = apps.get_model('paplib', 'Mountain')
+    MountainSearchToken = apps.get_model('paplib', 'MountainSearchToken')
+    tokens = [
+        MountainSearchToken(mountain_id=m.pk, field=field, gram=gram)
+        for m in Mountain.objects.all()
+        for field, text in (('n', m.name), ('k', m.name_kana), ('p', m.prefecture))
+        for gram in index_grams(text)
+    ]
+    MountainSearchToken.objects.bulk_create(tokens, batch_size=5000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('paplib', '0003_climbrecord_image'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mountain',
+            name='name_kana',
+            field=models.CharField(blank=True, help_text='ひらがな・カタカナで入力すると読みでも検索できます', max_length=100, verbose_name='読み'),
+        ),
+        migrations.CreateModel(
+            name='MountainSearchToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('field', models.CharField(choices=[('n', '山名'), ('k', '読み'), ('p', '都道府県')], max_length=1)),
+                ('gram', models.CharField(max_length=2)),
+                ('mountain', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_tokens', to='paplib.mountain')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['gram', 'mountain', 'field'], name='paplib_search_gram_idx')],
+            },
+        ),
+        migrations.RunPython(build_index, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.2.5 on 2026-10-18 06:34
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def compute_stats(apps, schema_editor):
+    Mountain = apps.get_model('paplib', 'Mountain')
+    ClimbRecord = apps.get_model('paplib', 'ClimbRecord')
+    records = ClimbRecord.objects.filter(mountain=OuterRef('pk')).order_by()
+    photos = records.exclude(image='').exclude(image__isnull=True).order_by('-climb_date', '-pk')
+    Mountain.objects.update(
+        record_count=Coalesce(Subquery(records.values('mountain').annotate(c=Count('pk')).values('c')), 0),
+        climber_count=Coalesce(
+            Subquery(records.values('mountain').annotate(c=Count('user', distinct=True)).values('c')), 0),
+        last_climbed_on=Subquery(records.order_by('-climb_date').values('climb_date')[:1]),
+        latest_photo=Coalesce(Subquery(photos.values('image')[:1]), Value(''), output_field=models.CharField()),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('paplib', '0004_mountain_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mountain',
+            name='climber_count',
+            field=models.IntegerField(default=0, editable=False, verbose_name='登山者数'),
+        ),
+        migrations.AddField(
+            model_name='mountain',
+            name='last_climbed_on',
+            field=models.DateField(blank=True, editable=False, null=True, verbose_name='最終登山日'),
+        ),
+        migrations.AddField(
+            model_name='mountain',
+            name='latest_photo',
+            field=models.ImageField(blank=True, editable=False, upload_to='', verbose_name='最新の写真'),
+        ),
+        migrations.AddField(
+            model_name='mountain',
+            name='record_count',
+            field=models.IntegerField(default=0, editable=False, verbose_name='登山記録数'),
+        ),
+        migrations.RunPython(compute_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-18 06:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('paplib', '0005_mountain_aggregates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mountain',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, verbose_name='更新日'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.5 on 2026-10-18 06:48
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('paplib', '0006_mountain_updated_at'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='climbrecord',
+            name='mountain',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='paplib.mountain', verbose_name='山'),
+        ),
+        migrations.AlterField(
+            model_name='climbrecord',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='ユーザー'),
+        ),
+        migrations.AddIndex(
+            model_name='climbrecord',
+            index=models.Index(fields=['mountain', '-climb_date', '-id'], name='paplib_rec_mountain_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='climbrecord',
+            index=models.Index(fields=['user', '-climb_date', '-id'], name='paplib_rec_user_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='climbrecord',
+            index=models.Index(fields=['-climb_date', '-id'], name='paplib_rec_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='climbrecord',
+            index=models.Index(fields=['updated_at', 'id'], name='paplib_rec_updated_idx'),
+        ),
+    ]
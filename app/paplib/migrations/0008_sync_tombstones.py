@@ -0,0 +1,31 @@
+# Generated by Django 5.2.5 on 2026-10-18 07:08
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('paplib', '0007_climbrecord_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Tombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('r', '登山記録'), ('m', '山')], max_length=1)),
+                ('object_id', models.BigIntegerField()),
+                ('deleted_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='削除日')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='mountain',
+            index=models.Index(fields=['updated_at', 'id'], name='paplib_mountain_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tombstone',
+            index=models.Index(fields=['deleted_at', 'id'], name='paplib_tombstone_deleted_idx'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.5 on 2026-10-18 07:15
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('paplib', '0008_sync_tombstones'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LeaderboardEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scope', models.CharField(max_length=60)),
+                ('year', models.IntegerField(default=0)),
+                ('climbs', models.IntegerField(verbose_name='登山回数')),
+                ('peaks', models.IntegerField(verbose_name='登った山の数')),
+                ('elevation', models.IntegerField(verbose_name='標高の合計')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['scope', 'year', '-climbs', 'user'], name='paplib_lb_climbs_idx'), models.Index(fields=['scope', 'year', '-peaks', 'user'], name='paplib_lb_peaks_idx'), models.Index(fields=['scope', 'year', '-elevation', 'user'], name='paplib_lb_elevation_idx')],
+                'constraints': [models.UniqueConstraint(fields=('scope', 'year', 'user'), name='paplib_leaderboard_unique')],
+            },
+        ),
+    ]
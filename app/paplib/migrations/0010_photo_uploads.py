@@ -0,0 +1,36 @@
+# Generated by Django 5.2.5 on 2026-10-18 07:25
+
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('paplib', '0009_leaderboards'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PhotoUpload',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('filename', models.CharField(max_length=255, verbose_name='ファイル名')),
+                ('size', models.BigIntegerField(verbose_name='サイズ')),
+                ('sha256', models.CharField(max_length=64, verbose_name='SHA-256')),
+                ('offset', models.BigIntegerField(default=0, verbose_name='受信済み')),
+                ('status', models.CharField(choices=[('uploading', '送信中'), ('processing', '処理中'), ('done', '完了'), ('failed', '失敗')], default='uploading', max_length=10)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='作成日')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新日')),
+                ('record', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='uploads', to='paplib.climbrecord')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'updated_at'], name='paplib_upload_status_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.5 on 2026-10-18 07:31
+
+import paplib.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('paplib', '0010_photo_uploads'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PhotoBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('refs', models.IntegerField(default=0, verbose_name='参照数')),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='climbrecord',
+            name='image',
+            field=models.ImageField(blank=True, null=True, storage=paplib.storage.photo_storage, upload_to='photos/', verbose_name='写真'),
+        ),
+        migrations.AlterField(
+            model_name='mountain',
+            name='latest_photo',
+            field=models.ImageField(blank=True, editable=False, storage=paplib.storage.photo_storage, upload_to='', verbose_name='最新の写真'),
+        ),
+    ]
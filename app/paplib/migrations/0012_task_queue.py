@@ -0,0 +1,33 @@
+# Generated by Django 5.2.5 on 2026-10-18 07:38
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('paplib', '0011_photo_blobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Task',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=200, verbose_name='関数')),
+                ('kwargs', models.JSONField(default=dict, verbose_name='引数')),
+                ('status', models.CharField(choices=[('queued', '待機中'), ('running', '実行中'), ('failed', '失敗')], default='queued', max_length=10)),
+                ('attempts', models.IntegerField(default=0, verbose_name='実行回数')),
+                ('max_attempts', models.IntegerField(default=3, verbose_name='最大実行回数')),
+                ('run_after', models.DateTimeField(default=django.utils.timezone.now, verbose_name='実行予定')),
+                ('locked_by', models.CharField(blank=True, max_length=100, verbose_name='ワーカー')),
+                ('locked_until', models.DateTimeField(blank=True, null=True, verbose_name='実行期限')),
+                ('last_error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='作成日')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'run_after', 'id'], name='paplib_task_ready_idx'), models.Index(fields=['status', 'locked_until'], name='paplib_task_locked_idx'), models.Index(fields=['locked_by'], name='paplib_task_locked_by_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.5 on 2026-10-18 07:49
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('paplib', '0012_task_queue'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='climbrecord',
+            index=models.Index(fields=['mountain', 'updated_at'], name='paplib_rec_mountain_upd_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='climbrecord',
+            index=models.Index(fields=['user', 'updated_at'], name='paplib_rec_user_upd_idx'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.5 on 2026-10-18 07:59
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('paplib', '0013_record_version_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mountain',
+            name='geo_cell',
+            field=models.IntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='mountain',
+            name='latitude',
+            field=models.FloatField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(-90), django.core.validators.MaxValueValidator(90)], verbose_name='緯度'),
+        ),
+        migrations.AddField(
+            model_name='mountain',
+            name='longitude',
+            field=models.FloatField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(-180), django.core.validators.MaxValueValidator(180)], verbose_name='経度'),
+        ),
+        migrations.AddIndex(
+            model_name='mountain',
+            index=models.Index(fields=['geo_cell', 'latitude', 'longitude'], name='paplib_mountain_geo_idx'),
+        ),
+    ]
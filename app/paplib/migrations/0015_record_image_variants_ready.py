@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-18 08:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('paplib', '0014_mountain_location'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='climbrecord',
+            name='image_variants_ready',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+    ]
@@ -1,25 +1,286 @@
+import uuid
+
+from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
+from .geo import cell_of
+from .images import variant_url
+from .storage import photo_storage
 
 # Create your models here.
 
 class Mountain(models.Model):
     name = models.CharField('山名', max_length=100)
+    name_kana = models.CharField('読み', max_length=100, blank=True, help_text='ひらがな・カタカナで入力すると読みでも検索できます')
     prefecture = models.CharField('都道府県', max_length=50)
     elevation = models.IntegerField('標高')
+    latitude = models.FloatField('緯度', blank=True, null=True,
+                                 validators=[MinValueValidator(-90), MaxValueValidator(90)])
+    longitude = models.FloatField('経度', blank=True, null=True,
+                                  validators=[MinValueValidator(-180), MaxValueValidator(180)])
+    # 位置で検索するための升目の番号 (paplib.geo)。save() が緯度・経度から計算する
+    geo_cell = models.IntegerField(blank=True, null=True, editable=False)
+
+    # 登山記録からの集計値。paplib.aggregates が記録の保存・削除のたびに差分で更新する
+    record_count = models.IntegerField('登山記録数', default=0, editable=False)
+    climber_count = models.IntegerField('登山者数', default=0, editable=False)
+    last_climbed_on = models.DateField('最終登山日', blank=True, null=True, editable=False)
+    latest_photo = models.ImageField('最新の写真', blank=True, editable=False, storage=photo_storage)
+    # 集計値の更新でも変わる (ETag / 差分同期に使う)
+    updated_at = models.DateTimeField('更新日', auto_now=True)
+
+    AGGREGATE_FIELDS = ('record_count', 'climber_count', 'last_climbed_on', 'latest_photo')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['updated_at', 'id'], name='paplib_mountain_updated_idx'),
+            # 升目の範囲から候補の緯度・経度までを索引だけで読む (paplib.geo)
+            models.Index(fields=['geo_cell', 'latitude', 'longitude'], name='paplib_mountain_geo_idx'),
+        ]
 
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        self.geo_cell = cell_of(self.latitude, self.longitude)
+        update_fields = kwargs.get('update_fields')
+        # 編集フォームが読み込んだ古い集計値で上書きしないよう、集計値は書き戻さない
+        if not self._state.adding and update_fields is None:
+            kwargs['update_fields'] = [
+                f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.name not in self.AGGREGATE_FIELDS
+            ]
+        elif update_fields is not None and {'latitude', 'longitude'} & set(update_fields):
+            kwargs['update_fields'] = [*update_fields, 'geo_cell']
+        super().save(*args, **kwargs)
+
+
+class MountainSearchToken(models.Model):
+    """山の検索用 n-gram 索引。paplib.search が Mountain の保存時に更新する。"""
+    NAME = 'n'
+    KANA = 'k'
+    PREFECTURE = 'p'
+    FIELD_CHOICES = [
+        (NAME, '山名'),
+        (KANA, '読み'),
+        (PREFECTURE, '都道府県'),
+    ]
+
+    mountain = models.ForeignKey(Mountain, on_delete=models.CASCADE, related_name='search_tokens')
+    field = models.CharField(max_length=1, choices=FIELD_CHOICES)
+    gram = models.CharField(max_length=2)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['gram', 'mountain', 'field'], name='paplib_search_gram_idx'),
+        ]
+
 
 class ClimbRecord(models.Model):
-    user = models.ForeignKey(User, on_delete=models.CASCADE, verbose_name='ユーザー')
-    mountain = models.ForeignKey(Mountain, on_delete=models.CASCADE, verbose_name='山')
+    # 単独の索引は Meta.indexes の複合索引の先頭列で足りるので作らない
+    user = models.ForeignKey(User, on_delete=models.CASCADE, verbose_name='ユーザー', db_index=False)
+    mountain = models.ForeignKey(Mountain, on_delete=models.CASCADE, verbose_name='山', db_index=False)
     climb_date = models.DateField('登った日')
     comment = models.TextField('感想・コメント', blank=True, null=True)
     created_at = models.DateTimeField('作成日', auto_now_add=True)
-    image = models.ImageField('写真', upload_to='photos/', blank=True, null=True)
+    image = models.ImageField('写真', upload_to='photos/', storage=photo_storage, blank=True, null=True)
+    # 写真の縮小画像ができたか。タスク (paplib.signals.build_image_variants) が作るまでは元画像の URL を出す
+    image_variants_ready = models.BooleanField(default=False, editable=False)
     updated_at = models.DateTimeField('更新日', auto_now=True)
 
+    class Meta:
+        # 記録はいつも「新しい登山日順」に読まれるので、並び順まで索引に含める
+        # (paplib.tests.QueryPlanTests で実際の問い合わせが索引を使うことを確認している)
+        indexes = [
+            models.Index(fields=['mountain', '-climb_date', '-id'], name='paplib_rec_mountain_date_idx'),
+            models.Index(fields=['user', '-climb_date', '-id'], name='paplib_rec_user_date_idx'),
+            models.Index(fields=['-climb_date', '-id'], name='paplib_rec_date_idx'),
+            models.Index(fields=['updated_at', 'id'], name='paplib_rec_updated_idx'),
+            # 山ごと・ユーザーごとの最新の更新日時 (views.latest_updates) を1行読むだけで求める
+            models.Index(fields=['mountain', 'updated_at'], name='paplib_rec_mountain_upd_idx'),
+            models.Index(fields=['user', 'updated_at'], name='paplib_rec_user_upd_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.mountain.name} ({self.user.username})'
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # 保存時に変更前の値と比べるため (paplib.aggregates)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        loaded = getattr(self, '_loaded_values', {})
+        image_changed = 'image' in loaded and (loaded['image'] or '') != (self.image.name or '')
+        if image_changed and (update_fields is None or 'image' in update_fields):
+            # 写真を替えたら、新しい写真の縮小画像ができるまで元画像を出す
+            self.image_variants_ready = False
+            if update_fields is not None:
+                kwargs['update_fields'] = [*update_fields, 'image_variants_ready']
+        elif not self._state.adding and update_fields is None:
+            # 読み込んだあとにタスクが縮小画像を作っていても、古い値で上書きしない
+            kwargs['update_fields'] = [
+                f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.name != 'image_variants_ready'
+            ]
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def mark_variants_ready(cls, name):
+        """写真 name の縮小画像ができた。同じ写真を使う記録すべてで縮小画像の URL を出す"""
+        # 更新日時も進めて、ETag・差分同期・記録の断片キャッシュのキーを変える
+        cls.objects.filter(image=name, image_variants_ready=False).update(
+            image_variants_ready=True, updated_at=timezone.now(),
+        )
+
+    def _variant_url(self, variant):
+        if not self.image:
+            return None
+        if not self.image_variants_ready:
+            return self.image.url
+        return variant_url(self.image.name, variant)
+
+    @property
+    def thumbnail_url(self):
+        return self._variant_url('thumb')
+
+    @property
+    def medium_url(self):
+        return self._variant_url('medium')
+
+
+class Tombstone(models.Model):
+    """削除された山と登山記録の id。paplib.sync の差分同期でクライアントに削除を伝える。
+
+    山の削除で CASCADE された記録も post_delete のシグナルで残る (paplib.signals)。
+    SYNC_TOMBSTONE_DAYS より古いものは prune_tombstones コマンドで消す。
+    """
+    RECORD = 'r'
+    MOUNTAIN = 'm'
+    KIND_CHOICES = [
+        (RECORD, '登山記録'),
+        (MOUNTAIN, '山'),
+    ]
+
+    kind = models.CharField(max_length=1, choices=KIND_CHOICES)
+    object_id = models.BigIntegerField()
+    deleted_at = models.DateTimeField('削除日', default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['deleted_at', 'id'], name='paplib_tombstone_deleted_idx'),
+        ]
+
+
+class LeaderboardEntry(models.Model):
+    """ランキング用に、ユーザーごとの集計を範囲と期間ごとに保存したもの。
+
+    paplib.leaderboards が記録の保存・削除のたびに、関係する行だけを計算し直す。
+    scope は '' (全体)・'p:<都道府県>'・'m:<山のID>'、year は 0 なら全期間 (山ごとは全期間だけ)。
+    """
+    METRICS = ('climbs', 'peaks', 'elevation')
+
+    scope = models.CharField(max_length=60)
+    year = models.IntegerField(default=0)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    climbs = models.IntegerField('登山回数')
+    peaks = models.IntegerField('登った山の数')
+    elevation = models.IntegerField('標高の合計')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['scope', 'year', 'user'], name='paplib_leaderboard_unique'),
+        ]
+        # 指標ごとに「多い順、同じならユーザーIDの順」の索引を持ち、どのページも索引をたどるだけで読む
+        indexes = [
+            models.Index(fields=['scope', 'year', '-climbs', 'user'], name='paplib_lb_climbs_idx'),
+            models.Index(fields=['scope', 'year', '-peaks', 'user'], name='paplib_lb_peaks_idx'),
+            models.Index(fields=['scope', 'year', '-elevation', 'user'], name='paplib_lb_elevation_idx'),
+        ]
+
+
+class PhotoUpload(models.Model):
+    """分割して送られてくる登山記録の写真 (/api/uploads/)。
+
+    受け取った部分は PHOTO_UPLOAD_TEMP_DIR に置き、全部そろったら paplib.uploads が
+    リクエストの外で検証・変換して record の写真にする。
+    """
+    UPLOADING = 'uploading'
+    PROCESSING = 'processing'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (UPLOADING, '送信中'),
+        (PROCESSING, '処理中'),
+        (DONE, '完了'),
+        (FAILED, '失敗'),
+    ]
+
+    # 推測されないよう連番ではなく UUID にする
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    record = models.ForeignKey(ClimbRecord, on_delete=models.CASCADE, related_name='uploads')
+    filename = models.CharField('ファイル名', max_length=255)
+    size = models.BigIntegerField('サイズ')
+    sha256 = models.CharField('SHA-256', max_length=64)
+    # 受け取り済みのバイト数。次の部分はここから送る
+    offset = models.BigIntegerField('受信済み', default=0)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=UPLOADING)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField('作成日', auto_now_add=True)
+    updated_at = models.DateTimeField('更新日', auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'updated_at'], name='paplib_upload_status_idx'),
+        ]
+
+
+class PhotoBlob(models.Model):
+    """写真のファイルと、それを使っている登山記録の数。
+
+    同じ写真は1つのファイルを共有するので (paplib.storage)、参照がなくなったときだけ消す (paplib.blobs)。
+    """
+    name = models.CharField(max_length=255, unique=True)
+    refs = models.IntegerField('参照数', default=0)
+
+
+class Task(models.Model):
+    """DB に保存するタスクキューのタスク (paplib.tasks)。run_worker コマンドが取り出して実行する。
+
+    実行中のまま locked_until を過ぎたもの (ワーカーが落ちたなど) は、また取り出せる。
+    成功したタスクは消し、max_attempts 回失敗したものは failed にして残す。
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, '待機中'),
+        (RUNNING, '実行中'),
+        (FAILED, '失敗'),
+    ]
+
+    name = models.CharField('関数', max_length=200)
+    kwargs = models.JSONField('引数', default=dict)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.IntegerField('実行回数', default=0)
+    max_attempts = models.IntegerField('最大実行回数', default=3)
+    run_after = models.DateTimeField('実行予定', default=timezone.now)
+    locked_by = models.CharField('ワーカー', max_length=100, blank=True)
+    locked_until = models.DateTimeField('実行期限', blank=True, null=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField('作成日', auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_after', 'id'], name='paplib_task_ready_idx'),
+            models.Index(fields=['status', 'locked_until'], name='paplib_task_locked_idx'),
+            models.Index(fields=['locked_by'], name='paplib_task_locked_by_idx'),
+        ]
+
     def __str__(self):
-        return f'{self.mountain.name} ({self.user.username})'
\ No newline at end of file
+        return f'{self.name} ({self.status})'
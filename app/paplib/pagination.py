@@ -0,0 +1,202 @@
+import datetime
+import json
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import F, Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import Cursor, CursorPagination, _reverse_ordering
+
+
+def _compare(name, lookup, value, nullable):
+    """name <lookup> value の条件。NULL は最も小さい値として扱う (並べるときも同じ)"""
+    if not nullable:
+        return Q(**{f'{name}__{lookup}': value})
+    if value is None:
+        return {
+            'exact': Q(**{f'{name}__isnull': True}),
+            'gte': Q(),
+            'gt': Q(**{f'{name}__isnull': False}),
+            'lte': Q(**{f'{name}__isnull': True}),
+            'lt': Q(pk__in=[]),
+        }[lookup]
+    condition = Q(**{f'{name}__{lookup}': value})
+    if lookup in ('lt', 'lte'):
+        condition |= Q(**{f'{name}__isnull': True})
+    return condition
+
+
+def _after(ordering, position, nullable):
+    """ordering の順で position より後にある行の条件。
+
+    (a, b, id) > (x, y, z) を a >= x AND (a > x OR (a = x AND (b, id) > (y, z))) の形で書き、
+    先頭の列の範囲条件で索引を引けるようにする。
+    """
+    order, value = ordering[0], position[0]
+    name = order.lstrip('-')
+    op = 'lt' if order.startswith('-') else 'gt'
+    is_nullable = name in nullable
+    if len(ordering) == 1:
+        return _compare(name, op, value, is_nullable)
+    return _compare(name, op + 'e', value, is_nullable) & (
+        _compare(name, op, value, is_nullable)
+        | _compare(name, 'exact', value, is_nullable) & _after(ordering[1:], position[1:], nullable)
+    )
+
+
+def _order_by(ordering, nullable):
+    # NULL を取りうる列は、データベースによらず NULL を最も小さい値として並べる
+    return [
+        (F(order[1:]).desc(nulls_last=True) if order.startswith('-') else F(order).asc(nulls_first=True))
+        if order.lstrip('-') in nullable else order
+        for order in ordering
+    ]
+
+
+def _nullable_fields(model, ordering):
+    nullable = set()
+    for name in (order.lstrip('-') for order in ordering):
+        try:
+            if model._meta.get_field(name).null:
+                nullable.add(name)
+        except FieldDoesNotExist:
+            # 注釈 (検索の関連度など)
+            pass
+    return nullable
+
+
+def _json_value(value):
+    # DjangoJSONEncoder は日時をミリ秒に丸めるので、位置がずれないよう isoformat をそのまま使う
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return value
+
+
+class StandardCursorPagination(CursorPagination):
+    """API一覧用のカーソル(キーセット)ページネーション。
+
+    カーソルには並び順のすべての列の値を入れ、次のページは「(列1, 列2, …, id) がその位置より後」
+    の行を先頭から読む。並び順の最後には必ず id を付けるので、値が同じ行がいくら続いても
+    読み飛ばしや重複は起きない。並び順に合う索引があれば、深いページでも読む行はページの大きさ程度で済む。
+    ページサイズは ?page_size= で変更できるが API_MAX_PAGE_SIZE を上限とする。
+    """
+    ordering = ('id',)
+    page_size_query_param = 'page_size'
+    max_page_size = getattr(settings, 'API_MAX_PAGE_SIZE', 200)
+    # 並び順に含まれていなければ最後に付け、行の位置を一意に決める列
+    tiebreaker = 'id'
+
+    def get_ordering(self, request, queryset, view):
+        ordering = super().get_ordering(request, queryset, view)
+        if not any(order.lstrip('-') in ('id', 'pk') for order in ordering):
+            ordering += (self.tiebreaker,)
+        return ordering
+
+    # 問い合わせの組み立てと、結果から前後の位置を決める処理は同期と非同期で共通にし、
+    # 問い合わせの実行だけを paginate_queryset と apaginate_queryset で変える
+
+    def paginate_queryset(self, queryset, request, view=None):
+        queryset = self._page_queryset(queryset, request, view)
+        if queryset is None:
+            return None
+        return self._set_page(list(queryset))
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        queryset = self._page_queryset(queryset, request, view)
+        if queryset is None:
+            return None
+        return self._set_page([obj async for obj in queryset.aiterator()])
+
+    def _page_queryset(self, queryset, request, view):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.cursor = self.decode_cursor(request)
+
+        ordering = self.ordering
+        if self.cursor is not None and self.cursor.reverse:
+            ordering = _reverse_ordering(ordering)
+        nullable = _nullable_fields(queryset.model, ordering)
+        queryset = queryset.order_by(*_order_by(ordering, nullable))
+        if self.cursor is not None and self.cursor.position is not None:
+            try:
+                queryset = queryset.filter(_after(ordering, self.cursor.position, nullable))
+            except (TypeError, ValueError, ValidationError):
+                # 列の型に合わない値 (書き換えられたカーソル)
+                raise NotFound(self.invalid_cursor_message)
+
+        # 次のページがあるかを知るために1件多く読む
+        return queryset[:self.page_size + 1]
+
+    def _set_page(self, results):
+        reverse = self.cursor is not None and self.cursor.reverse
+        current_position = self.cursor.position if self.cursor is not None else None
+        has_more = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        if reverse:
+            self.page.reverse()
+
+        if reverse:
+            self.has_next = current_position is not None
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = current_position is not None
+        # 空のページ (カーソルの後の行が消えた) ではカーソルの位置から前後に進む
+        self.previous_position = self._position(self.page[0]) if self.page else current_position
+        self.next_position = self._position(self.page[-1]) if self.page else current_position
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+        return self.page
+
+    def _position(self, instance):
+        return [
+            _json_value(instance[name] if isinstance(instance, dict) else getattr(instance, name))
+            for name in (order.lstrip('-') for order in self.ordering)
+        ]
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return self.encode_cursor(Cursor(offset=0, reverse=False, position=self.next_position))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        return self.encode_cursor(Cursor(offset=0, reverse=True, position=self.previous_position))
+
+    def encode_cursor(self, cursor):
+        return super().encode_cursor(cursor._replace(position=json.dumps(cursor.position)))
+
+    def decode_cursor(self, request):
+        cursor = super().decode_cursor(request)
+        if cursor is None or cursor.position is None:
+            return cursor
+        try:
+            position = json.loads(cursor.position)
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(position, list) or len(position) != len(self.ordering):
+            # 並び順 (?ordering=) を変えたあとに前のカーソルを使った場合など
+            raise NotFound(self.invalid_cursor_message)
+        return cursor._replace(offset=0, position=position)
+
+
+class MountainCursorPagination(StandardCursorPagination):
+    ordering = ('name', 'id')
+
+
+class ClimbRecordCursorPagination(StandardCursorPagination):
+    ordering = ('-climb_date', '-id')
+    # 差分取得 (?updated_since=) は更新日時の古い順に進める (更新日時の索引をそのまま使える)
+    sync_ordering = ('updated_at', 'id')
+
+    def get_ordering(self, request, queryset, view):
+        if request.query_params.get('updated_since'):
+            return self.sync_ordering
+        return super().get_ordering(request, queryset, view)
@@ -0,0 +1,35 @@
+import json
+
+from rest_framework.parsers import BaseParser
+
+
+class InvalidLine:
+    """NDJSON の読めなかった行。登録する行と同じ順に返し、paplib.bulk がその行のエラーにする"""
+
+    def __init__(self, message):
+        self.message = message
+
+
+class NDJSONParser(BaseParser):
+    """1行1オブジェクトの JSON (NDJSON) を読むパーサー。
+
+    本文を一度に読み込まず、1行ずつ dict を返すジェネレータを返す。読めない行で全体を止めると、
+    それより前に登録された記録がわからなくなるので、その行は InvalidLine として返す。
+    """
+    media_type = 'application/x-ndjson'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        encoding = (parser_context or {}).get('encoding', 'utf-8')
+        return self._iter_rows(stream, encoding)
+
+    def _iter_rows(self, stream, encoding):
+        # 文字コードの誤りも行ごとに扱えるよう、バイト列の行を1行ずつデコードする
+        for lineno, raw in enumerate(stream, start=1):
+            try:
+                line = raw.decode(encoding).strip()
+                if not line:
+                    continue
+                yield json.loads(line)
+            except ValueError as e:
+                # UnicodeDecodeError も ValueError
+                yield InvalidLine(f'NDJSON の {lineno} 行目を読めません: {e}')
@@ -0,0 +1,205 @@
+import contextvars
+import heapq
+import itertools
+import json
+import logging
+import random
+import time
+from contextlib import ExitStack, contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connections
+from django.template.base import Template
+
+logger = logging.getLogger('paplib.slow_requests')
+
+_current = contextvars.ContextVar('paplib_request_profile', default=None)
+# slow log に載せる SQL の最大文字数
+MAX_SQL_LENGTH = 500
+
+
+class RequestProfile:
+    def __init__(self, keep_queries):
+        self.queries = 0
+        self.sql_ms = 0.0
+        self.template_ms = 0.0
+        self.sections = {}
+        self.rendering = False
+        self._keep = keep_queries
+        self._worst = []
+        self._order = itertools.count()
+
+    def add_query(self, sql, ms):
+        self.queries += 1
+        self.sql_ms += ms
+        # 遅い順に keep_queries 件だけ残す
+        item = (ms, next(self._order), sql)
+        if len(self._worst) < self._keep:
+            heapq.heappush(self._worst, item)
+        elif self._keep:
+            heapq.heappushpop(self._worst, item)
+
+    def worst_queries(self):
+        return [
+            {'ms': round(ms, 2), 'sql': sql[:MAX_SQL_LENGTH]}
+            for ms, _, sql in sorted(self._worst, reverse=True)
+        ]
+
+    def __call__(self, execute, sql, params, many, context):
+        # connection.execute_wrapper に渡すと全ての SQL の実行時間を数える
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.add_query(sql, (time.perf_counter() - start) * 1000)
+
+
+@contextmanager
+def section(name):
+    """プロファイル中のリクエストなら、この中の処理時間を Server-Timing の name に足す"""
+    profile = _current.get()
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.sections[name] = profile.sections.get(name, 0.0) + (time.perf_counter() - start) * 1000
+
+
+_original_render = Template.render
+
+
+def _timed_render(self, context):
+    profile = _current.get()
+    # {% include %} などの入れ子は外側の描画時間に含まれるので数えない
+    if profile is None or profile.rendering:
+        return _original_render(self, context)
+    profile.rendering = True
+    start = time.perf_counter()
+    try:
+        return _original_render(self, context)
+    finally:
+        profile.rendering = False
+        profile.template_ms += (time.perf_counter() - start) * 1000
+
+
+def enabled():
+    """RequestProfilingMiddleware が有効で、測るリクエストがあるか"""
+    return (
+        f'{__name__}.RequestProfilingMiddleware' in settings.MIDDLEWARE
+        and getattr(settings, 'PAPLIB_PROFILE_SAMPLE_RATE', 1.0) > 0
+    )
+
+
+def install_template_timer():
+    """Template.render を描画時間を数える版に置き換える (PaplibConfig.ready() から起動時に1回だけ呼ぶ)。
+
+    測っていないリクエストや別のスレッドでは、元の render をそのまま呼ぶ。
+    """
+    if Template.render is not _timed_render:
+        Template.render = _timed_render
+
+
+class RequestProfilingMiddleware:
+    """リクエストごとの SQL の件数と時間・テンプレートの描画時間を測る。
+
+    PAPLIB_PROFILE_SAMPLE_RATE の割合のリクエストだけを詳しく測り、Server-Timing ヘッダーで返す。
+    PAPLIB_SLOW_REQUEST_MS を超えたリクエストは paplib.slow_requests に JSON で記録する
+    (詳しく測らなかったリクエストは全体の時間だけ)。テンプレートの描画時間は install_template_timer() で測る。
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def _sample(self):
+        rate = getattr(settings, 'PAPLIB_PROFILE_SAMPLE_RATE', 1.0)
+        if rate >= 1 or random.random() < rate:
+            return RequestProfile(getattr(settings, 'PAPLIB_SLOW_QUERY_COUNT', 5))
+        return None
+
+    @staticmethod
+    def _install(stack, profile):
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(profile))
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        profile = self._sample()
+        start = time.perf_counter()
+        if profile is None:
+            response = self.get_response(request)
+        else:
+            token = _current.set(profile)
+            try:
+                with ExitStack() as stack:
+                    self._install(stack, profile)
+                    response = self.get_response(request)
+            finally:
+                _current.reset(token)
+        return self._finish(request, response, profile, start)
+
+    async def __acall__(self, request):
+        profile = self._sample()
+        start = time.perf_counter()
+        if profile is None:
+            response = await self.get_response(request)
+        else:
+            # 非同期 ORM はリクエストごとの同じスレッドで SQL を実行するので、
+            # そのスレッドの接続に execute_wrapper を付ける
+            stack = ExitStack()
+            await sync_to_async(self._install)(stack, profile)
+            token = _current.set(profile)
+            try:
+                response = await self.get_response(request)
+            finally:
+                _current.reset(token)
+                await sync_to_async(stack.close)()
+        return self._finish(request, response, profile, start)
+
+    def _finish(self, request, response, profile, start):
+        total_ms = (time.perf_counter() - start) * 1000
+        if profile is not None:
+            response['Server-Timing'] = self._server_timing(profile, total_ms)
+        if total_ms >= getattr(settings, 'PAPLIB_SLOW_REQUEST_MS', 500):
+            self._log_slow(request, response, profile, total_ms)
+        return response
+
+    def _server_timing(self, profile, total_ms):
+        # view は SQL を含み、テンプレートの描画を除いた時間
+        metrics = [
+            f'total;dur={total_ms:.1f}',
+            f'view;dur={total_ms - profile.template_ms:.1f}',
+            f'sql;dur={profile.sql_ms:.1f};desc="{profile.queries} queries"',
+            f'tpl;dur={profile.template_ms:.1f}',
+        ]
+        metrics.extend(f'{name};dur={ms:.1f}' for name, ms in profile.sections.items())
+        return ', '.join(metrics)
+
+    def _log_slow(self, request, response, profile, total_ms):
+        entry = {
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'total_ms': round(total_ms, 1),
+            'sampled': profile is not None,
+        }
+        if profile is not None:
+            entry.update({
+                'view_ms': round(total_ms - profile.template_ms, 1),
+                'template_ms': round(profile.template_ms, 1),
+                'sql_ms': round(profile.sql_ms, 1),
+                'queries': profile.queries,
+                'sections': {name: round(ms, 1) for name, ms in profile.sections.items()},
+                'worst_queries': profile.worst_queries(),
+            })
+        logger.warning(json.dumps(entry, ensure_ascii=False))
@@ -0,0 +1,97 @@
+import unicodedata
+
+from django.db.models import Case, Count, F, IntegerField, Value, When
+from django.db.models.functions import Length
+
+from .models import Mountain, MountainSearchToken
+
+_SMALL_KANA = str.maketrans({'ゖ': 'け', 'ゕ': 'か'})
+
+
+def normalize(text):
+    """検索用に文字列を正規化する。
+
+    NFKC で全角英数・半角カナを揃え、小文字化し、カタカナをひらがなに寄せる。
+    """
+    text = unicodedata.normalize('NFKC', text or '').lower()
+    text = ''.join(chr(ord(c) - 0x60) if 'ァ' <= c <= 'ヶ' else c for c in text)
+    # 「駒ヶ岳」「駒ケ岳」のような表記ゆれを揃える
+    return text.translate(_SMALL_KANA)
+
+
+def bigrams(text):
+    if len(text) == 1:
+        return {text}
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+def index_grams(text):
+    """索引に登録する n-gram (1文字と2文字)"""
+    text = ''.join(normalize(text).split())
+    return set(text) | bigrams(text) if text else set()
+
+
+def query_grams(query):
+    """検索語を n-gram に分解する。空白区切りの語はすべて含む (AND) 扱い。"""
+    grams = set()
+    for term in normalize(query).split():
+        grams |= bigrams(term)
+    return grams
+
+
+def mountain_tokens(mountain):
+    fields = {
+        MountainSearchToken.NAME: mountain.name,
+        MountainSearchToken.KANA: mountain.name_kana,
+        MountainSearchToken.PREFECTURE: mountain.prefecture,
+    }
+    return [
+        MountainSearchToken(mountain_id=mountain.pk, field=field, gram=gram)
+        for field, text in fields.items()
+        for gram in index_grams(text)
+    ]
+
+
+def index_mountains(mountains, batch_size=5000):
+    """山の索引を作り直す。mountains は Mountain のイテラブル。"""
+    mountains = list(mountains)
+    MountainSearchToken.objects.filter(mountain__in=[m.pk for m in mountains]).delete()
+    tokens = [token for m in mountains for token in mountain_tokens(m)]
+    MountainSearchToken.objects.bulk_create(tokens, batch_size=batch_size)
+
+
+def search_mountains(query, queryset=None):
+    """n-gram 索引で山を検索し、関連度の高い順に並べた QuerySet を返す。
+
+    すべての n-gram を含む山だけを返す。山名 (または読み) だけで一致したものを優先し、
+    その中では山名が短い (検索語に近い) ものほど上位にする。
+    """
+    if queryset is None:
+        queryset = Mountain.objects.all()
+    grams = query_grams(query)
+    if not grams:
+        return queryset.none()
+
+    def matching(tokens):
+        # すべての n-gram を含む山の id (索引 gram, mountain だけで完結する)
+        return (
+            tokens.filter(gram__in=grams)
+            .values('mountain_id')
+            .annotate(matched=Count('gram', distinct=True))
+            .filter(matched=len(grams))
+            .values('mountain_id')
+        )
+
+    tokens = MountainSearchToken.objects.all()
+    name_tokens = tokens.filter(field__in=[MountainSearchToken.NAME, MountainSearchToken.KANA])
+    return (
+        queryset.filter(pk__in=matching(tokens))
+        .annotate(
+            search_score=Case(
+                When(pk__in=matching(name_tokens), then=Value(1000)),
+                default=Value(0),
+                output_field=IntegerField(),
+            ) - Length('name'),
+        )
+        .order_by(F('search_score').desc(), 'id')
+    )
@@ -1,6 +1,11 @@
+import os
+import re
+
+from django.conf import settings
 from rest_framework import serializers
+from rest_framework.exceptions import ValidationError
 from django.contrib.auth.models import User
-from .models import Mountain, ClimbRecord
+from .models import Mountain, ClimbRecord, PhotoUpload
 
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
@@ -19,10 +24,167 @@ class UserSerializer(serializers.ModelSerializer):
 class MountainSerializer(serializers.ModelSerializer):
     class Meta:
         model = Mountain
-        fields = ['id', 'name', 'prefecture', 'elevation']
+        fields = [
+            'id', 'name', 'name_kana', 'prefecture', 'elevation', 'latitude', 'longitude',
+            'record_count', 'climber_count', 'last_climbed_on', 'latest_photo',
+        ]
+
+class NearbyMountainSerializer(MountainSerializer):
+    """近くの山の検索結果 (paplib.geo.nearby)。中心がなければ distance_km は null"""
+    distance_km = serializers.FloatField(read_only=True, default=None)
+
+    class Meta(MountainSerializer.Meta):
+        fields = [*MountainSerializer.Meta.fields, 'distance_km']
     
+class RecordUserSerializer(serializers.ModelSerializer):
+    """登山記録に展開するユーザー (メールアドレスなどは出さない)"""
+    class Meta:
+        model = User
+        fields = ['id', 'username']
+
 class ClimbRecordSerializer(serializers.ModelSerializer):
+    """登山記録。context の fields (出すフィールド) と expand (中身を展開する関連先) で形を変えられる"""
     user = serializers.ReadOnlyField(source='user.username')
+    thumbnail = serializers.SerializerMethodField()
+    medium = serializers.SerializerMethodField()
+
+    # ?expand= で ID (user はユーザー名) の代わりに中身を出せる関連先
+    EXPANSIONS = {'mountain': MountainSerializer, 'user': RecordUserSerializer}
+
     class Meta:
         model = ClimbRecord
-        fields = ['id', 'user', 'mountain', 'comment', 'climb_date', 'created_at', 'image']
\ No newline at end of file
+        fields = ['id', 'user', 'mountain', 'comment', 'climb_date', 'created_at', 'image', 'thumbnail', 'medium']
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        fields = self.context.get('fields')
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+        # 行ごとに作らないよう、展開に使うシリアライザは1つだけ作る
+        self._expanded = {
+            name: self.EXPANSIONS[name](context=self.context)
+            for name in self.context.get('expand', ()) if name in self.fields
+        }
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        for name, serializer in self._expanded.items():
+            data[name] = serializer.to_representation(getattr(instance, name))
+        return data
+
+    def _absolute_url(self, url):
+        request = self.context.get('request')
+        if url and request is not None:
+            return request.build_absolute_uri(url)
+        return url
+
+    def get_thumbnail(self, obj):
+        return self._absolute_url(obj.thumbnail_url)
+
+    def get_medium(self, obj):
+        return self._absolute_url(obj.medium_url)
+
+# ClimbRecordSerializer の各フィールドを出すのに読む列
+RECORD_FIELD_COLUMNS = {
+    'id': ['id'],
+    'user': ['user', 'user__username'],
+    'mountain': ['mountain'],
+    'comment': ['comment'],
+    'climb_date': ['climb_date'],
+    'created_at': ['created_at'],
+    'image': ['image'],
+    'thumbnail': ['image', 'image_variants_ready'],
+    'medium': ['image', 'image_variants_ready'],
+}
+
+# 一覧の並び順 (paplib.pagination) に使う列。出さないフィールドでもカーソルを作るのに読む
+RECORD_ORDERING_COLUMNS = ['id', 'climb_date', 'updated_at']
+
+def _split(value):
+    return [name.strip() for name in value.split(',') if name.strip()]
+
+def record_shape(params):
+    """?fields= と ?expand= (どちらもカンマ区切り) を読み、(出すフィールド, 展開する関連先) を返す"""
+    fields = _split(params.get('fields', '')) or ClimbRecordSerializer.Meta.fields
+    unknown = [name for name in fields if name not in RECORD_FIELD_COLUMNS]
+    if unknown:
+        raise ValidationError({'fields': [f'不明なフィールドです: {", ".join(unknown)}']})
+    expand = _split(params.get('expand', ''))
+    unknown = [name for name in expand if name not in ClimbRecordSerializer.EXPANSIONS]
+    if unknown:
+        allowed = ', '.join(ClimbRecordSerializer.EXPANSIONS)
+        raise ValidationError({'expand': [f'展開できない関連先です: {", ".join(unknown)} ({allowed} から選んでください)']})
+    return set(fields), {name for name in expand if name in fields}
+
+def shape_records(queryset, fields, expand):
+    """record_shape() の形で出すのに必要な関連先と列だけを1回のクエリで読むようにする"""
+    columns = set(RECORD_ORDERING_COLUMNS)
+    for name in fields:
+        columns.update(RECORD_FIELD_COLUMNS[name])
+    related = {'user'} & fields
+    for name in expand:
+        related.add(name)
+        columns.add(name)
+        columns.update(f'{name}__{field}' for field in ClimbRecordSerializer.EXPANSIONS[name].Meta.fields)
+    # 元の select_related を残すと、読まない関連先と only() がぶつかる
+    return queryset.select_related(None).select_related(*sorted(related)).only(*sorted(columns))
+
+def shape_updated_fields(expand):
+    """展開した関連先のうち、変更を検証値 (ETag など) に含める更新日時の列"""
+    return ['mountain__updated_at'] if 'mountain' in expand else []
+
+class ClimbRecordImportSerializer(serializers.ModelSerializer):
+    """一括登録用。山の存在確認は呼び出し側がまとめて行い、context['mountain_ids'] で渡す。"""
+    mountain = serializers.IntegerField(source='mountain_id')
+
+    class Meta:
+        model = ClimbRecord
+        fields = ['mountain', 'climb_date', 'comment']
+
+    def validate_mountain(self, value):
+        if value not in self.context['mountain_ids']:
+            raise serializers.ValidationError(f'無効な主キー "{value}" - オブジェクトは存在しません。')
+        return value
+
+class PhotoUploadSerializer(serializers.ModelSerializer):
+    """写真の分割アップロード。chunk_size は1回の PUT で送れる部分の上限"""
+    record = serializers.PrimaryKeyRelatedField(queryset=ClimbRecord.objects.all())
+    chunk_size = serializers.SerializerMethodField()
+    image = serializers.SerializerMethodField()
+
+    class Meta:
+        model = PhotoUpload
+        fields = ['id', 'record', 'filename', 'size', 'sha256', 'offset', 'status', 'error',
+                  'chunk_size', 'image', 'created_at']
+        read_only_fields = ['offset', 'status', 'error']
+
+    def validate_record(self, value):
+        if value.user_id != self.context['request'].user.pk:
+            raise serializers.ValidationError('自分の登山記録にだけ写真を付けられます。')
+        return value
+
+    def validate_filename(self, value):
+        return os.path.basename(value.replace('\\', '/'))
+
+    def validate_size(self, value):
+        if not 0 < value <= settings.PHOTO_UPLOAD_MAX_BYTES:
+            raise serializers.ValidationError(f'1〜{settings.PHOTO_UPLOAD_MAX_BYTES} バイトの写真を送ってください。')
+        return value
+
+    def validate_sha256(self, value):
+        value = value.lower()
+        if not re.fullmatch(r'[0-9a-f]{64}', value):
+            raise serializers.ValidationError('SHA-256 を16進数64桁で指定してください。')
+        return value
+
+    def get_chunk_size(self, obj):
+        return settings.PHOTO_UPLOAD_CHUNK_BYTES
+
+    def get_image(self, obj):
+        # 処理が終わるまでは記録の写真は変わっていない
+        if obj.status != PhotoUpload.DONE or not obj.record.image:
+            return None
+        request = self.context.get('request')
+        url = obj.record.image.url
+        return request.build_absolute_uri(url) if request is not None else url
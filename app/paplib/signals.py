@@ -0,0 +1,183 @@
+from collections import Counter
+
+from django.contrib.auth.models import User
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import Signal, receiver
+
+from . import aggregates, blobs, cache, leaderboards
+from .images import generate_variants
+from .models import ClimbRecord, Mountain, Tombstone
+from .search import index_mountains
+from .storage import photo_storage
+from .tasks import task
+
+# bulk_create は post_save を送らないので、一括登録した記録はこのシグナルで通知する
+records_bulk_created = Signal()
+
+
+@task()
+def build_image_variants(name):
+    # 縮小画像が既にあれば generate_variants は何もしない。実行までに写真が消えていれば何もしない
+    if photo_storage().exists(name):
+        generate_variants(name)
+        ClimbRecord.mark_variants_ready(name)
+
+
+@receiver(post_save, sender=ClimbRecord)
+def create_image_variants(sender, instance, raw=False, **kwargs):
+    # Pillow での縮小はリクエストの外 (タスクキュー) で行う
+    original = (getattr(instance, '_original_values', None) or {}).get('image', '')
+    if instance.image and not raw and instance.image.name != original:
+        build_image_variants.enqueue(name=instance.image.name)
+
+
+@receiver(post_save, sender=ClimbRecord)
+def count_photo_references(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    original = (instance._original_values or {}).get('image', '')
+    blobs.changed(original, instance.image.name or '')
+
+
+@receiver(post_delete, sender=ClimbRecord)
+def release_photo(sender, instance, **kwargs):
+    # 同じ写真を使う記録が残っていればファイルは消えない
+    blobs.release(instance.image.name)
+
+
+@receiver(post_save, sender=Mountain)
+def update_search_index(sender, instance, raw=False, **kwargs):
+    # 削除時は ForeignKey の CASCADE で索引も消える
+    if not raw:
+        index_mountains([instance])
+
+
+@receiver(post_save, sender=Mountain)
+@receiver(post_delete, sender=Mountain)
+def invalidate_mountain_cache(sender, instance, **kwargs):
+    cache.invalidate_mountain(instance.pk)
+
+
+@receiver(post_save, sender=Mountain)
+def invalidate_all_user_stats(sender, instance, created=False, raw=False, **kwargs):
+    # 標高や都道府県の変更は、その山に登った全員の統計に響く
+    if not created and not raw:
+        cache.invalidate_user_stats()
+
+
+@receiver(pre_save, sender=ClimbRecord)
+def remember_original_values(sender, instance, raw=False, **kwargs):
+    instance._original_values = None if raw else aggregates.original_values(instance)
+
+
+@receiver(post_save, sender=ClimbRecord)
+def update_mountain_stats(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    original = instance._original_values
+    current = aggregates.snapshot(instance)
+    aggregates.record_saved(instance, original)
+    instance._loaded_values = current
+    # 集計値は山の一覧・API にも出るので、変わった山のキャッシュを捨てる
+    if original != current:
+        for mountain_id in {current['mountain_id'], (original or current)['mountain_id']}:
+            cache.invalidate_mountain(mountain_id)
+
+
+@receiver(post_save, sender=ClimbRecord)
+def invalidate_user_stats(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    # コメントだけの変更では統計は変わらない
+    original = instance._original_values
+    current = aggregates.snapshot(instance)
+    if original != current:
+        for user_id in {current['user_id'], (original or current)['user_id']}:
+            cache.invalidate_user_stats(user_id)
+
+
+@receiver(post_delete, sender=ClimbRecord)
+def invalidate_user_stats_on_delete(sender, instance, **kwargs):
+    cache.invalidate_user_stats(instance.user_id)
+
+
+@receiver(post_delete, sender=ClimbRecord)
+def update_mountain_stats_on_delete(sender, instance, origin=None, **kwargs):
+    # 山ごと削除されるときは集計し直す必要がない
+    if isinstance(origin, Mountain) or getattr(origin, 'model', None) is Mountain:
+        return
+    aggregates.record_removed(aggregates.snapshot(instance), instance.pk)
+    cache.invalidate_mountain(instance.mountain_id)
+
+
+@receiver(records_bulk_created, sender=ClimbRecord)
+def update_mountain_stats_on_bulk_create(sender, records, **kwargs):
+    mountain_ids = {record.mountain_id for record in records}
+    aggregates.refresh_mountain_stats(Mountain.objects.filter(pk__in=mountain_ids))
+    for mountain_id in mountain_ids:
+        cache.invalidate_mountain(mountain_id)
+    for user_id in {record.user_id for record in records}:
+        cache.invalidate_user_stats(user_id)
+    for name, count in Counter(record.image.name for record in records if record.image).items():
+        blobs.retain(name, count)
+
+
+@receiver(post_delete, sender=ClimbRecord)
+@receiver(post_delete, sender=Mountain)
+def record_tombstone(sender, instance, **kwargs):
+    # 山の削除で CASCADE された記録にも送られるので、差分同期でまとめて消せる
+    kind = Tombstone.MOUNTAIN if sender is Mountain else Tombstone.RECORD
+    Tombstone.objects.create(kind=kind, object_id=instance.pk)
+
+
+@receiver(post_save, sender=ClimbRecord)
+def update_leaderboards(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    original = instance._original_values
+    current = aggregates.snapshot(instance)
+    if original != current:
+        leaderboards.records_changed(original, current)
+
+
+@receiver(post_delete, sender=ClimbRecord)
+def update_leaderboards_on_delete(sender, instance, origin=None, **kwargs):
+    # 山の削除は update_leaderboards_on_mountain_delete でまとめて作り直す。
+    # ユーザーの削除ではランキングの行も CASCADE で消える
+    if isinstance(origin, (Mountain, User)) or getattr(origin, 'model', None) in (Mountain, User):
+        return
+    leaderboards.records_changed(aggregates.snapshot(instance))
+
+
+@receiver(records_bulk_created, sender=ClimbRecord)
+def update_leaderboards_on_bulk_create(sender, records, **kwargs):
+    leaderboards.rebuild_users.enqueue(user_ids=sorted({record.user_id for record in records}))
+
+
+def _climber_ids(mountain):
+    return list(ClimbRecord.objects.filter(mountain=mountain).order_by('user_id').values_list('user_id', flat=True).distinct())
+
+
+@receiver(pre_save, sender=Mountain)
+def remember_mountain_attributes(sender, instance, raw=False, **kwargs):
+    instance._ranked_values = None
+    if not raw and not instance._state.adding:
+        instance._ranked_values = Mountain.objects.filter(pk=instance.pk).values_list('prefecture', 'elevation').first()
+
+
+@receiver(post_save, sender=Mountain)
+def update_leaderboards_on_mountain_change(sender, instance, raw=False, **kwargs):
+    # 都道府県や標高が変わったら、その山に登った人の行を作り直す
+    original = getattr(instance, '_ranked_values', None)
+    if not raw and original is not None and original != (instance.prefecture, instance.elevation):
+        leaderboards.rebuild_users.enqueue(user_ids=_climber_ids(instance))
+
+
+@receiver(pre_delete, sender=Mountain)
+def remember_climbers(sender, instance, **kwargs):
+    instance._climber_ids = _climber_ids(instance)
+
+
+@receiver(post_delete, sender=Mountain)
+def update_leaderboards_on_mountain_delete(sender, instance, **kwargs):
+    leaderboards.rebuild_users.enqueue(user_ids=instance._climber_ids)
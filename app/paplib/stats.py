@@ -0,0 +1,62 @@
+"""ユーザーごとの登山の統計 (マイページと /api/stats/)。
+
+記録を (年, 山) ごとにまとめる1回の集計クエリから全ての数字を作り、ユーザーごとにキャッシュする。
+キャッシュは記録の保存・削除と山の編集で捨てる (paplib.signals)。
+"""
+from django.db.models import Count, Max, Min
+from django.db.models.functions import ExtractYear
+
+from . import cache
+from .models import ClimbRecord
+
+
+def _totals():
+    return {'climbs': 0, 'elevation': 0, 'peaks': set()}
+
+
+def _finish(totals):
+    return {**totals, 'peaks': len(totals['peaks'])}
+
+
+def compute_user_stats(user_id):
+    rows = (
+        ClimbRecord.objects.filter(user_id=user_id)
+        .annotate(year=ExtractYear('climb_date'))
+        .values('year', 'mountain_id', 'mountain__prefecture', 'mountain__elevation')
+        .annotate(climbs=Count('pk'), first=Min('climb_date'), last=Max('climb_date'))
+        .order_by()
+    )
+    overall = _totals()
+    prefectures, years = {}, {}
+    first_climb = last_climb = None
+    for row in rows:
+        elevation = row['mountain__elevation'] * row['climbs']
+        for totals in (overall, prefectures.setdefault(row['mountain__prefecture'], _totals()),
+                       years.setdefault(row['year'], _totals())):
+            totals['climbs'] += row['climbs']
+            totals['elevation'] += elevation
+            totals['peaks'].add(row['mountain_id'])
+        first_climb = min(first_climb or row['first'], row['first'])
+        last_climb = max(last_climb or row['last'], row['last'])
+
+    return {
+        **_finish(overall),
+        'first_climb': first_climb,
+        'last_climb': last_climb,
+        # 記録の多い都道府県から
+        'prefectures': [
+            {'prefecture': name, **_finish(totals)}
+            for name, totals in sorted(prefectures.items(), key=lambda item: (-item[1]['climbs'], item[0]))
+        ],
+        # 新しい年から
+        'years': [{'year': year, **_finish(totals)} for year, totals in sorted(years.items(), reverse=True)],
+    }
+
+
+def user_stats(user_id):
+    key = cache.make_key(f'user_stats:{user_id}', cache.namespace_version('user_stats'))
+    stats = cache.get(key)
+    if stats is None:
+        stats = compute_user_stats(user_id)
+        cache.set(key, stats)
+    return stats
@@ -0,0 +1,57 @@
+"""登山記録の写真のストレージ。
+
+写真は内容の SHA-256 をファイル名にして photos/ab/abcdef....jpg に保存する。同じ写真 (パーティの
+全員が同じ写真を付けたときなど) は1つのファイルを共有し、参照の数は paplib.blobs が数える。
+名前が同じなら内容も同じなので、ブラウザには長くキャッシュさせてよい (paplib.views.serve_media)。
+"""
+import hashlib
+import posixpath
+import re
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage, storages
+
+# 内容のハッシュを名前にしたファイル (縮小画像は元の写真のハッシュ + _thumb などになる)
+HASHED_NAME = re.compile(r'(?:^|/)[0-9a-f]{2}/(?:variants/)?([0-9a-f]{64}(?:_[a-z]+)?)\.\w+$')
+
+
+def immutable_key(name):
+    """内容のハッシュを名前にしたファイルなら、その名前 (拡張子なし) を返す。そうでなければ None"""
+    match = HASHED_NAME.search(name)
+    return match.group(1) if match else None
+
+
+def content_hash(content):
+    digest = hashlib.sha256()
+    content.seek(0)
+    for chunk in content.chunks():
+        digest.update(chunk)
+    content.seek(0)
+    return digest.hexdigest()
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """ファイルを内容のハッシュの名前で保存し、同じ内容のファイルがあればそれを使う。
+
+    渡された名前からはディレクトリ (upload_to) と拡張子だけを使う。縮小画像 (variants/ 以下) は
+    元の写真のハッシュから名前が決まっているので、そのままの名前で保存する。
+    """
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        directory, filename = posixpath.split(name)
+        if posixpath.basename(directory) == 'variants':
+            return super().save(name, content, max_length)
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        digest = content_hash(content)
+        ext = posixpath.splitext(filename)[1].lower()
+        name = posixpath.join(directory, digest[:2], f'{digest}{ext}')
+        if self.exists(name):
+            return name
+        return super().save(name, content, max_length)
+
+
+def photo_storage():
+    return storages['photos']
@@ -0,0 +1,98 @@
+"""差分同期 (/api/sync/)。
+
+山・登山記録・削除 (Tombstone) の3つを、それぞれ (更新日時, id) の順に読み進める。
+サーバーが返すカーソルには3つの読み終えた位置が入っていて、次の呼び出しでは
+その続きだけを読むので、処理量は前回からの変更の件数に比例する。
+
+書き込み中のトランザクションが後から古い更新日時の行をコミットしても取りこぼさないよう、
+SYNC_SETTLE_SECONDS 秒より新しい変更は次回以降に回す。
+"""
+import datetime
+
+from django.conf import settings
+from django.core import signing
+from django.utils import timezone
+
+from .models import ClimbRecord, Mountain, Tombstone
+
+CURSOR_SALT = 'paplib.sync'
+
+# 名前: (問い合わせ, 読み進める日時のフィールド)
+STREAMS = {
+    'mountains': (Mountain.objects.all(), 'updated_at'),
+    'records': (ClimbRecord.objects.select_related('user'), 'updated_at'),
+    'deleted': (Tombstone.objects.all(), 'deleted_at'),
+}
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+class CursorExpired(Exception):
+    """カーソルが古すぎて、その間の削除を伝えられない (最初から同期し直す必要がある)"""
+
+
+def encode_cursor(positions):
+    return signing.dumps({
+        name: [moment.isoformat(), pk] for name, (moment, pk) in positions.items()
+    }, salt=CURSOR_SALT, compress=True)
+
+
+def decode_cursor(value):
+    try:
+        data = signing.loads(value, salt=CURSOR_SALT)
+        return {
+            name: (datetime.datetime.fromisoformat(data[name][0]), int(data[name][1]))
+            for name in STREAMS
+        }
+    except (signing.BadSignature, KeyError, TypeError, ValueError):
+        raise InvalidCursor
+
+
+def _read(queryset, field, position, horizon, limit):
+    """position より後で horizon より前の行を (field, id) の順に limit 件まで読む"""
+    moment, pk = position
+    # (field, id) > position を field の範囲条件として書き、(field, id) の索引で読めるようにする
+    rows = list(
+        queryset.filter(**{f'{field}__gte': moment, f'{field}__lt': horizon})
+        .exclude(**{field: moment, 'pk__lte': pk})
+        .order_by(field, 'pk')[:limit + 1]
+    )
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        return rows[:limit], (getattr(last, field), last.pk), True
+    # 読み終えたら horizon まで進める (次は horizon 以降の変更だけを読む)。時計が戻っても後ろには戻らない
+    return rows, max(position, (horizon, 0)), False
+
+
+def changes(cursor=None, limit=500):
+    """cursor 以降の変更を {'mountains': [...], 'records': [...], 'deleted': [...]} で返す。
+
+    戻り値は (変更, 次のカーソル, まだ残りがあるか)。cursor が None なら全件を最初から返す
+    (削除は最初の呼び出し以降のものだけ)。
+    """
+    now = timezone.now()
+    horizon = now - datetime.timedelta(seconds=settings.SYNC_SETTLE_SECONDS)
+    if cursor is None:
+        epoch = datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+        positions = {'mountains': (epoch, 0), 'records': (epoch, 0), 'deleted': (horizon, 0)}
+    else:
+        positions = decode_cursor(cursor)
+        # 古い Tombstone は消しているので、その期間の削除は伝えられない
+        if positions['deleted'][0] < now - datetime.timedelta(days=settings.SYNC_TOMBSTONE_DAYS):
+            raise CursorExpired
+
+    result, has_more = {}, False
+    for name, (queryset, field) in STREAMS.items():
+        rows, positions[name], more = _read(queryset, field, positions[name], horizon, limit)
+        result[name] = rows
+        has_more = has_more or more
+    return result, encode_cursor(positions), has_more
+
+
+def prune_tombstones(days=None):
+    """days 日 (既定は SYNC_TOMBSTONE_DAYS) より古い Tombstone を消し、消した件数を返す"""
+    days = settings.SYNC_TOMBSTONE_DAYS if days is None else days
+    deleted, _ = Tombstone.objects.filter(deleted_at__lt=timezone.now() - datetime.timedelta(days=days)).delete()
+    return deleted
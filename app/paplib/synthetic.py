@@ -0,0 +1,75 @@
+import itertools
+from io import BytesIO
+
+from PIL import Image, ImageDraw
+
+from .geo import cell_of
+from .models import Mountain
+
+PREFECTURES = [
+    '北海道', '青森県', '岩手県', '宮城県', '秋田県', '山形県', '福島県', '茨城県', '栃木県', '群馬県',
+    '埼玉県', '千葉県', '東京都', '神奈川県', '新潟県', '富山県', '石川県', '福井県', '山梨県', '長野県',
+    '岐阜県', '静岡県', '愛知県', '三重県', '滋賀県', '京都府', '大阪府', '兵庫県', '奈良県', '和歌山県',
+    '鳥取県', '島根県', '岡山県', '広島県', '山口県', '徳島県', '香川県', '愛媛県', '高知県', '福岡県',
+    '佐賀県', '長崎県', '熊本県', '大分県', '宮崎県', '鹿児島県', '沖縄県',
+]
+
+# (表記, 読み)
+NAME_PARTS = [
+    ('富士', 'ふじ'), ('八', 'はち'), ('赤', 'あか'), ('白', 'しら'), ('黒', 'くろ'), ('大', 'おお'),
+    ('小', 'こ'), ('駒', 'こま'), ('槍', 'やり'), ('穂高', 'ほたか'), ('乗鞍', 'のりくら'), ('燕', 'つばくろ'),
+    ('鷲羽', 'わしば'), ('剣', 'つるぎ'), ('立', 'たて'), ('雲', 'くも'), ('月', 'がっ'), ('谷川', 'たにがわ'),
+    ('金', 'きん'), ('甲', 'かい'), ('仙丈', 'せんじょう'), ('塩見', 'しおみ'), ('蝶', 'ちょう'), ('常念', 'じょうねん'),
+]
+SUFFIXES = [('山', 'さん'), ('岳', 'だけ'), ('峰', 'ほう'), ('ヶ岳', 'がたけ'), ('森', 'もり')]
+
+# 山の位置を選ぶ範囲 (日本の南端〜北端, 西端〜東端のおよそ)
+JAPAN_LATITUDE = (24.0, 45.5)
+JAPAN_LONGITUDE = (123.0, 146.0)
+
+COMMENTS = [
+    '', '', '快晴で山頂からの眺めが最高でした。', '雨で展望なし。', '紅葉がきれいだった。',
+    '思ったより急登が続いた。', '山小屋泊。星がよく見えた。', '雪が残っていてアイゼンを使った。',
+]
+
+
+def mountain_objects(rng, count):
+    """保存前の Mountain を count 件作る。先頭の47件で全都道府県を1回ずつ使う。"""
+    mountains = []
+    for i in range(count):
+        (p1, k1), (p2, k2), (suffix, ks) = rng.choice(NAME_PARTS), rng.choice(NAME_PARTS), rng.choice(SUFFIXES)
+        prefecture = PREFECTURES[i] if i < len(PREFECTURES) else rng.choice(PREFECTURES)
+        latitude, longitude = round(rng.uniform(*JAPAN_LATITUDE), 5), round(rng.uniform(*JAPAN_LONGITUDE), 5)
+        mountains.append(Mountain(
+            name=f'{p1}{p2}{suffix}', name_kana=f'{k1}{k2}{ks}',
+            prefecture=prefecture, elevation=rng.randint(100, 3776),
+            # bulk_create は save() を通らないので升目もここで入れる
+            latitude=latitude, longitude=longitude, geo_cell=cell_of(latitude, longitude),
+        ))
+    return mountains
+
+
+def popularity(rng, items, skew):
+    """人気に偏りのある抽選用に (並べ替えた items, 累積重み) を返す。
+
+    順位 k の重みを 1 / k**skew とする (Zipf 分布)。rng.choices(..., cum_weights=) に渡す。
+    """
+    items = list(items)
+    rng.shuffle(items)
+    weights = (1 / rank ** skew for rank in range(1, len(items) + 1))
+    return items, list(itertools.accumulate(weights))
+
+
+def photo_bytes(rng, size=(1600, 1200)):
+    """写真の代わりになる JPEG を作る"""
+    image = Image.new('RGB', size, tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(8):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        draw.rectangle(
+            [x, y, x + rng.randrange(50, 600), y + rng.randrange(50, 400)],
+            fill=tuple(rng.randrange(256) for _ in range(3)),
+        )
+    buffer = BytesIO()
+    image.save(buffer, format='JPEG', quality=85)
+    return buffer.getvalue()
@@ -0,0 +1,117 @@
+"""DB に保存する小さなタスクキュー。
+
+@task を付けた関数は func.enqueue(**kwargs) でキューに入れる。タスクは呼び出し元のトランザクションと
+一緒にコミットされるので、ロールバックされた保存のタスクは実行されない。引数は JSON にできる値だけ。
+
+run_worker コマンドが claim() でまとめて取り出し (1回の UPDATE で取り合うので、複数のワーカーが
+同じタスクを同時に実行することはない)、execute() で実行する。失敗したら TASKS_RETRY_DELAY 秒から
+倍々に間をあけて再試行し、TASKS_VISIBILITY_TIMEOUT 秒たっても終わらないタスクは別のワーカーが実行し直す。
+
+TASKS_EAGER (テスト用) なら、キューに入れずにその場で実行する。
+"""
+import datetime
+import functools
+import time
+import traceback
+import uuid
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import Task
+
+
+class TaskError(Exception):
+    pass
+
+
+def task(max_attempts=None):
+    """関数をキューで実行できるようにする。func.enqueue(**kwargs) でキューに入れる"""
+    def decorator(func):
+        func.task_name = f'{func.__module__}.{func.__qualname__}'
+        func.max_attempts = max_attempts or settings.TASKS_MAX_ATTEMPTS
+        func.enqueue = functools.partial(enqueue, func)
+        return func
+    return decorator
+
+
+def enqueue(func, delay=0, **kwargs):
+    """func (@task を付けた関数) を kwargs で呼ぶタスクを入れ、その Task を返す (TASKS_EAGER なら None)"""
+    if settings.TASKS_EAGER:
+        func(**kwargs)
+        return None
+    return Task.objects.create(
+        name=func.task_name, kwargs=kwargs, max_attempts=func.max_attempts,
+        run_after=timezone.now() + datetime.timedelta(seconds=delay),
+    )
+
+
+def _ready(now):
+    # 待機中で実行予定を過ぎたもの、または実行中のまま期限が切れたもの
+    return Q(status=Task.QUEUED, run_after__lte=now) | Q(status=Task.RUNNING, locked_until__lt=now)
+
+
+def claim(worker, limit):
+    """実行できるタスクを最大 limit 件取り出し、(タスク, 取り出しの印) のリストを返す"""
+    now = timezone.now()
+    token = f'{worker}:{uuid.uuid4().hex[:12]}'
+    with transaction.atomic():
+        # 行ロックのある DB では他のワーカーが取り出し中の行を飛ばす (SQLite ではトランザクション全体が排他)
+        ids = list(
+            Task.objects.select_for_update(skip_locked=True).filter(_ready(now))
+            .order_by('run_after', 'id').values_list('pk', flat=True)[:limit]
+        )
+        if not ids:
+            return []
+        # 条件をもう一度付けて UPDATE するので、同時に取り出そうとしたワーカーとは重ならない
+        Task.objects.filter(_ready(now), pk__in=ids).update(
+            status=Task.RUNNING, attempts=F('attempts') + 1, locked_by=token,
+            locked_until=now + datetime.timedelta(seconds=settings.TASKS_VISIBILITY_TIMEOUT),
+        )
+    return [(t, token) for t in Task.objects.filter(locked_by=token).order_by('run_after', 'id')]
+
+
+def _resolve(name):
+    try:
+        func = import_string(name)
+    except ImportError:
+        raise TaskError(f'タスク {name} が見つかりません。')
+    if getattr(func, 'task_name', None) != name:
+        raise TaskError(f'{name} はタスクではありません。')
+    return func
+
+
+def execute(task_id, token):
+    """取り出したタスクを実行し、(結果, 待ち時間, 実行時間) を返す。結果は done / retry / failed / lost"""
+    t = Task.objects.filter(pk=task_id, locked_by=token).first()
+    if t is None:
+        # 期限が切れて、別のワーカーが取り出した
+        return 'lost', 0.0, 0.0
+    wait = (timezone.now() - t.created_at).total_seconds()
+    started = time.perf_counter()
+    mine = Task.objects.filter(pk=t.pk, locked_by=token)
+    try:
+        if t.attempts > t.max_attempts:
+            raise TaskError(f'{settings.TASKS_VISIBILITY_TIMEOUT} 秒以内に終わりませんでした。')
+        _resolve(t.name)(**t.kwargs)
+    except Exception:
+        error = traceback.format_exc()
+        duration = time.perf_counter() - started
+        if t.attempts < t.max_attempts:
+            delay = settings.TASKS_RETRY_DELAY * 2 ** (t.attempts - 1)
+            mine.update(status=Task.QUEUED, last_error=error, locked_by='', locked_until=None,
+                        run_after=timezone.now() + datetime.timedelta(seconds=delay))
+            return 'retry', wait, duration
+        mine.update(status=Task.FAILED, last_error=error, locked_until=None)
+        return 'failed', wait, duration
+    duration = time.perf_counter() - started
+    mine.delete()
+    return 'done', wait, duration
+
+
+def pending():
+    """まだ終わっていない (待機中・実行中の) タスクの数"""
+    return Task.objects.filter(status__in=[Task.QUEUED, Task.RUNNING]).count()
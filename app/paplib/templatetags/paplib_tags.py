@@ -0,0 +1,9 @@
+from django import template
+
+register = template.Library()
+
+
+@register.filter
+def owned_by(record, user):
+    """record が user の記録か。{% cache %} のキーで、閲覧者ごとに変わる編集・削除ボタンを分けるのに使う"""
+    return record.user_id == user.pk
@@ -1,3 +1,1975 @@
-from django.test import TestCase
+import base64
+import datetime
+import hashlib
+import json
+import os
+import random
+import re
+import shutil
+import tempfile
+from io import BytesIO, StringIO
+from unittest import mock
+from urllib.parse import urlencode
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, iscoroutinefunction
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import F
+from django.http import HttpResponse
+from django.template.base import Template
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve, reverse
+from django.utils import timezone
+from django.utils.http import http_date
+from PIL import Image
+from rest_framework.authtoken.models import Token
+
+from . import profiling
+from .aggregates import refresh_mountain_stats
+from .cache import get_cache, make_key, reset_stats, stats
+from .geo import cell_of, haversine_km, nearby, within_box
+from .images import IMAGE_VARIANTS, variant_name
+from .leaderboards import rebuild as rebuild_leaderboards
+from .models import LeaderboardEntry, Mountain, ClimbRecord, MountainSearchToken, PhotoBlob, PhotoUpload, Task, Tombstone
+from .pagination import ClimbRecordCursorPagination
+from .search import index_mountains, normalize, search_mountains
+from .stats import compute_user_stats, user_stats
+from .tasks import claim, execute, task
+
+
+def make_records(mountain, users, count, start=datetime.date(2024, 1, 1)):
+    records = [
+        ClimbRecord(
+            user=users[i % len(users)],
+            mountain=mountain,
+            climb_date=start + datetime.timedelta(days=i),
+            comment=f'記録 {i}',
+        )
+        for i in range(count)
+    ]
+    return ClimbRecord.objects.bulk_create(records)
+
+
+class ViewQueryCountTests(TestCase):
+    """HTML ビューのクエリ数が記録数に依存しないことを確認する。"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('owner', password='pass')
+        cls.others = [User.objects.create_user(f'user{i}', password='pass') for i in range(5)]
+        cls.small = Mountain.objects.create(name='高尾山', prefecture='東京都', elevation=599)
+        cls.large = Mountain.objects.create(name='富士山', prefecture='静岡県', elevation=3776)
+        make_records(cls.small, [cls.owner], 1)
+        make_records(cls.large, [cls.owner, *cls.others], 40)
+        cls.record = ClimbRecord.objects.filter(user=cls.owner, mountain=cls.large).first()
+
+    def setUp(self):
+        get_cache().clear()
+        self.client.force_login(self.owner)
+
+    def test_mountain_detail_anonymous(self):
+        self.client.logout()
+        for mountain in (self.small, self.large):
+            # 山 + 件数 + 最新の更新日時 (フラグメントキャッシュの版) + 記録
+            with self.assertNumQueries(4):
+                response = self.client.get(reverse('mountain_detail', args=[mountain.pk]))
+            self.assertEqual(response.status_code, 200)
+
+    def test_mountain_detail_logged_in(self):
+        # セッション + ユーザー + 山 + 件数 + 最新の更新日時 + 記録
+        for mountain in (self.small, self.large):
+            with self.assertNumQueries(6):
+                response = self.client.get(reverse('mountain_detail', args=[mountain.pk]))
+            self.assertEqual(response.status_code, 200)
+
+    def test_mountain_detail_is_paginated(self):
+        response = self.client.get(reverse('mountain_detail', args=[self.large.pk]), {'page': 2})
+        self.assertEqual(response.context['page_obj'].number, 2)
+        self.assertEqual(len(response.context['records']), 10)
+        self.assertContains(response, '前へ')
+
+    def test_mountain_detail_shows_owner_buttons_only(self):
+        response = self.client.get(reverse('mountain_detail', args=[self.small.pk]))
+        self.assertContains(response, reverse('record_edit', args=[self.small.climbrecord_set.get().pk]))
+        self.client.force_login(self.others[0])
+        response = self.client.get(reverse('mountain_detail', args=[self.small.pk]))
+        self.assertNotContains(response, reverse('record_edit', args=[self.small.climbrecord_set.get().pk]))
+
+    def test_mypage(self):
+        get_cache().clear()
+        # 統計はキャッシュがなければ集計クエリ1回で作り、次からはキャッシュを使う
+        # 記録の一覧も2回目はフラグメントキャッシュから出るので、記録そのものは読まない
+        for queries in (6, 4):
+            with self.assertNumQueries(queries):
+                response = self.client.get(reverse('mypage'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['records']), 8)
+
+    def test_record_edit(self):
+        url = reverse('record_edit', args=[self.record.pk])
+        with self.assertNumQueries(3):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        # 記録の更新 + 山の集計値の差分更新 (旧値の取り消しと新値の反映)
+        # + ランキングの更新 (山の都道府県・集計・書き込み)
+        with self.assertNumQueries(9):
+            response = self.client.post(url, {'climb_date': '2024-05-05', 'comment': '更新'})
+        self.assertRedirects(response, reverse('mountain_detail', args=[self.large.pk]), fetch_redirect_response=False)
+
+    def test_record_edit_forbidden_for_others(self):
+        self.client.force_login(self.others[0])
+        response = self.client.get(reverse('record_edit', args=[self.record.pk]))
+        self.assertEqual(response.status_code, 403)
+
+    def test_record_delete(self):
+        url = reverse('record_delete', args=[self.record.pk])
+        with self.assertNumQueries(3):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post(url)
+        self.assertRedirects(response, reverse('mountain_detail', args=[self.large.pk]), fetch_redirect_response=False)
+        self.assertFalse(ClimbRecord.objects.filter(pk=self.record.pk).exists())
+
+
+class ApiPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('climber', password='pass')
+        cls.mountain = Mountain.objects.create(name='北岳', prefecture='山梨県', elevation=3193)
+        # 同じ登山日の記録を混ぜて、カーソルが重複なく進むことを確認する
+        make_records(cls.mountain, [cls.user], 25)
+        make_records(cls.mountain, [cls.user], 5)
+
+    def setUp(self):
+        get_cache().clear()
+
+    def test_records_follow_next_links(self):
+        url = reverse('climbrecord-list') + '?page_size=7'
+        seen = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.data['results']), 7)
+            seen.extend(r['id'] for r in response.data['results'])
+            url = response.data['next']
+        self.assertEqual(sorted(seen), sorted(ClimbRecord.objects.values_list('id', flat=True)))
+        self.assertEqual(len(seen), len(set(seen)))
+
+    def follow(self, url, params):
+        pages = []
+        response = self.client.get(url, params)
+        while True:
+            self.assertEqual(response.status_code, 200)
+            pages.append([r['id'] for r in response.data['results']])
+            if not response.data['next']:
+                return pages
+            self.assertLess(len(pages), 100, 'next が終わらない')
+            response = self.client.get(response.data['next'])
+
+    def test_cursor_passes_long_runs_of_ties(self):
+        # 登山日も更新日時も同じ記録が DRF の offset の上限 (1000) より多く続いても進める
+        ClimbRecord.objects.bulk_create(
+            ClimbRecord(user=self.user, mountain=self.mountain, climb_date=datetime.date(2024, 6, 1))
+            for _ in range(1100)
+        )
+        ClimbRecord.objects.update(updated_at=timezone.now())
+        expected = sorted(ClimbRecord.objects.values_list('id', flat=True))
+        url = reverse('climbrecord-list')
+        for params in ({'page_size': 200}, {'page_size': 200, 'updated_since': '2024-01-01'}):
+            seen = [pk for page in self.follow(url, params) for pk in page]
+            self.assertEqual(sorted(seen), expected)
+            self.assertEqual(len(seen), len(set(seen)))
+
+    def test_previous_link_returns_the_same_page(self):
+        url = reverse('climbrecord-list')
+        first = self.client.get(url, {'page_size': 7})
+        second = self.client.get(first.data['next'])
+        third = self.client.get(second.data['next'])
+        back = self.client.get(third.data['previous'])
+        self.assertEqual(back.data['results'], second.data['results'])
+        self.assertEqual(self.client.get(back.data['previous']).data['results'], first.data['results'])
+        self.assertIsNone(first.data['previous'])
+
+    def test_broken_cursor(self):
+        url = reverse('climbrecord-list')
+        self.assertEqual(self.client.get(url, {'cursor': 'broken'}).status_code, 404)
+        # 並び順の列の数と合わない位置や、列の型に合わない値
+        for position in ('[1]', '["x", 1]', '{}'):
+            cursor = base64.b64encode(urlencode({'p': position}).encode()).decode()
+            self.assertEqual(self.client.get(url, {'cursor': cursor}).status_code, 404, position)
+
+    def test_mountain_orderings_pass_long_runs_of_ties(self):
+        # 登山記録数・標高は同じ値が多く、最終登山日は NULL が多い。?ordering= の列の後ろに id を付けて進める
+        Mountain.objects.bulk_create(
+            Mountain(name=f'山{i}', prefecture='長野県', elevation=1000 + i % 2,
+                     last_climbed_on=datetime.date(2024, 1, 1 + i % 3) if i % 4 else None)
+            for i in range(1100)
+        )
+        url = reverse('mountain-list')
+        for ordering, expected in (
+            ('-record_count', ['-record_count', 'id']),
+            ('elevation', ['elevation', 'id']),
+            ('-last_climbed_on', [F('last_climbed_on').desc(nulls_last=True), 'id']),
+            ('last_climbed_on', [F('last_climbed_on').asc(nulls_first=True), 'id']),
+        ):
+            pages = self.follow(url, {'ordering': ordering, 'page_size': 200})
+            expected = list(Mountain.objects.order_by(*expected).values_list('id', flat=True))
+            self.assertEqual([pk for page in pages for pk in page], expected, ordering)
+
+    def test_previous_link_across_nulls(self):
+        Mountain.objects.bulk_create(
+            Mountain(name=f'山{i}', prefecture='長野県', elevation=1000,
+                     last_climbed_on=datetime.date(2024, 1, 1) if i < 3 else None)
+            for i in range(6)
+        )
+        url = reverse('mountain-list')
+        first = self.client.get(url, {'ordering': '-last_climbed_on', 'page_size': 3})
+        second = self.client.get(first.data['next'])
+        third = self.client.get(second.data['next'])
+        self.assertIsNone(third.data['next'])
+        self.assertEqual(self.client.get(third.data['previous']).data['results'], second.data['results'])
+        self.assertEqual(self.client.get(second.data['previous']).data['results'], first.data['results'])
+
+    def test_page_size_is_capped(self):
+        with mock.patch.object(ClimbRecordCursorPagination, 'max_page_size', 10):
+            response = self.client.get(reverse('climbrecord-list'), {'page_size': 100000})
+        self.assertEqual(len(response.data['results']), 10)
+        self.assertIsNotNone(response.data['next'])
+
+    def test_mountains_are_paginated(self):
+        response = self.client.get(reverse('mountain-list'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('next', response.data)
+        self.assertEqual(response.data['results'][0]['name'], '北岳')
+
+
+class RecordShapeTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create_user(f'user{i}', password='pass', email=f'user{i}@example.com')
+                     for i in range(3)]
+        cls.mountains = [Mountain.objects.create(name=f'山{i}', prefecture='長野県', elevation=2000 + i)
+                         for i in range(3)]
+        for mountain in cls.mountains:
+            make_records(mountain, cls.users, 6)
+        cls.record = ClimbRecord.objects.first()
+
+    def setUp(self):
+        get_cache().clear()
+
+    def test_fields(self):
+        response = self.client.get(reverse('climbrecord-list'), {'fields': 'id,climb_date', 'page_size': 5})
+        self.assertEqual(set(response.data['results'][0]), {'id', 'climb_date'})
+        # 並び順の列は読むので、次のページのカーソルも作れる
+        response = self.client.get(response.data['next'])
+        self.assertEqual(set(response.data['results'][0]), {'id', 'climb_date'})
+        response = self.client.get(reverse('climbrecord-detail', args=[self.record.pk]), {'fields': 'comment'})
+        self.assertEqual(response.data, {'comment': self.record.comment})
+
+    def test_expand(self):
+        response = self.client.get(reverse('climbrecord-detail', args=[self.record.pk]), {'expand': 'mountain,user'})
+        self.assertEqual(response.data['mountain']['name'], self.record.mountain.name)
+        self.assertEqual(response.data['mountain']['elevation'], self.record.mountain.elevation)
+        # 展開したユーザーにメールアドレスは出さない
+        self.assertEqual(response.data['user'], {'id': self.record.user_id, 'username': self.record.user.username})
+        response = self.client.get(reverse('climbrecord-detail', args=[self.record.pk]))
+        self.assertEqual(response.data['mountain'], self.record.mountain_id)
+        self.assertEqual(response.data['user'], self.record.user.username)
+
+    def test_query_count_is_constant(self):
+        url = reverse('climbrecord-list')
+        for params in ({}, {'fields': 'id,comment'}, {'expand': 'mountain'},
+                       {'fields': 'id,mountain,user', 'expand': 'mountain,user'}):
+            for page_size in (2, 18):
+                # 検証値 + 記録 (関連先も同じクエリで読む)
+                with self.assertNumQueries(2):
+                    response = self.client.get(url, {**params, 'page_size': page_size})
+                self.assertEqual(len(response.data['results']), page_size)
+
+    def test_unknown_names_are_rejected(self):
+        response = self.client.get(reverse('climbrecord-list'), {'fields': 'id,password'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('password', response.data['fields'][0])
+        response = self.client.get(reverse('climbrecord-list'), {'expand': 'comment'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_expanded_mountain_changes_etag(self):
+        url = reverse('climbrecord-detail', args=[self.record.pk])
+        etag = self.client.get(url, {'expand': 'mountain'})['ETag']
+        self.assertEqual(self.client.get(url, {'expand': 'mountain'}, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        Mountain.objects.filter(pk=self.record.mountain_id).update(name='改名', updated_at=timezone.now())
+        response = self.client.get(url, {'expand': 'mountain'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['mountain']['name'], '改名')
+
+    def test_writes_ignore_shape(self):
+        self.client.force_login(self.record.user)
+        response = self.client.patch(
+            reverse('climbrecord-detail', args=[self.record.pk]) + '?fields=id',
+            {'comment': '更新'}, content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['comment'], '更新')
+
+
+def make_image(size=(2000, 1500), fmt='JPEG'):
+    buffer = BytesIO()
+    Image.new('RGB', size, (120, 160, 200)).save(buffer, format=fmt)
+    return SimpleUploadedFile('summit.jpg', buffer.getvalue(), content_type='image/jpeg')
+
+
+@override_settings(TASKS_EAGER=True)
+class ImageVariantTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        override = self.settings(MEDIA_ROOT=media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.user = User.objects.create_user('photographer', password='pass')
+        self.mountain = Mountain.objects.create(name='槍ヶ岳', prefecture='長野県', elevation=3180)
+
+    def test_variants_created_on_save(self):
+        record = ClimbRecord.objects.create(
+            user=self.user, mountain=self.mountain, climb_date=datetime.date(2024, 8, 1), image=make_image(),
+        )
+        for variant, bounds in IMAGE_VARIANTS.items():
+            name = variant_name(record.image.name, variant)
+            self.assertTrue(default_storage.exists(name))
+            with default_storage.open(name) as f:
+                width, height = Image.open(f).size
+            self.assertLessEqual(width, bounds[0])
+            self.assertLessEqual(height, bounds[1])
+
+    def test_webp_variants(self):
+        with self.settings(IMAGE_VARIANT_FORMAT='WEBP'):
+            record = ClimbRecord.objects.create(
+                user=self.user, mountain=self.mountain, climb_date=datetime.date(2024, 8, 1), image=make_image(),
+            )
+            record.refresh_from_db()
+            self.assertTrue(record.thumbnail_url.endswith('_thumb.webp'))
+            self.assertTrue(default_storage.exists(variant_name(record.image.name, 'thumb')))
+
+    def test_serializer_exposes_variant_urls(self):
+        record = ClimbRecord.objects.create(
+            user=self.user, mountain=self.mountain, climb_date=datetime.date(2024, 8, 1), image=make_image(),
+        )
+        response = self.client.get(reverse('climbrecord-detail', args=[record.pk]))
+        self.assertRegex(response.data['thumbnail'], r'^http://testserver/media/photos/[0-9a-f]{2}/variants/')
+        self.assertTrue(response.data['medium'].endswith('_medium.jpg'))
+
+    def test_original_until_variants_are_built(self):
+        with self.settings(TASKS_EAGER=False):
+            record = ClimbRecord.objects.create(
+                user=self.user, mountain=self.mountain, climb_date=datetime.date(2024, 8, 1), image=make_image(),
+            )
+        detail = reverse('climbrecord-detail', args=[record.pk])
+        page = reverse('mountain_detail', args=[self.mountain.pk])
+        # ワーカーが縮小画像を作るまでは元画像を出す
+        self.assertFalse(default_storage.exists(variant_name(record.image.name, 'thumb')))
+        self.assertEqual(record.thumbnail_url, record.image.url)
+        self.assertEqual(self.client.get(detail).data['medium'], f'http://testserver{record.image.url}')
+        response = self.client.get(page)
+        self.assertContains(response, f'src="{record.image.url}"')
+        self.assertNotContains(response, 'srcset=')
+
+        (queued, token), = claim('test', 10)
+        self.assertEqual(execute(queued.pk, token)[0], 'done')
+        record.refresh_from_db()
+        self.assertTrue(record.thumbnail_url.endswith('_thumb.jpg'))
+        self.assertTrue(self.client.get(detail).data['medium'].endswith('_medium.jpg'))
+        self.assertContains(self.client.get(page), f'srcset="{record.thumbnail_url} 320w')
+
+    def test_save_keeps_variants_ready(self):
+        record = ClimbRecord.objects.create(
+            user=self.user, mountain=self.mountain, climb_date=datetime.date(2024, 8, 1), image=make_image(),
+        )
+        # 作成時の (縮小画像ができる前の) 値を持ったまま保存しても、できたことを消さない
+        record.comment = '編集'
+        record.save()
+        record.refresh_from_db()
+        self.assertTrue(record.image_variants_ready)
+        # 写真を替えると、新しい写真の縮小画像ができるまで元画像に戻る
+        with self.settings(TASKS_EAGER=False):
+            record.image = make_image(size=(1200, 900))
+            record.save()
+        record.refresh_from_db()
+        self.assertFalse(record.image_variants_ready)
+        self.assertEqual(record.medium_url, record.image.url)
+
+    def test_backfill_command(self):
+        record = ClimbRecord.objects.create(
+            user=self.user, mountain=self.mountain, climb_date=datetime.date(2024, 8, 1), image=make_image(),
+        )
+        thumb = variant_name(record.image.name, 'thumb')
+        default_storage.delete(thumb)
+        call_command('build_image_variants', workers=1, stdout=StringIO())
+        self.assertTrue(default_storage.exists(thumb))
+
+
+class MountainSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.fuji = Mountain.objects.create(name='富士山', name_kana='ふじさん', prefecture='静岡県', elevation=3776)
+        cls.komagatake = Mountain.objects.create(name='木曽駒ヶ岳', name_kana='キソコマガタケ', prefecture='長野県', elevation=2956)
+        cls.kofuji = Mountain.objects.create(name='小富士山麓の丘', prefecture='山梨県', elevation=1200)
+        cls.other = Mountain.objects.create(name='ABC Peak', prefecture='北海道', elevation=1000)
+
+    def test_normalize(self):
+        self.assertEqual(normalize('ＡＢＣ ｺﾏｶﾞﾀｹ'), 'abc こまがたけ')
+
+    def test_kanji_hiragana_and_katakana(self):
+        self.assertEqual(list(search_mountains('富士')), [self.fuji, self.kofuji])
+        self.assertEqual(list(search_mountains('フジサン')), [self.fuji])
+        self.assertEqual(list(search_mountains('こまが')), [self.komagatake])
+
+    def test_width_and_case(self):
+        self.assertEqual(list(search_mountains('ａｂｃ')), [self.other])
+        self.assertEqual(list(search_mountains('駒ｹ岳')), [self.komagatake])
+
+    def test_prefecture_and_multiple_terms(self):
+        self.assertEqual(list(search_mountains('長野')), [self.komagatake])
+        self.assertEqual(list(search_mountains('富士 山梨')), [self.kofuji])
+
+    def test_index_follows_save_and_delete(self):
+        self.fuji.name = '不二山'
+        self.fuji.name_kana = ''
+        self.fuji.save()
+        self.assertEqual(list(search_mountains('富士')), [self.kofuji])
+        self.assertEqual(list(search_mountains('不二')), [self.fuji])
+        self.kofuji.delete()
+        self.assertFalse(MountainSearchToken.objects.filter(mountain_id=self.kofuji.pk).exists())
+
+    def setUp(self):
+        get_cache().clear()
+
+    def test_mountain_list_page(self):
+        response = self.client.get(reverse('mountain_list'), {'q': 'ふじ'})
+        self.assertEqual(list(response.context['mountains']), [self.fuji])
+
+    def test_api_search_is_ranked_and_paginated(self):
+        response = self.client.get(reverse('mountain-list'), {'q': '富士', 'page_size': 1})
+        names = [m['name'] for m in response.data['results']]
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            names.extend(m['name'] for m in response.data['results'])
+        self.assertEqual(names, ['富士山', '小富士山麓の丘'])
+
+    def test_api_search_passes_long_runs_of_equal_scores(self):
+        # 同じ長さの山名は関連度が同じになる。offset の上限 (1000) より多く続いても id で進める
+        index_mountains(Mountain.objects.bulk_create(
+            Mountain(name=f'山{i:04d}', prefecture='長野県', elevation=1000) for i in range(1100)
+        ))
+        seen = []
+        response = self.client.get(reverse('mountain-list'), {'q': '山', 'page_size': 200})
+        while True:
+            seen.extend(m['id'] for m in response.data['results'])
+            if not response.data['next']:
+                break
+            self.assertLess(len(seen), 2000, 'next が終わらない')
+            response = self.client.get(response.data['next'])
+        expected = search_mountains('山')
+        self.assertEqual(seen, [m.pk for m in expected])
+        self.assertEqual(len(seen), 1102)
+
+
+class MountainLocationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        rng = random.Random(0)
+        # 本州の中ほどにまとめ、日付変更線と北極の近くにも置く
+        points = [(rng.uniform(34, 37), rng.uniform(136, 140)) for _ in range(400)]
+        points += [(10.0, 179.95), (10.0, -179.95), (10.2, 179.5), (89.9, 0.0), (89.9, 180.0)]
+        Mountain.objects.bulk_create([
+            Mountain(name=f'山{i}', prefecture='長野県', elevation=1000 + i,
+                     latitude=lat, longitude=lon, geo_cell=cell_of(lat, lon))
+            for i, (lat, lon) in enumerate(points)
+        ])
+        Mountain.objects.create(name='位置なし', prefecture='長野県', elevation=500)
+
+    def brute_force(self, lat, lon, radius_km=None, limit=20):
+        found = sorted(
+            (haversine_km(lat, lon, m.latitude, m.longitude), m.pk)
+            for m in Mountain.objects.exclude(latitude=None)
+        )
+        return [pk for distance, pk in found if radius_km is None or distance <= radius_km][:limit]
+
+    def test_cell_follows_save(self):
+        mountain = Mountain.objects.create(name='富士山', prefecture='静岡県', elevation=3776,
+                                           latitude=35.3606, longitude=138.7274)
+        self.assertEqual(mountain.geo_cell, cell_of(35.3606, 138.7274))
+        mountain.latitude, mountain.longitude = 43.6633, 142.8542
+        mountain.save(update_fields=['latitude', 'longitude'])
+        mountain.refresh_from_db()
+        self.assertEqual(mountain.geo_cell, cell_of(43.6633, 142.8542))
+        mountain.latitude = None
+        mountain.save()
+        mountain.refresh_from_db()
+        self.assertIsNone(mountain.geo_cell)
+
+    def test_matches_brute_force(self):
+        rng = random.Random(1)
+        for _ in range(20):
+            lat, lon = rng.uniform(34, 37), rng.uniform(136, 140)
+            for radius_km in (5, 30, None):
+                with self.subTest(lat=lat, lon=lon, radius_km=radius_km):
+                    found = [m.pk for m in nearby(Mountain.objects.all(), lat, lon, radius_km)]
+                    self.assertEqual(found, self.brute_force(lat, lon, radius_km))
+
+    def test_antimeridian_and_pole(self):
+        for lat, lon in ((10.0, 179.99), (10.0, -179.99), (89.95, 90.0)):
+            with self.subTest(lat=lat, lon=lon):
+                found = [m.pk for m in nearby(Mountain.objects.all(), lat, lon, 100, limit=3)]
+                self.assertEqual(found, self.brute_force(lat, lon, 100, limit=3))
+                self.assertTrue(found)
+
+    def test_api_radius(self):
+        response = self.client.get(reverse('mountain-nearby'), {'lat': 35.5, 'lon': 138, 'radius': 20, 'limit': 5})
+        self.assertEqual(response.status_code, 200)
+        results = response.data['results']
+        self.assertEqual([m['id'] for m in results], self.brute_force(35.5, 138, 20, limit=5))
+        distances = [m['distance_km'] for m in results]
+        self.assertEqual(distances, sorted(distances))
+        self.assertLessEqual(distances[-1], 20)
+
+    def test_api_bbox(self):
+        response = self.client.get(reverse('mountain-nearby'), {'bbox': '179,9,-179,11', 'limit': 10})
+        names = [m['name'] for m in response.data['results']]
+        # 標高の高い順
+        self.assertEqual(names, ['山402', '山401', '山400'])
+        self.assertIsNone(response.data['results'][0]['distance_km'])
+
+    def test_api_bbox_up_to_antimeridian(self):
+        # 東端がちょうど 180 度でも最後の列まで探す (行数は MAX_RANGES 以下)
+        response = self.client.get(reverse('mountain-nearby'), {'bbox': '170,9,180,11', 'limit': 10})
+        self.assertEqual([m['name'] for m in response.data['results']], ['山402', '山400'])
+        found = within_box(Mountain.objects.all(), 9, 170, 11, 180)
+        self.assertEqual(sorted(m.name for m in found), ['山400', '山402'])
+
+    def test_api_rejects_bad_params(self):
+        url = reverse('mountain-nearby')
+        for params in ({}, {'lat': 35}, {'lat': 95, 'lon': 0}, {'lat': 'x', 'lon': 0},
+                       {'bbox': '1,2,3'}, {'radius': 10, 'bbox': '0,0,1,1'}, {'lat': 35, 'lon': 138, 'limit': 0}):
+            with self.subTest(params=params):
+                self.assertEqual(self.client.get(url, params).status_code, 400)
+
+
+class MountainAggregateTests(TestCase):
+    def setUp(self):
+        get_cache().clear()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        override = self.settings(MEDIA_ROOT=media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.alice = User.objects.create_user('alice', password='pass')
+        self.bob = User.objects.create_user('bob', password='pass')
+        self.fuji = Mountain.objects.create(name='富士山', prefecture='静岡県', elevation=3776)
+        self.takao = Mountain.objects.create(name='高尾山', prefecture='東京都', elevation=599)
+
+    def assertStats(self, mountain, records, climbers, last, photo=''):
+        mountain.refresh_from_db()
+        self.assertEqual(
+            (mountain.record_count, mountain.climber_count, mountain.last_climbed_on, mountain.latest_photo.name or ''),
+            (records, climbers, last, photo),
+        )
+        # 差分更新の結果は全件再計算と一致する
+        self.assertEqual(refresh_mountain_stats(Mountain.objects.filter(pk=mountain.pk)), [])
+
+    def climb(self, user, mountain, date, **kwargs):
+        return ClimbRecord.objects.create(user=user, mountain=mountain, climb_date=date, **kwargs)
+
+    def test_create_update_delete(self):
+        d1, d2, d3 = datetime.date(2023, 7, 1), datetime.date(2024, 7, 1), datetime.date(2024, 8, 1)
+        first = self.climb(self.alice, self.fuji, d1, image=make_image())
+        second = self.climb(self.alice, self.fuji, d2)
+        self.assertStats(self.fuji, 2, 1, d2, first.image.name)
+
+        third = self.climb(self.bob, self.fuji, d3, image=make_image())
+        self.assertStats(self.fuji, 3, 2, d3, third.image.name)
+
+        third.climb_date = d1 - datetime.timedelta(days=1)
+        third.save()
+        self.assertStats(self.fuji, 3, 2, d2, first.image.name)
+
+        second.mountain = self.takao
+        second.save()
+        self.assertStats(self.fuji, 2, 2, d1, first.image.name)
+        self.assertStats(self.takao, 1, 1, d2)
+
+        first.delete()
+        self.assertStats(self.fuji, 1, 1, third.climb_date, third.image.name)
+
+    def test_user_cascade_delete(self):
+        self.climb(self.alice, self.fuji, datetime.date(2024, 1, 1))
+        self.climb(self.bob, self.fuji, datetime.date(2024, 2, 1))
+        self.bob.delete()
+        self.assertStats(self.fuji, 1, 1, datetime.date(2024, 1, 1))
+        self.fuji.delete()
+        self.assertFalse(ClimbRecord.objects.exists())
+
+    def test_mountain_edit_keeps_stats(self):
+        self.climb(self.alice, self.fuji, datetime.date(2024, 1, 1))
+        stale = Mountain.objects.get(pk=self.fuji.pk)
+        self.climb(self.bob, self.fuji, datetime.date(2024, 2, 1))
+        stale.elevation = 3777
+        stale.save()
+        self.assertStats(self.fuji, 2, 2, datetime.date(2024, 2, 1))
+
+    def test_reconcile_command(self):
+        self.climb(self.alice, self.fuji, datetime.date(2024, 1, 1))
+        make_records(self.takao, [self.alice, self.bob], 3)
+        out = StringIO()
+        call_command('reconcile_mountain_stats', stdout=out)
+        self.assertIn(f'ID {self.takao.pk}', out.getvalue())
+        self.assertNotIn(f'ID {self.fuji.pk}', out.getvalue())
+        self.assertStats(self.takao, 3, 2, datetime.date(2024, 1, 3))
+
+    def test_sorting(self):
+        make_records(self.takao, [self.alice, self.bob], 3)
+        refresh_mountain_stats()
+        response = self.client.get(reverse('mountain_list'), {'sort': 'popular'})
+        self.assertEqual(list(response.context['mountains']), [self.takao, self.fuji])
+        response = self.client.get(reverse('mountain-list'), {'ordering': '-record_count'})
+        self.assertEqual([m['name'] for m in response.data['results']], ['高尾山', '富士山'])
+        self.assertEqual(response.data['results'][0]['climber_count'], 2)
+
+
+class BulkImportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('importer', password='pass')
+        cls.mountain = Mountain.objects.create(name='白馬岳', prefecture='長野県', elevation=2932)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        self.url = reverse('climbrecord-bulk-create')
+
+    def test_json_array_with_errors(self):
+        rows = [
+            {'mountain': self.mountain.pk, 'climb_date': '2024-07-01', 'comment': '晴れ'},
+            {'mountain': 9999, 'climb_date': '2024-07-02'},
+            {'mountain': str(self.mountain.pk), 'climb_date': 'not-a-date'},
+            {'mountain': str(self.mountain.pk), 'climb_date': '2024-07-03'},
+        ]
+        response = self.client.post(self.url, rows, content_type='application/json')
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual(response.data['created'], 2)
+        self.assertEqual([e['row'] for e in response.data['errors']], [1, 2])
+        self.assertIn('mountain', response.data['errors'][0]['errors'])
+        self.assertEqual(ClimbRecord.objects.filter(user=self.user).count(), 2)
+        self.mountain.refresh_from_db()
+        self.assertEqual(self.mountain.record_count, 2)
+        self.assertEqual(self.mountain.last_climbed_on, datetime.date(2024, 7, 3))
+
+    def test_ndjson_in_chunks(self):
+        body = ''.join(
+            json.dumps({'mountain': self.mountain.pk, 'climb_date': f'2024-01-{d:02d}'}) + '\n'
+            for d in range(1, 26)
+        )
+        with self.settings(RECORD_IMPORT_CHUNK_SIZE=10):
+            response = self.client.post(self.url, body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data, {'created': 25, 'errors': []})
+
+    def test_ndjson_unreadable_lines_after_committed_chunks(self):
+        # 前のチャンクを登録したあとで読めない行があっても止めず、その行だけをエラーにする
+        lines = [
+            json.dumps({'mountain': self.mountain.pk, 'climb_date': f'2024-01-{d:02d}'}).encode()
+            for d in range(1, 26)
+        ]
+        lines[14] = b'{"mountain": '
+        lines[19] = '{"comment": "壊れた"}'.encode('shift_jis')
+        with self.settings(RECORD_IMPORT_CHUNK_SIZE=10):
+            response = self.client.post(self.url, b'\n'.join(lines), content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual(response.data['created'], 23)
+        self.assertEqual([e['row'] for e in response.data['errors']], [14, 19])
+        self.assertIn('15 行目', response.data['errors'][0]['errors']['non_field_errors'][0])
+        self.assertEqual(ClimbRecord.objects.filter(user=self.user).count(), 23)
+
+    def test_query_count_does_not_grow_per_row(self):
+        rows = [{'mountain': self.mountain.pk, 'climb_date': '2024-07-01'}] * 200
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(self.url, rows, content_type='application/json')
+        self.assertLess(len(queries), 20)
+
+    def test_requires_login(self):
+        self.client.logout()
+        response = self.client.post(self.url, [], content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+
+
+class RecordExportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='pass')
+        cls.bob = User.objects.create_user('bob', password='pass')
+        cls.fuji = Mountain.objects.create(name='富士山', prefecture='静岡県', elevation=3776)
+        cls.takao = Mountain.objects.create(name='高尾山', prefecture='東京都', elevation=599)
+        make_records(cls.fuji, [cls.alice, cls.bob], 10)
+        make_records(cls.takao, [cls.alice], 5)
+
+    def export(self, **params):
+        response = self.client.get(reverse('climbrecord-export'), params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode('utf-8')
+
+    def test_ndjson(self):
+        rows = [json.loads(line) for line in self.export().splitlines()]
+        self.assertEqual(len(rows), 15)
+        self.assertEqual(rows[0]['user'], 'alice')
+        self.assertEqual(rows[0]['mountain_name'], '富士山')
+
+    def test_csv_with_filters(self):
+        lines = self.export(fmt='csv', user='alice', mountain=self.fuji.pk, since='2024-01-03', until='2024-01-07').splitlines()
+        self.assertEqual(lines[0].split(',')[:3], ['id', 'user', 'mountain'])
+        self.assertEqual([line.split(',')[4] for line in lines[1:]], ['2024-01-03', '2024-01-05', '2024-01-07'])
+
+    def test_query_count_is_constant(self):
+        with self.assertNumQueries(1):
+            self.export()
+
+    def test_invalid_filter(self):
+        response = self.client.get(reverse('climbrecord-export'), {'since': '2024-13-01'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_list_uses_same_filters(self):
+        response = self.client.get(reverse('climbrecord-list'), {'mountain': self.takao.pk})
+        self.assertEqual(len(response.data['results']), 5)
+
+
+class ConditionalGetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('alice', password='pass')
+        cls.mountain = Mountain.objects.create(name='富士山', prefecture='静岡県', elevation=3776)
+        make_records(cls.mountain, [cls.user], 3)
+
+    def setUp(self):
+        get_cache().clear()
+
+    def assertRevalidates(self, url, num_queries=1):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        # 一覧は ETag だけで検証する
+        if resolve(url).url_name.endswith('-list'):
+            self.assertNotIn('Last-Modified', response)
+        else:
+            self.assertIn('Last-Modified', response)
+        etag = response['ETag']
+        # 304 のときは検証値の問い合わせ (1クエリ) だけで済む
+        with self.assertNumQueries(num_queries):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        return etag
+
+    def test_record_list_and_detail(self):
+        record = ClimbRecord.objects.first()
+        list_etag = self.assertRevalidates(reverse('climbrecord-list'))
+        detail_etag = self.assertRevalidates(reverse('climbrecord-detail', args=[record.pk]))
+
+        record.comment = '更新'
+        record.save()
+        response = self.client.get(reverse('climbrecord-list'), HTTP_IF_NONE_MATCH=list_etag)
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(reverse('climbrecord-detail', args=[record.pk]), HTTP_IF_NONE_MATCH=detail_etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_delete_changes_list_etag(self):
+        etag = self.assertRevalidates(reverse('climbrecord-list'))
+        ClimbRecord.objects.order_by('updated_at').first().delete()
+        response = self.client.get(reverse('climbrecord-list'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_list_ignores_if_modified_since(self):
+        # 削除では更新日時の最大値が変わらないので、一覧を If-Modified-Since で 304 にしない
+        record = ClimbRecord.objects.first()
+        since = http_date(timezone.now().timestamp() + 60)
+        record.delete()
+        for url in (reverse('climbrecord-list'), reverse('mountain-list')):
+            response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=since)
+            self.assertEqual(response.status_code, 200, url)
+        response = self.client.get(reverse('mountain-detail', args=[self.mountain.pk]), HTTP_IF_MODIFIED_SINCE=since)
+        self.assertEqual(response.status_code, 304)
+
+    def test_mountain_list_and_detail(self):
+        # 山の応答はキャッシュ済みの検証値で判定するのでクエリは不要
+        list_etag = self.assertRevalidates(reverse('mountain-list'), num_queries=0)
+        self.assertRevalidates(reverse('mountain-detail', args=[self.mountain.pk]), num_queries=0)
+        # 記録の追加で集計値が変われば山の ETag も変わる
+        ClimbRecord.objects.create(user=self.user, mountain=self.mountain, climb_date=datetime.date(2025, 1, 1))
+        response = self.client.get(reverse('mountain-list'), HTTP_IF_NONE_MATCH=list_etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_missing_object_is_404(self):
+        response = self.client.get(reverse('climbrecord-detail', args=[9999]))
+        self.assertEqual(response.status_code, 404)
+
+
+class MountainCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('alice', password='pass', is_staff=True)
+        cls.fuji = Mountain.objects.create(name='富士山', prefecture='静岡県', elevation=3776)
+        cls.takao = Mountain.objects.create(name='高尾山', prefecture='東京都', elevation=599)
+
+    def setUp(self):
+        get_cache().clear()
+
+    def test_list_page_is_served_from_cache(self):
+        self.client.get(reverse('mountain_list'))
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('mountain_list'))
+        self.assertContains(response, '富士山')
+
+    def test_api_hit_after_miss(self):
+        response = self.client.get(reverse('mountain-list'))
+        self.assertEqual(response['X-Cache'], 'MISS')
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('mountain-list'))
+        self.assertEqual(response['X-Cache'], 'HIT')
+        self.assertEqual([m['name'] for m in response.data['results']], ['富士山', '高尾山'])
+
+    def test_edit_and_delete_invalidate(self):
+        self.client.login(username='alice', password='pass')
+        self.client.get(reverse('mountain_list'))
+        self.client.get(reverse('mountain-detail', args=[self.fuji.pk]))
+        self.client.post(reverse('mountain_edit', args=[self.fuji.pk]), {
+            'name': '不二山', 'name_kana': '', 'prefecture': '静岡県', 'elevation': 3776,
+        })
+        self.assertContains(self.client.get(reverse('mountain_list')), '不二山')
+        response = self.client.get(reverse('mountain-detail', args=[self.fuji.pk]))
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.data['name'], '不二山')
+
+        self.client.post(reverse('mountain_delete', args=[self.takao.pk]))
+        self.assertNotContains(self.client.get(reverse('mountain_list')), '高尾山')
+
+    def test_record_changes_invalidate_aggregates(self):
+        self.client.get(reverse('mountain-detail', args=[self.takao.pk]))
+        ClimbRecord.objects.create(user=self.user, mountain=self.takao, climb_date=datetime.date(2025, 1, 1))
+        response = self.client.get(reverse('mountain-detail', args=[self.takao.pk]))
+        self.assertEqual(response.data['record_count'], 1)
+
+    def test_other_mountain_stays_cached(self):
+        self.client.get(reverse('mountain-detail', args=[self.fuji.pk]))
+        self.takao.save()
+        response = self.client.get(reverse('mountain-detail', args=[self.fuji.pk]))
+        self.assertEqual(response['X-Cache'], 'HIT')
+
+    def test_stats(self):
+        reset_stats()
+        key = make_key('mountains', 'test')
+        self.assertIsNone(get_cache().get(key))
+        self.client.get(reverse('mountain_list'))
+        self.client.get(reverse('mountain_list'))
+        self.assertEqual(stats(), {'hits': 1, 'misses': 1, 'hit_rate': 0.5})
+        out = StringIO()
+        call_command('cache_stats', '--reset', stdout=out)
+        self.assertIn('50.0%', out.getvalue())
+        self.assertEqual(stats()['hits'], 0)
+
+
+class FragmentCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('owner', password='pass')
+        cls.other = User.objects.create_user('other', password='pass')
+        cls.mountain = Mountain.objects.create(name='富士山', prefecture='静岡県', elevation=3776)
+        make_records(cls.mountain, [cls.owner, cls.other], 4)
+        cls.record = ClimbRecord.objects.filter(user=cls.owner).first()
+
+    def setUp(self):
+        get_cache().clear()
+        self.url = reverse('mountain_detail', args=[self.mountain.pk])
+
+    def test_records_are_served_from_cache(self):
+        self.client.get(self.url)
+        # 2回目は記録を読まない (山 + 件数 + 最新の更新日時)
+        with self.assertNumQueries(3):
+            response = self.client.get(self.url)
+        self.assertContains(response, self.record.comment)
+
+    def test_changes_show_without_invalidation(self):
+        self.client.get(self.url)
+        self.record.comment = '書き換えた感想'
+        self.record.save()
+        self.assertContains(self.client.get(self.url), '書き換えた感想')
+        self.record.delete()
+        self.assertNotContains(self.client.get(self.url), '書き換えた感想')
+
+    def test_owner_buttons_follow_viewer(self):
+        edit = reverse('record_edit', args=[self.record.pk])
+        self.client.force_login(self.owner)
+        self.assertContains(self.client.get(self.url), edit)
+        for user in (self.other, None):
+            if user:
+                self.client.force_login(user)
+            else:
+                self.client.logout()
+            self.assertNotContains(self.client.get(self.url), edit)
+        self.client.force_login(self.owner)
+        self.assertContains(self.client.get(self.url), edit)
+
+    def test_mypage_shows_new_record(self):
+        self.client.force_login(self.owner)
+        self.client.get(reverse('mypage'))
+        ClimbRecord.objects.create(user=self.owner, mountain=self.mountain, climb_date=datetime.date(2030, 1, 1), comment='新しい記録')
+        self.assertContains(self.client.get(reverse('mypage')), '新しい記録')
+
+
+class SQLiteSettingsTests(TestCase):
+    def test_pragmas_and_transaction_mode(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], 5000)
+            cursor.execute('PRAGMA synchronous')
+            # 1 = NORMAL
+            self.assertEqual(cursor.fetchone()[0], 1)
+        self.assertEqual(connection.transaction_mode, 'IMMEDIATE')
+        self.assertGreater(connection.settings_dict['CONN_MAX_AGE'], 0)
+
+
+class QueryPlanTests(TestCase):
+    """よく使う記録の問い合わせが索引を使い、表の全件走査や一時ソートにならないことを確認する"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('alice', password='pass')
+        cls.mountain = Mountain.objects.create(name='富士山', prefecture='静岡県', elevation=3776)
+        make_records(cls.mountain, [cls.user], 30)
+
+    def assertUsesIndexes(self, url, params=None):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url, params)
+            if response.streaming:
+                b''.join(response.streaming_content)
+        self.assertEqual(response.status_code, 200)
+        plans = []
+        for query in ctx.captured_queries:
+            if not query['sql'].startswith('SELECT') or 'paplib_climbrecord' not in query['sql']:
+                continue
+            with connection.cursor() as cursor:
+                cursor.execute('EXPLAIN QUERY PLAN ' + query['sql'])
+                details = [row[-1] for row in cursor.fetchall()]
+            plans.append(details)
+            for detail in details:
+                self.assertNotEqual(detail, 'SCAN paplib_climbrecord', f'全件走査: {query["sql"]}')
+                self.assertNotIn('TEMP B-TREE', detail, f'一時ソート: {query["sql"]}')
+        self.assertTrue(plans)
+        return response
+
+    def test_mountain_detail(self):
+        self.assertUsesIndexes(reverse('mountain_detail', args=[self.mountain.pk]))
+
+    def test_mypage(self):
+        self.client.login(username='alice', password='pass')
+        # 統計 (paplib.stats) の GROUP BY はキャッシュがないときだけなので、キャッシュした状態で確かめる
+        get_cache().clear()
+        self.client.get(reverse('mypage'))
+        self.assertUsesIndexes(reverse('mypage'))
+
+    def test_api_list_and_filters(self):
+        url = reverse('climbrecord-list')
+        self.assertUsesIndexes(url)
+        self.assertUsesIndexes(url, {'mountain': self.mountain.pk})
+        self.assertUsesIndexes(url, {'user': 'alice'})
+        self.assertUsesIndexes(url, {'since': '2024-01-05', 'until': '2024-01-20'})
+        self.assertUsesIndexes(url, {'updated_since': '2024-01-01'})
+
+    def test_api_next_pages(self):
+        for params in ({'page_size': 5}, {'page_size': 5, 'updated_since': '2024-01-01'}):
+            response = self.assertUsesIndexes(reverse('climbrecord-list'), params)
+            self.assertUsesIndexes(response.data['next'])
+
+    def test_updated_since_is_ordered_by_update(self):
+        first, second = ClimbRecord.objects.order_by('id')[:2]
+        second.save()
+        first.save()
+        response = self.client.get(reverse('climbrecord-list'), {'updated_since': '2024-01-01'})
+        self.assertEqual([r['id'] for r in response.data['results']][-2:], [second.pk, first.pk])
+
+
+class SyntheticDataTests(TestCase):
+    def seed(self, **options):
+        call_command('seed_data', mountains=60, users=5, records=300, batch_size=100, stdout=StringIO(), **options)
+        return list(ClimbRecord.objects.order_by('id').values_list(
+            'user__username', 'mountain__name', 'mountain__prefecture', 'climb_date', 'comment',
+        ))
+
+    def test_seed_is_reproducible(self):
+        first = self.seed()
+        self.assertEqual(len(first), 300)
+        self.assertEqual(Mountain.objects.values('prefecture').distinct().count(), 47)
+        # 人気の偏り: 最も登られた山に平均より明らかに多くの記録が集まる
+        self.assertGreater(Mountain.objects.order_by('-record_count').first().record_count, 300 / 60 * 5)
+        self.assertEqual(sum(Mountain.objects.values_list('record_count', flat=True)), 300)
+
+        ClimbRecord.objects.all().delete()
+        Mountain.objects.all().delete()
+        User.objects.all().delete()
+        self.assertEqual(self.seed(), first)
+
+    def test_seeded_photos_have_variants(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        with self.settings(MEDIA_ROOT=media_root):
+            self.seed(photos=2, photo_ratio=0.5)
+        with_photo = ClimbRecord.objects.exclude(image='')
+        self.assertTrue(with_photo.exists())
+        self.assertFalse(with_photo.filter(image_variants_ready=False).exists())
+        self.assertFalse(ClimbRecord.objects.filter(image='', image_variants_ready=True).exists())
+
+    def test_bench_endpoints_writes_json(self):
+        self.seed()
+        User.objects.filter(pk=User.objects.order_by('id').values('pk')[:1]).update(is_staff=True)
+        output = tempfile.NamedTemporaryFile(suffix='.json', delete=False).name
+        self.addCleanup(os.remove, output)
+        out = StringIO()
+        call_command('bench_endpoints', repeat=2, warmup=0, output=output, stdout=out)
+        with open(output, encoding='utf-8') as f:
+            report = json.load(f)
+        endpoints = report['endpoints']
+        for name in ('mountain_list', 'mountain_detail', 'mypage', 'record_edit',
+                     'mountain-list', 'mountain-detail', 'climbrecord-list', 'climbrecord-detail',
+                     'climbrecord-export', 'user-list'):
+            self.assertIn(name, endpoints)
+        self.assertEqual(endpoints['mountain_detail']['status'], 200)
+        # 管理者用の URL は管理者で測り、エラーの応答は測らない
+        for name in ('mountain_edit', 'mountain_delete', 'user-list', 'user-detail'):
+            self.assertEqual((endpoints[name]['status'], endpoints[name]['login']), (200, 'staff'), name)
+        self.assertEqual(endpoints['mypage']['login'], 'user')
+        self.assertTrue(all(200 <= e['status'] < 300 for e in endpoints.values()))
+        self.assertEqual(report['failed'], {})
+        # 近くの山の検索は計測用の山の位置で測る (中心からと範囲の2通り)
+        self.assertEqual(set(endpoints['mountain-nearby']['params']), {'lat', 'lon'})
+        self.assertEqual(set(endpoints['mountain-nearby:bbox']['params']), {'bbox'})
+        self.assertEqual(set(endpoints['climbrecord-list']['latency_ms']), {'mean', 'p50', 'p90', 'p95', 'p99', 'max'})
+        self.assertGreater(endpoints['climbrecord-list']['queries']['max'], 0)
+        self.assertGreater(endpoints['climbrecord-list']['peak_memory_kib'], 0)
+        self.assertEqual(report['dataset']['records'], 300)
+        # POST しか受け付けない URL は計測しない
+        self.assertNotIn('climbrecord-bulk-create', endpoints)
+
+        call_command('bench_endpoints', repeat=1, warmup=0, only=['mountain_list'], output=output,
+                     compare=output, stdout=out)
+        self.assertIn('前回 → 今回', out.getvalue())
+
+        call_command('bench_endpoints', repeat=1, warmup=0, anonymous=True, only=['mypage', 'user-list'],
+                     output=output, stdout=out)
+        with open(output, encoding='utf-8') as f:
+            report = json.load(f)
+        self.assertEqual(report['endpoints'], {})
+        self.assertEqual(report['failed'], {'mypage': 302, 'user-list': 403})
+
+
+class RequestProfilingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('alice', password='pass')
+        cls.mountain = Mountain.objects.create(name='富士山', prefecture='静岡県', elevation=3776)
+        make_records(cls.mountain, [cls.user], 3)
+        ClimbRecord.objects.update(image='photos/summit.jpg', image_variants_ready=True)
+
+    def setUp(self):
+        # 記録の一覧がフラグメントキャッシュから出るとクエリ数が変わる
+        get_cache().clear()
+
+    def test_server_timing(self):
+        url = reverse('mountain_detail', args=[self.mountain.pk])
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        metrics = {item.split(';')[0]: item for item in response['Server-Timing'].split(', ')}
+        self.assertEqual(set(metrics), {'total', 'view', 'sql', 'tpl', 'img'})
+        self.assertIn(f'desc="{len(ctx.captured_queries)} queries"', metrics['sql'])
+        self.assertNotEqual(metrics['tpl'], 'tpl;dur=0.0')
+
+    def test_template_timer_is_installed_at_startup(self):
+        self.assertIs(Template.render, profiling._timed_render)
+        # ミドルウェアを作っても Template.render は置き換えない
+        with mock.patch.object(Template, 'render', profiling._original_render):
+            profiling.RequestProfilingMiddleware(lambda request: HttpResponse())
+            self.assertIs(Template.render, profiling._original_render)
+        with self.settings(PAPLIB_PROFILE_SAMPLE_RATE=0):
+            self.assertFalse(profiling.enabled())
+        with self.settings(MIDDLEWARE=[m for m in settings.MIDDLEWARE if 'profiling' not in m]):
+            self.assertFalse(profiling.enabled())
+
+    def test_sampling(self):
+        with self.settings(PAPLIB_PROFILE_SAMPLE_RATE=0):
+            response = self.client.get(reverse('climbrecord-list'))
+        self.assertNotIn('Server-Timing', response)
+
+    def test_slow_log(self):
+        with self.settings(PAPLIB_SLOW_REQUEST_MS=0, PAPLIB_SLOW_QUERY_COUNT=2):
+            with self.assertLogs('paplib.slow_requests', 'WARNING') as logs:
+                self.client.get(reverse('mountain_detail', args=[self.mountain.pk]))
+        entry = json.loads(logs.records[0].getMessage())
+        self.assertEqual(entry['path'], reverse('mountain_detail', args=[self.mountain.pk]))
+        self.assertTrue(entry['sampled'])
+        self.assertGreater(entry['queries'], 2)
+        self.assertEqual(len(entry['worst_queries']), 2)
+        self.assertGreaterEqual(entry['worst_queries'][0]['ms'], entry['worst_queries'][1]['ms'])
+
+    def test_unsampled_slow_request_logs_total_only(self):
+        with self.settings(PAPLIB_PROFILE_SAMPLE_RATE=0, PAPLIB_SLOW_REQUEST_MS=0):
+            with self.assertLogs('paplib.slow_requests', 'WARNING') as logs:
+                self.client.get(reverse('mountain_list'))
+        entry = json.loads(logs.records[0].getMessage())
+        self.assertFalse(entry['sampled'])
+        self.assertNotIn('queries', entry)
+
+
+@override_settings(ROOT_URLCONF='app.urls_async')
+class AsyncViewTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('alice', password='pass')
+        cls.other = User.objects.create_user('bob', password='pass')
+        cls.fuji = Mountain.objects.create(name='富士山', prefecture='静岡県', elevation=3776)
+        cls.takao = Mountain.objects.create(name='高尾山', prefecture='東京都', elevation=599)
+        make_records(cls.fuji, [cls.user, cls.other], 25)
+        make_records(cls.takao, [cls.user], 3)
+
+    def setUp(self):
+        get_cache().clear()
+
+    def assertSameAsSync(self, url, params=None):
+        async_response = async_to_sync(self.async_client.get)(url, params or {})
+        with self.settings(ROOT_URLCONF='app.urls'):
+            get_cache().clear()
+            sync_response = self.client.get(url, params or {})
+        self.assertEqual(async_response.status_code, sync_response.status_code)
+        self.assertEqual(async_response.json(), sync_response.json())
+        self.assertEqual(async_response.get('ETag'), sync_response.get('ETag'))
+        return async_response
+
+    def test_views_are_async(self):
+        for name, args in (('mountain_list', []), ('mountain_detail', [1]),
+                           ('climbrecord-list', []), ('climbrecord-detail', [1])):
+            match = resolve(reverse(name, args=args))
+            self.assertTrue(iscoroutinefunction(match.func), name)
+
+    async def test_mountain_list(self):
+        response = await self.async_client.get(reverse('mountain_list'), {'sort': 'popular'})
+        self.assertEqual(response.status_code, 200)
+        content = response.content.decode()
+        self.assertLess(content.index('富士山'), content.index('高尾山'))
+        self.assertIn('Server-Timing', response)
+
+    async def test_mountain_detail(self):
+        await self.async_client.aforce_login(self.user)
+        url = reverse('mountain_detail', args=[self.fuji.pk])
+        response = await self.async_client.get(url, {'page': 3})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['page_obj'].number, 3)
+        self.assertEqual(len(response.context['records']), 5)
+        self.assertContains(response, '編集')
+        response = await self.async_client.get(url, {'page': 'x'})
+        self.assertEqual(response.context['page_obj'].number, 1)
+        response = await self.async_client.get(reverse('mountain_detail', args=[9999]))
+        self.assertEqual(response.status_code, 404)
+
+    def test_mountain_detail_with_db_cache(self):
+        # {% cache %} がキャッシュの表を読んでも、イベントループの中で同期の ORM を呼ばない
+        db_cache = {'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'paplib_test_cache'}}
+        with self.settings(CACHES=db_cache):
+            call_command('createcachetable', verbosity=0)
+            url = reverse('mountain_detail', args=[self.fuji.pk])
+            for _ in range(2):
+                response = async_to_sync(self.async_client.get)(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertContains(response, '記録 24')
+
+    async def test_post_uses_sync_view(self):
+        await self.async_client.aforce_login(self.user)
+        url = reverse('mountain_detail', args=[self.takao.pk])
+        response = await self.async_client.post(url, {'climb_date': '2025-05-01', 'comment': '非同期'})
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(await ClimbRecord.objects.filter(comment='非同期').aexists())
+
+    def test_record_list_matches_sync_api(self):
+        url = reverse('climbrecord-list')
+        response = self.assertSameAsSync(url, {'page_size': 7})
+        # 次のページと前のページのリンクも同期の API と同じ
+        next_response = self.assertSameAsSync(response.json()['next'])
+        self.assertSameAsSync(next_response.json()['previous'])
+        self.assertSameAsSync(url, {'mountain': self.takao.pk})
+        self.assertSameAsSync(url, {'user': 'bob', 'since': '2024-01-05'})
+        self.assertSameAsSync(url, {'updated_since': '2024-01-01', 'page_size': 5})
+        self.assertSameAsSync(url, {'since': 'x'})
+        self.assertSameAsSync(url, {'cursor': 'broken'})
+        self.assertSameAsSync(url, {'fields': 'id,user,mountain', 'expand': 'user,mountain'})
+        self.assertSameAsSync(url, {'fields': 'nope'})
+
+    async def test_record_list_passes_long_runs_of_ties(self):
+        # 同期の API と同じキーセットのカーソルで、同じ登山日が offset の上限 (1000) より多く続いても進める
+        await ClimbRecord.objects.abulk_create(
+            ClimbRecord(user=self.user, mountain=self.takao, climb_date=datetime.date(2024, 6, 1))
+            for _ in range(1100)
+        )
+        seen = []
+        url, params = reverse('climbrecord-list'), {'page_size': 200}
+        while url:
+            self.assertLess(len(seen), 2000, 'next が終わらない')
+            data = (await self.async_client.get(url, params)).json()
+            seen.extend(r['id'] for r in data['results'])
+            url, params = data['next'], None
+        self.assertEqual(len(seen), len(set(seen)))
+        self.assertEqual(len(seen), await ClimbRecord.objects.acount())
+
+    def test_record_detail_matches_sync_api(self):
+        record = ClimbRecord.objects.first()
+        self.assertSameAsSync(reverse('climbrecord-detail', args=[record.pk]))
+        self.assertSameAsSync(reverse('climbrecord-detail', args=[record.pk]), {'fields': 'id', 'expand': 'mountain'})
+        self.assertSameAsSync(reverse('climbrecord-detail', args=[9999]))
+
+    async def test_conditional_get(self):
+        url = reverse('climbrecord-list')
+        response = await self.async_client.get(url)
+        response = await self.async_client.get(url, headers={'if-none-match': response['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    async def test_writes_and_browsable_api_use_drf(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.post(
+            reverse('climbrecord-list'),
+            {'mountain': self.takao.pk, 'climb_date': '2025-05-01', 'comment': 'API'},
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 201)
+        response = await self.async_client.get(reverse('climbrecord-list'), headers={'accept': 'text/html'})
+        self.assertContains(response, 'Django REST framework')
+
+
+class AsgiBenchmarkTests(TransactionTestCase):
+    # ワーカーのスレッドが別の接続で読めるよう、データをコミットしておく
+    def test_bench_asgi(self):
+        mountain = Mountain.objects.create(name='富士山', prefecture='静岡県', elevation=3776)
+        make_records(mountain, [User.objects.create_user('alice', password='pass')], 3)
+        out = StringIO()
+        call_command('bench_asgi', concurrency=[1, 3], requests=6, client_delay=0, wsgi_threads=2, stdout=out)
+        lines = [line for line in out.getvalue().splitlines() if line.startswith(('wsgi', 'asgi'))]
+        self.assertEqual(len(lines), 4)
+        for line in lines:
+            self.assertTrue(line.endswith('エラー 0'), line)
+
+
+# パスワードの確認はどれも slow log に載るほど遅いので、ログを書かない
+@override_settings(PAPLIB_SLOW_REQUEST_MS=float('inf'))
+class TokenAuthTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('alice', password='pass')
+        cls.mountain = Mountain.objects.create(name='高尾山', prefecture='東京都', elevation=599)
+        cls.record = ClimbRecord.objects.create(
+            user=cls.user, mountain=cls.mountain, climb_date=datetime.date(2024, 1, 1),
+        )
+
+    def login(self, password='pass'):
+        return self.client.post(reverse('api-token'), {'username': 'alice', 'password': password})
+
+    def patch(self, token):
+        return self.client.patch(
+            reverse('climbrecord-detail', args=[self.record.pk]), {'comment': 'トークン'},
+            content_type='application/json', headers={'authorization': f'Token {token}'},
+        )
+
+    def test_login_and_write(self):
+        response = self.login()
+        self.assertEqual(response.status_code, 200)
+        token = response.json()['token']
+        self.assertIn('expires', response.json())
+        # 有効な間は同じトークンを返す
+        self.assertEqual(self.login().json()['token'], token)
+        # トークンの確認ではパスワードのハッシュを計算しない
+        with mock.patch('django.contrib.auth.hashers.PBKDF2PasswordHasher.verify') as verify:
+            self.assertEqual(self.patch(token).status_code, 200)
+        verify.assert_not_called()
+        self.record.refresh_from_db()
+        self.assertEqual(self.record.comment, 'トークン')
+
+    def test_wrong_password(self):
+        self.assertEqual(self.login('wrong').status_code, 400)
+
+    def test_invalid_token(self):
+        self.assertEqual(self.patch('0' * 40).status_code, 403)
+
+    def test_expired_token(self):
+        token = self.login().json()['token']
+        Token.objects.filter(key=token).update(created=timezone.now() - datetime.timedelta(days=31))
+        self.assertEqual(self.patch(token).status_code, 403)
+        new_token = self.login().json()['token']
+        self.assertNotEqual(new_token, token)
+        self.assertEqual(self.patch(new_token).status_code, 200)
+
+    def test_logout(self):
+        token = self.login().json()['token']
+        response = self.client.delete(reverse('api-token'), headers={'authorization': f'Token {token}'})
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.patch(token).status_code, 403)
+        self.assertEqual(self.client.delete(reverse('api-token')).status_code, 403)
+
+
+@override_settings(SYNC_SETTLE_SECONDS=0)
+class SyncTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('alice', password='pass', is_staff=True)
+        cls.fuji = Mountain.objects.create(name='富士山', prefecture='静岡県', elevation=3776)
+        cls.takao = Mountain.objects.create(name='高尾山', prefecture='東京都', elevation=599)
+        make_records(cls.fuji, [cls.user], 7)
+        make_records(cls.takao, [cls.user], 3)
+
+    def sync(self, cursor=None, limit=None, status=200):
+        params = {}
+        if cursor:
+            params['cursor'] = cursor
+        if limit:
+            params['limit'] = limit
+        response = self.client.get(reverse('api-sync'), params)
+        self.assertEqual(response.status_code, status, response.content)
+        return response.json()
+
+    def sync_all(self, cursor=None, limit=None):
+        """has_more がなくなるまで同期し、(山の id, 記録の id, 削除, カーソル) を返す"""
+        mountains, records = set(), set()
+        deleted = {'mountains': set(), 'records': set()}
+        while True:
+            page = self.sync(cursor, limit)
+            mountains.update(m['id'] for m in page['mountains'])
+            records.update(r['id'] for r in page['records'])
+            for name in deleted:
+                deleted[name].update(page['deleted'][name])
+            cursor = page['cursor']
+            if not page['has_more']:
+                return mountains, records, deleted, cursor
+
+    def test_initial_sync_in_batches(self):
+        page = self.sync(limit=4)
+        self.assertEqual(len(page['records']), 4)
+        self.assertTrue(page['has_more'])
+        mountains, records, deleted, _ = self.sync_all(limit=4)
+        self.assertEqual(mountains, {self.fuji.pk, self.takao.pk})
+        self.assertEqual(records, set(ClimbRecord.objects.values_list('pk', flat=True)))
+        self.assertEqual(deleted, {'mountains': set(), 'records': set()})
+
+    def test_only_changes_since_cursor(self):
+        cursor = self.sync_all()[3]
+        page = self.sync(cursor)
+        self.assertEqual((page['mountains'], page['records'], page['has_more']), ([], [], False))
+
+        record = ClimbRecord.objects.filter(mountain=self.fuji).first()
+        record.comment = '更新'
+        record.save()
+        removed = ClimbRecord.objects.filter(mountain=self.takao).first()
+        removed_pk = removed.pk
+        removed.delete()
+        mountains, records, deleted, cursor = self.sync_all(cursor)
+        self.assertEqual(records, {record.pk})
+        # 記録の削除で集計値が変わった山も返る (コメントの更新では山は変わらない)
+        self.assertEqual(mountains, {self.takao.pk})
+        self.assertEqual(deleted['records'], {removed_pk})
+        self.assertEqual(self.sync_all(cursor)[:3], (set(), set(), {'mountains': set(), 'records': set()}))
+
+    def test_mountain_delete_cascades_tombstones(self):
+        cursor = self.sync_all()[3]
+        record_ids = set(self.takao.climbrecord_set.values_list('pk', flat=True))
+        self.client.login(username='alice', password='pass')
+        response = self.client.post(reverse('mountain_delete', args=[self.takao.pk]))
+        self.assertEqual(response.status_code, 302)
+        _, _, deleted, _ = self.sync_all(cursor)
+        self.assertEqual(deleted, {'mountains': {self.takao.pk}, 'records': record_ids})
+
+    def test_recent_changes_wait_for_settle_window(self):
+        cursor = self.sync_all()[3]
+        record = ClimbRecord.objects.first()
+        with self.settings(SYNC_SETTLE_SECONDS=60):
+            record.save()
+            page = self.sync(cursor)
+            self.assertEqual(page['records'], [])
+            later = timezone.now() + datetime.timedelta(seconds=61)
+            with mock.patch('paplib.sync.timezone.now', return_value=later):
+                page = self.sync(page['cursor'])
+        self.assertEqual([r['id'] for r in page['records']], [record.pk])
+
+    def test_bad_and_expired_cursor(self):
+        self.assertIn('cursor', self.sync('broken', status=400))
+        cursor = self.sync()['cursor']
+        later = timezone.now() + datetime.timedelta(days=91)
+        with mock.patch('paplib.sync.timezone.now', return_value=later):
+            self.sync(cursor, status=410)
+
+    def test_prune_tombstones(self):
+        ClimbRecord.objects.first().delete()
+        Tombstone.objects.update(deleted_at=timezone.now() - datetime.timedelta(days=100))
+        ClimbRecord.objects.first().delete()
+        out = StringIO()
+        call_command('prune_tombstones', stdout=out)
+        self.assertEqual(Tombstone.objects.count(), 1)
+        self.assertIn('1 件', out.getvalue())
+
+    def test_uses_indexes(self):
+        cursor = self.sync(limit=3)['cursor']
+        with CaptureQueriesContext(connection) as ctx:
+            self.sync(cursor, limit=3)
+        self.assertEqual(len(ctx.captured_queries), 3)
+        for query in ctx.captured_queries:
+            with connection.cursor() as c:
+                c.execute('EXPLAIN QUERY PLAN ' + query['sql'])
+                for detail in [row[-1] for row in c.fetchall()]:
+                    self.assertNotIn('TEMP B-TREE', detail, query['sql'])
+                    self.assertFalse(detail.startswith('SCAN'), f'{detail}: {query["sql"]}')
+
+
+class UserStatsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('alice', password='pass')
+        cls.other = User.objects.create_user('bob', password='pass')
+        cls.fuji = Mountain.objects.create(name='富士山', prefecture='静岡県', elevation=3776)
+        cls.takao = Mountain.objects.create(name='高尾山', prefecture='東京都', elevation=599)
+        cls.kumotori = Mountain.objects.create(name='雲取山', prefecture='東京都', elevation=2017)
+        for mountain, date in ((cls.fuji, '2023-08-01'), (cls.takao, '2023-11-03'), (cls.takao, '2024-01-01'),
+                               (cls.kumotori, '2024-05-05'), (cls.takao, '2024-12-31')):
+            ClimbRecord.objects.create(user=cls.user, mountain=mountain,
+                                       climb_date=datetime.date.fromisoformat(date))
+        ClimbRecord.objects.create(user=cls.other, mountain=cls.fuji, climb_date=datetime.date(2024, 7, 1))
+
+    def setUp(self):
+        get_cache().clear()
+
+    def test_compute(self):
+        with self.assertNumQueries(1):
+            result = compute_user_stats(self.user.pk)
+        self.assertEqual(result['climbs'], 5)
+        self.assertEqual(result['peaks'], 3)
+        self.assertEqual(result['elevation'], 3776 + 599 * 3 + 2017)
+        self.assertEqual(result['first_climb'], datetime.date(2023, 8, 1))
+        self.assertEqual(result['last_climb'], datetime.date(2024, 12, 31))
+        self.assertEqual(result['prefectures'], [
+            {'prefecture': '東京都', 'climbs': 4, 'elevation': 599 * 3 + 2017, 'peaks': 2},
+            {'prefecture': '静岡県', 'climbs': 1, 'elevation': 3776, 'peaks': 1},
+        ])
+        self.assertEqual(result['years'], [
+            {'year': 2024, 'climbs': 3, 'elevation': 599 * 2 + 2017, 'peaks': 2},
+            {'year': 2023, 'climbs': 2, 'elevation': 3776 + 599, 'peaks': 2},
+        ])
+
+    def test_empty(self):
+        user = User.objects.create_user('carol', password='pass')
+        result = compute_user_stats(user.pk)
+        self.assertEqual((result['climbs'], result['peaks'], result['first_climb']), (0, 0, None))
+        self.assertEqual((result['prefectures'], result['years']), ([], []))
+
+    def test_cached_and_invalidated(self):
+        user_stats(self.user.pk)
+        with self.assertNumQueries(0):
+            user_stats(self.user.pk)
+
+        # コメントだけの変更では捨てない
+        record = ClimbRecord.objects.filter(user=self.user).first()
+        record.comment = '感想'
+        record.save()
+        with self.assertNumQueries(0):
+            user_stats(self.user.pk)
+
+        ClimbRecord.objects.create(user=self.user, mountain=self.fuji, climb_date=datetime.date(2025, 1, 1))
+        self.assertEqual(user_stats(self.user.pk)['climbs'], 6)
+        # 他のユーザーの統計は捨てない
+        user_stats(self.other.pk)
+        ClimbRecord.objects.filter(user=self.user).last().delete()
+        with self.assertNumQueries(0):
+            user_stats(self.other.pk)
+        self.assertEqual(user_stats(self.user.pk)['climbs'], 5)
+
+        self.fuji.elevation = 3777
+        self.fuji.save()
+        self.assertEqual(user_stats(self.other.pk)['elevation'], 3777)
+
+    def test_bulk_create_invalidates(self):
+        user_stats(self.user.pk)
+        self.client.force_login(self.user)
+        response = self.client.post(
+            reverse('climbrecord-bulk-create'),
+            [{'mountain': self.fuji.pk, 'climb_date': '2025-02-02'}], content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(user_stats(self.user.pk)['climbs'], 6)
+
+    def test_mypage(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('mypage'))
+        self.assertEqual(response.context['stats']['peaks'], 3)
+        self.assertContains(response, '7,590 m')
+        self.assertContains(response, '<td>東京都</td>', html=True)
+
+    def test_api(self):
+        url = reverse('api-stats')
+        self.assertEqual(self.client.get(url).status_code, 403)
+        response = self.client.get(url, {'user': 'bob'})
+        self.assertEqual(response.json()['user'], 'bob')
+        self.assertEqual(response.json()['climbs'], 1)
+        self.client.force_login(self.user)
+        data = self.client.get(url).json()
+        self.assertEqual((data['user'], data['climbs'], data['first_climb']), ('alice', 5, '2023-08-01'))
+        self.assertEqual(self.client.get(url, {'user': 'nobody'}).status_code, 404)
+
+
+@override_settings(TASKS_EAGER=True)
+class LeaderboardTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create_user(f'user{i}', password='pass', is_staff=True) for i in range(4)]
+        cls.fuji = Mountain.objects.create(name='富士山', prefecture='静岡県', elevation=3776)
+        cls.takao = Mountain.objects.create(name='高尾山', prefecture='東京都', elevation=599)
+        cls.kumotori = Mountain.objects.create(name='雲取山', prefecture='東京都', elevation=2017)
+        # user0: 高尾山 3回 / user1: 富士山 1回 + 雲取山 1回 (2024年) / user2: 高尾山 2回 + 富士山 1回 / user3: 高尾山 1回
+        for user, mountain, date in (
+            (0, cls.takao, '2023-01-01'), (0, cls.takao, '2024-01-01'), (0, cls.takao, '2024-02-01'),
+            (1, cls.fuji, '2024-08-01'), (1, cls.kumotori, '2024-09-01'),
+            (2, cls.takao, '2023-05-01'), (2, cls.takao, '2023-06-01'), (2, cls.fuji, '2023-08-01'),
+            (3, cls.takao, '2024-03-01'),
+        ):
+            ClimbRecord.objects.create(user=cls.users[user], mountain=mountain,
+                                       climb_date=datetime.date.fromisoformat(date))
+
+    def snapshot(self):
+        return set(LeaderboardEntry.objects.values_list('scope', 'year', 'user_id', 'climbs', 'peaks', 'elevation'))
+
+    def assertMatchesRebuild(self):
+        incremental = self.snapshot()
+        rebuild_leaderboards()
+        self.assertEqual(incremental, self.snapshot())
+
+    def board(self, **params):
+        response = self.client.get(reverse('api-leaderboards'), params)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def ranking(self, **params):
+        return [(row['rank'], row['user']) for row in self.board(**params)['results']]
+
+    def test_rankings(self):
+        self.assertEqual(self.ranking(), [(1, 'user0'), (1, 'user2'), (3, 'user1'), (4, 'user3')])
+        self.assertEqual(self.ranking(metric='peaks'), [(1, 'user1'), (1, 'user2'), (3, 'user0'), (3, 'user3')])
+        self.assertEqual(self.ranking(metric='elevation')[0], (1, 'user1'))
+        self.assertEqual(self.ranking(prefecture='東京都', year=2024),
+                         [(1, 'user0'), (2, 'user1'), (2, 'user3')])
+        self.assertEqual(self.ranking(mountain=self.fuji.pk), [(1, 'user1'), (1, 'user2')])
+        row = self.board(metric='elevation', prefecture='東京都')['results'][0]
+        self.assertEqual((row['user'], row['climbs'], row['peaks'], row['elevation']), ('user1', 1, 1, 2017))
+
+    def test_pages_keep_ranks(self):
+        url = reverse('api-leaderboards')
+        ranks = []
+        response = self.client.get(url, {'metric': 'peaks', 'page_size': 1})
+        while True:
+            data = response.json()
+            ranks.extend((row['rank'], row['user']) for row in data['results'])
+            if not data['next']:
+                break
+            with self.assertNumQueries(1):
+                response = self.client.get(data['next'])
+        self.assertEqual(ranks, self.ranking(metric='peaks'))
+        self.assertEqual(self.client.get(url, {'cursor': 'broken'}).status_code, 400)
+
+    def test_bad_params(self):
+        url = reverse('api-leaderboards')
+        self.assertEqual(self.client.get(url, {'metric': 'name'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'year': 'x'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'mountain': self.fuji.pk, 'year': 2024}).status_code, 400)
+
+    def test_uses_indexes(self):
+        for metric in LeaderboardEntry.METRICS:
+            url = self.board(metric=metric, page_size=1)['next']
+            with CaptureQueriesContext(connection) as ctx:
+                self.client.get(url)
+            with connection.cursor() as cursor:
+                cursor.execute('EXPLAIN QUERY PLAN ' + ctx.captured_queries[0]['sql'])
+                details = [row[-1] for row in cursor.fetchall()]
+            self.assertTrue(any(f'paplib_lb_{metric}_idx' in detail for detail in details), details)
+            for detail in details:
+                self.assertNotIn('TEMP B-TREE', detail)
+
+    def test_incremental_updates_match_rebuild(self):
+        self.assertMatchesRebuild()
+        record = ClimbRecord.objects.filter(user=self.users[0]).first()
+        record.mountain = self.fuji
+        record.climb_date = datetime.date(2022, 1, 1)
+        record.save()
+        self.assertMatchesRebuild()
+        self.assertEqual(self.ranking(year=2022), [(1, 'user0')])
+
+        ClimbRecord.objects.filter(user=self.users[3]).delete()
+        self.assertMatchesRebuild()
+        self.assertNotIn('user3', [user for _, user in self.ranking()])
+
+        self.client.force_login(self.users[3])
+        self.client.post(reverse('climbrecord-bulk-create'), [
+            {'mountain': self.kumotori.pk, 'climb_date': '2025-01-01'},
+            {'mountain': self.kumotori.pk, 'climb_date': '2025-01-02'},
+        ], content_type='application/json')
+        self.assertMatchesRebuild()
+        self.assertEqual(self.ranking(year=2025), [(1, 'user3')])
+
+        self.kumotori.prefecture = '埼玉県'
+        self.kumotori.save()
+        self.assertMatchesRebuild()
+        self.assertEqual(self.ranking(prefecture='埼玉県'), [(1, 'user3'), (2, 'user1')])
+
+        self.client.post(reverse('mountain_delete', args=[self.kumotori.pk]))
+        self.assertFalse(Mountain.objects.filter(pk=self.kumotori.pk).exists())
+        self.assertMatchesRebuild()
+        self.assertEqual(self.ranking(prefecture='埼玉県'), [])
+
+        self.users[2].delete()
+        self.assertMatchesRebuild()
+
+    def test_rebuild_command(self):
+        expected = self.snapshot()
+        LeaderboardEntry.objects.all().delete()
+        out = StringIO()
+        call_command('rebuild_leaderboards', stdout=out)
+        self.assertEqual(self.snapshot(), expected)
+        self.assertIn(f'{len(expected)} 件', out.getvalue())
+
+
+def make_rotated_photo():
+    """横長で、EXIF に「90度回して表示する」向きとカメラの情報を持つ JPEG (約32KB)"""
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    exif[0x010F] = 'TestCamera'
+    buffer = BytesIO()
+    Image.effect_noise((300, 200), 64).convert('RGB').save(buffer, format='JPEG', exif=exif)
+    return buffer.getvalue()
+
+
+@override_settings(TASKS_EAGER=True, PHOTO_UPLOAD_CHUNK_BYTES=4096)
+class PhotoUploadTests(TestCase):
+    def setUp(self):
+        for name in ('MEDIA_ROOT', 'PHOTO_UPLOAD_TEMP_DIR'):
+            directory = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, directory)
+            override = self.settings(**{name: directory})
+            override.enable()
+            self.addCleanup(override.disable)
+        self.user = User.objects.create_user('hiker', password='pass')
+        self.mountain = Mountain.objects.create(name='剱岳', prefecture='富山県', elevation=2999)
+        self.record = ClimbRecord.objects.create(
+            user=self.user, mountain=self.mountain, climb_date=datetime.date(2024, 8, 1),
+        )
+        self.client.force_login(self.user)
+
+    def start(self, data, record=None, sha256=None):
+        response = self.client.post(reverse('photoupload-list'), {
+            'record': (record or self.record).pk, 'filename': 'C:\\DCIM\\IMG_0001.JPG', 'size': len(data),
+            'sha256': sha256 or hashlib.sha256(data).hexdigest(),
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 201, response.content)
+        return response.json()
+
+    def put(self, upload, offset, chunk):
+        return self.client.put(
+            reverse('photoupload-detail', args=[upload['id']]), chunk,
+            content_type='application/offset+octet-stream', headers={'upload-offset': str(offset)},
+        )
+
+    def send(self, upload, data):
+        for offset in range(0, len(data), upload['chunk_size']):
+            response = self.put(upload, offset, data[offset:offset + upload['chunk_size']])
+            self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def complete(self, upload):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('photoupload-complete', args=[upload['id']]))
+        self.assertEqual(response.status_code, 202, response.content)
+        return self.client.get(reverse('photoupload-detail', args=[upload['id']])).json()
+
+    def test_chunked_upload(self):
+        data = make_rotated_photo()
+        upload = self.start(data)
+        self.assertEqual((upload['offset'], upload['status'], upload['filename']), (0, 'uploading', 'IMG_0001.JPG'))
+        self.assertEqual(self.send(upload, data)['offset'], len(data))
+
+        upload = self.complete(upload)
+        self.assertEqual(upload['status'], 'done', upload['error'])
+        self.record.refresh_from_db()
+        self.assertRegex(self.record.image.name, r'^photos/[0-9a-f]{2}/[0-9a-f]{64}\.jpg$')
+        self.assertTrue(upload['image'].endswith('.jpg'))
+        with default_storage.open(self.record.image.name) as f:
+            photo = Image.open(f)
+            # 向きは画素に反映され、EXIF は残らない
+            self.assertEqual(photo.size, (200, 300))
+            self.assertEqual(dict(photo.getexif()), {})
+        self.assertTrue(default_storage.exists(variant_name(self.record.image.name, 'thumb')))
+        self.mountain.refresh_from_db()
+        self.assertEqual(self.mountain.latest_photo, self.record.image.name)
+        # 一時ファイルは残らない
+        self.assertEqual(os.listdir(settings.PHOTO_UPLOAD_TEMP_DIR), [])
+
+    def test_resume(self):
+        data = make_rotated_photo()
+        upload = self.start(data)
+        size = upload['chunk_size']
+        self.put(upload, 0, data[:size])
+        # 同じ部分をもう一度送ったり、飛ばして送ったりすると受け取り済みの位置を返す
+        for offset in (0, size * 2):
+            response = self.put(upload, offset, data[offset:offset + size])
+            self.assertEqual(response.status_code, 409)
+            self.assertEqual(response.json()['offset'], size)
+        # 再開するクライアントは GET で位置を確かめる
+        offset = self.client.get(reverse('photoupload-detail', args=[upload['id']])).json()['offset']
+        self.assertEqual(offset, size)
+        self.assertEqual(self.put(upload, offset, data[offset:offset + size * 2]).status_code, 413)
+        for offset in range(offset, len(data), size):
+            self.assertEqual(self.put(upload, offset, data[offset:offset + size]).status_code, 200)
+        self.assertEqual(self.complete(upload)['status'], 'done')
+
+    def test_incomplete(self):
+        data = make_rotated_photo()
+        upload = self.start(data)
+        self.put(upload, 0, data[:upload['chunk_size']])
+        response = self.client.post(reverse('photoupload-complete', args=[upload['id']]))
+        self.assertEqual(response.status_code, 400)
+
+    def test_checksum_mismatch(self):
+        data = make_rotated_photo()
+        upload = self.start(data, sha256='0' * 64)
+        self.send(upload, data)
+        upload = self.complete(upload)
+        self.assertEqual(upload['status'], 'failed')
+        self.assertIn('チェックサム', upload['error'])
+        self.record.refresh_from_db()
+        self.assertFalse(self.record.image)
+
+    def test_not_an_image(self):
+        data = b'not a photo' * 100
+        upload = self.start(data)
+        self.send(upload, data)
+        self.assertEqual(self.complete(upload)['status'], 'failed')
+
+    def test_validation(self):
+        other = User.objects.create_user('other', password='pass')
+        other_record = ClimbRecord.objects.create(user=other, mountain=self.mountain, climb_date=datetime.date(2024, 1, 1))
+        response = self.client.post(reverse('photoupload-list'), {
+            'record': other_record.pk, 'filename': 'a.jpg', 'size': 10, 'sha256': '0' * 64,
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('record', response.json())
+        with self.settings(PHOTO_UPLOAD_MAX_BYTES=100):
+            response = self.client.post(reverse('photoupload-list'), {
+                'record': self.record.pk, 'filename': 'a.jpg', 'size': 101, 'sha256': '0' * 64,
+            }, content_type='application/json')
+        self.assertIn('size', response.json())
+
+        # 他のユーザーのアップロードは見えない
+        upload = self.start(b'x')
+        self.client.force_login(other)
+        self.assertEqual(self.put(upload, 0, b'x').status_code, 404)
+        self.client.logout()
+        self.assertEqual(self.put(upload, 0, b'x').status_code, 403)
+
+    def test_prune_command(self):
+        data = make_rotated_photo()
+        upload = self.start(data)
+        self.put(upload, 0, data[:upload['chunk_size']])
+        PhotoUpload.objects.update(updated_at=timezone.now() - datetime.timedelta(days=2))
+        call_command('process_uploads', stdout=StringIO())
+        self.assertFalse(PhotoUpload.objects.exists())
+        self.assertEqual(os.listdir(settings.PHOTO_UPLOAD_TEMP_DIR), [])
+
+
+@override_settings(TASKS_EAGER=True)
+class PhotoStorageTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        override = self.settings(MEDIA_ROOT=media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.users = [User.objects.create_user(f'member{i}', password='pass') for i in range(2)]
+        self.mountain = Mountain.objects.create(name='白馬岳', prefecture='長野県', elevation=2932)
+
+    def add(self, user, image):
+        return ClimbRecord.objects.create(
+            user=user, mountain=self.mountain, climb_date=datetime.date(2024, 7, 20), image=image,
+        )
+
+    def files(self, name):
+        return [default_storage.exists(n) for n in (name, variant_name(name, 'thumb'))]
+
+    def test_shared_photo_is_stored_once(self):
+        first, second = (self.add(user, make_image()) for user in self.users)
+        name = first.image.name
+        self.assertEqual(second.image.name, name)
+        self.assertRegex(name, r'^photos/[0-9a-f]{2}/[0-9a-f]{64}\.jpg$')
+        self.assertEqual(sorted(os.listdir(os.path.dirname(default_storage.path(name)))), [os.path.basename(name), 'variants'])
+        self.assertEqual(PhotoBlob.objects.get(name=name).refs, 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertEqual(self.files(name), [True, True])
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertEqual(self.files(name), [False, False])
+        self.assertFalse(PhotoBlob.objects.exists())
+
+    def test_replaced_photo_is_released(self):
+        record = self.add(self.users[0], make_image())
+        old = record.image.name
+        record.image = make_image(size=(800, 600))
+        with self.captureOnCommitCallbacks(execute=True):
+            record.save()
+        self.assertNotEqual(record.image.name, old)
+        self.assertEqual(self.files(old), [False, False])
+        self.assertEqual(list(PhotoBlob.objects.values_list('name', 'refs')), [(record.image.name, 1)])
+
+    def test_immutable_cache_headers(self):
+        record = self.add(self.users[0], make_image())
+        for url in (record.image.url, record.thumbnail_url):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('immutable', response['Cache-Control'])
+            self.assertIn('max-age=31536000', response['Cache-Control'])
+            response = self.client.get(url, headers={'if-none-match': response['ETag']})
+            self.assertEqual(response.status_code, 304)
+
+        # ハッシュの名前でないファイルは名前が使い回されるので、ETag だけで再検証させる
+        legacy = default_storage.save('photos/summit.jpg', make_image())
+        response = self.client.get(f'/media/{legacy}')
+        self.assertNotIn('immutable', response.get('Cache-Control', ''))
+        self.assertEqual(self.client.get(f'/media/{legacy}', headers={'if-none-match': response['ETag']}).status_code, 304)
+
+    def test_dedupe_command(self):
+        content = make_image().read()
+        legacy = [default_storage.save(f'photos/{name}.jpeg', ContentFile(content)) for name in ('a', 'b')]
+        orphan = default_storage.save('photos/orphan.jpg', ContentFile(b'old'))
+        records = [self.add(user, None) for user in self.users]
+        for record, name in zip(records, legacy):
+            ClimbRecord.objects.filter(pk=record.pk).update(image=name)
+        Mountain.objects.filter(pk=self.mountain.pk).update(latest_photo=legacy[1])
+
+        out = StringIO()
+        call_command('dedupe_photos', dry_run=True, stdout=out)
+        self.assertIn('2 枚の写真は 1 個のファイルにまとめられ', out.getvalue())
+        self.assertTrue(all(default_storage.exists(name) for name in legacy))
+
+        call_command('dedupe_photos', delete_orphans=True, stdout=StringIO())
+        names = {record.image.name for record in ClimbRecord.objects.all()}
+        self.assertEqual(len(names), 1)
+        name = names.pop()
+        self.assertIsNotNone(re.match(r'photos/[0-9a-f]{2}/[0-9a-f]{64}\.jpeg$', name))
+        self.mountain.refresh_from_db()
+        self.assertEqual(self.mountain.latest_photo, name)
+        self.assertEqual(PhotoBlob.objects.get(name=name).refs, 2)
+        self.assertEqual(self.files(name), [True, True])
+        self.assertFalse(any(default_storage.exists(n) for n in [*legacy, orphan]))
+
+
+# TaskQueueTests で実行するタスク
+task_calls = []
+
+
+@task(max_attempts=2)
+def remember(value, fail=False):
+    if fail:
+        raise ValueError(value)
+    task_calls.append(value)
+
+
+def not_a_task():
+    pass
+
+
+class TaskQueueTests(TestCase):
+    def setUp(self):
+        task_calls.clear()
+
+    def test_enqueue_and_execute(self):
+        queued = remember.enqueue(value='a')
+        self.assertEqual((queued.name, queued.kwargs, queued.status), ('paplib.tests.remember', {'value': 'a'}, 'queued'))
+        [(claimed, token)] = claim('w1', 10)
+        self.assertEqual((claimed.status, claimed.attempts), ('running', 1))
+        # 取り出し中のタスクは他のワーカーには渡らない
+        self.assertEqual(claim('w2', 10), [])
+        self.assertEqual(execute(claimed.pk, token)[0], 'done')
+        self.assertEqual(task_calls, ['a'])
+        self.assertFalse(Task.objects.exists())
+
+    def test_delayed(self):
+        remember.enqueue(value='later', delay=60)
+        self.assertEqual(claim('w1', 10), [])
+
+    def test_retry_then_fail(self):
+        remember.enqueue(value='x', fail=True)
+        [(claimed, token)] = claim('w1', 10)
+        self.assertEqual(execute(claimed.pk, token)[0], 'retry')
+        claimed.refresh_from_db()
+        self.assertEqual(claimed.status, 'queued')
+        self.assertIn('ValueError: x', claimed.last_error)
+        # 再試行は少し後
+        self.assertEqual(claim('w1', 10), [])
+        Task.objects.update(run_after=timezone.now())
+        [(claimed, token)] = claim('w1', 10)
+        self.assertEqual(execute(claimed.pk, token)[0], 'failed')
+        claimed.refresh_from_db()
+        self.assertEqual((claimed.status, claimed.attempts), ('failed', 2))
+        self.assertEqual(claim('w1', 10), [])
+
+    def test_visibility_timeout(self):
+        remember.enqueue(value='slow')
+        [(claimed, token)] = claim('w1', 10)
+        # w1 が落ちて期限が切れたら、w2 が取り出し直す
+        Task.objects.update(locked_until=timezone.now() - datetime.timedelta(seconds=1))
+        [(reclaimed, new_token)] = claim('w2', 10)
+        self.assertEqual(reclaimed.attempts, 2)
+        self.assertEqual(execute(claimed.pk, token)[0], 'lost')
+        self.assertEqual(execute(reclaimed.pk, new_token)[0], 'done')
+        self.assertEqual(task_calls, ['slow'])
+
+    def test_only_tasks_are_run(self):
+        Task.objects.create(name='paplib.tests.not_a_task', max_attempts=1)
+        Task.objects.create(name='paplib.tests.missing', max_attempts=1)
+        for claimed, token in claim('w1', 10):
+            self.assertEqual(execute(claimed.pk, token)[0], 'failed')
+
+    def test_image_variants_are_deferred(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        with self.settings(MEDIA_ROOT=media_root):
+            record = ClimbRecord.objects.create(
+                user=User.objects.create_user('queued', password='pass'),
+                mountain=Mountain.objects.create(name='燕岳', prefecture='長野県', elevation=2763),
+                climb_date=datetime.date(2024, 8, 1), image=make_image(),
+            )
+            thumb = variant_name(record.image.name, 'thumb')
+            self.assertFalse(default_storage.exists(thumb))
+            [(claimed, token)] = claim('w1', 10)
+            self.assertEqual(claimed.name, 'paplib.signals.build_image_variants')
+            self.assertEqual(execute(claimed.pk, token)[0], 'done')
+            self.assertTrue(default_storage.exists(thumb))
+
+
+class TaskWorkerTests(TransactionTestCase):
+    def test_burst(self):
+        task_calls.clear()
+        for i in range(20):
+            remember.enqueue(value=i)
+        remember.enqueue(value='bad', fail=True)
+        out = StringIO()
+        with self.settings(TASKS_RETRY_DELAY=0):
+            # テスト用のメモリ上の SQLite はスレッドをまたぐとテーブルごとロックされるので1つずつ実行する
+            call_command('run_worker', concurrency=1, burst=True, poll_interval=0.01, stdout=out, stderr=StringIO())
+        self.assertEqual(sorted(task_calls), list(range(20)))
+        self.assertIn('成功 20, 再試行 1, 失敗 1', out.getvalue())
+        self.assertEqual(list(Task.objects.values_list('status', flat=True)), ['failed'])
@@ -0,0 +1,196 @@
+"""写真の分割アップロード (/api/uploads/)。
+
+クライアントは写真を PHOTO_UPLOAD_CHUNK_BYTES 以下の部分に分け、先頭から順に送る。
+受け取った部分は1つずつファイルに書いてから、DB の offset を「送られてきた位置のときだけ進める」
+UPDATE で確定するので、同じ部分が2回届いても二重には書かれない。接続が切れたら offset を聞いて
+その続きから送り直せばよい。
+
+全部そろったら (complete)、つなぎ合わせ・チェックサムの確認・Pillow での検証と変換
+(向きの補正、EXIF の削除、JPEG への再エンコード) をリクエストの外 (タスクキュー, paplib.tasks) で行い、
+登山記録の写真にする。
+"""
+import datetime
+import hashlib
+import os
+import shutil
+import tempfile
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+from .models import PhotoUpload
+from .tasks import task
+
+# 写真として受け付ける形式 (MPO は iPhone などの JPEG)
+ALLOWED_FORMATS = {'JPEG', 'MPO', 'PNG', 'WEBP'}
+
+READ_SIZE = 64 * 1024
+
+
+class UploadError(Exception):
+    pass
+
+
+class OffsetMismatch(UploadError):
+    """送られてきた位置が受け取り済みの位置と違う"""
+
+    def __init__(self, offset):
+        super().__init__(f'{offset} バイト目から送ってください。')
+        self.offset = offset
+
+
+class ChunkTooLarge(UploadError):
+    pass
+
+
+def upload_dir(upload):
+    return os.path.join(settings.PHOTO_UPLOAD_TEMP_DIR, str(upload.pk))
+
+
+def _part_path(upload, offset):
+    return os.path.join(upload_dir(upload), f'{offset:012d}.part')
+
+
+def append_chunk(upload, offset, stream, length):
+    """stream から length バイトを読み、offset からの部分として保存する"""
+    if upload.status != PhotoUpload.UPLOADING:
+        raise UploadError('この写真は送信を終えています。')
+    if offset != upload.offset:
+        raise OffsetMismatch(upload.offset)
+    if length < 1:
+        raise UploadError('空の部分は送れません。')
+    limit = min(settings.PHOTO_UPLOAD_CHUNK_BYTES, upload.size - offset)
+    if length > limit:
+        raise ChunkTooLarge(f'この位置から1回に送れるのは {limit} バイトまでです。')
+
+    directory = upload_dir(upload)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        # 本文をメモリに載せず、少しずつファイルに書く
+        received = 0
+        with os.fdopen(fd, 'wb') as f:
+            while received < length:
+                data = stream.read(min(READ_SIZE, length - received))
+                if not data:
+                    break
+                f.write(data)
+                received += len(data)
+        if received != length:
+            raise UploadError('部分の途中で接続が切れました。同じ位置から送り直してください。')
+        with transaction.atomic():
+            claimed = PhotoUpload.objects.filter(
+                pk=upload.pk, offset=offset, status=PhotoUpload.UPLOADING,
+            ).update(offset=offset + length, updated_at=timezone.now())
+            if not claimed:
+                # 同じ部分が並行して届き、先に確定された
+                raise OffsetMismatch(PhotoUpload.objects.values_list('offset', flat=True).get(pk=upload.pk))
+            os.replace(tmp, _part_path(upload, offset))
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    upload.offset = offset + length
+
+
+def complete(upload):
+    """全部受け取った写真を処理待ちにし、タスクキューで処理する。2回呼んでもよい"""
+    updated = PhotoUpload.objects.filter(
+        pk=upload.pk, status=PhotoUpload.UPLOADING, offset=upload.size,
+    ).update(status=PhotoUpload.PROCESSING, updated_at=timezone.now())
+    upload.refresh_from_db(fields=['offset', 'status'])
+    if not updated:
+        if upload.status == PhotoUpload.UPLOADING:
+            raise UploadError(f'まだ {upload.size - upload.offset} バイト残っています。')
+        return
+    process.enqueue(upload_id=str(upload.pk))
+
+
+def _assemble(upload):
+    """部分をつなげた一時ファイルを返す。サイズとチェックサムが合わなければ UploadError"""
+    digest = hashlib.sha256()
+    output = tempfile.TemporaryFile()
+    offset = 0
+    try:
+        while offset < upload.size:
+            try:
+                part = open(_part_path(upload, offset), 'rb')
+            except FileNotFoundError:
+                raise UploadError(f'{offset} バイト目からの部分が見つかりません。')
+            with part:
+                while data := part.read(READ_SIZE):
+                    digest.update(data)
+                    output.write(data)
+                    offset += len(data)
+        if offset != upload.size or digest.hexdigest() != upload.sha256:
+            raise UploadError('受け取った写真のチェックサムが一致しません。')
+    except BaseException:
+        output.close()
+        raise
+    output.seek(0)
+    return output
+
+
+def normalize_photo(file):
+    """写真の向きを直し、EXIF (撮影位置など) を除いた JPEG にして返す"""
+    with Image.open(file) as original:
+        if original.format not in ALLOWED_FORMATS:
+            raise UploadError(f'{original.format} 形式の画像は受け付けていません。')
+        image = ImageOps.exif_transpose(original).convert('RGB')
+    limit = settings.PHOTO_MAX_DIMENSION
+    image.thumbnail((limit, limit), Image.Resampling.LANCZOS)
+    buffer = BytesIO()
+    # exif を渡さないので、元の写真のメタデータは残らない
+    image.save(buffer, format='JPEG', quality=90, optimize=True)
+    return buffer.getvalue()
+
+
+def _finish(upload, status, error=''):
+    PhotoUpload.objects.filter(pk=upload.pk).update(status=status, error=error, updated_at=timezone.now())
+    shutil.rmtree(upload_dir(upload), ignore_errors=True)
+
+
+@task()
+def process(upload_id):
+    """処理待ちの写真を検証・変換して登山記録に付ける。失敗したら status を failed にする"""
+    upload = PhotoUpload.objects.select_related('record').filter(pk=upload_id).first()
+    if upload is None or upload.status != PhotoUpload.PROCESSING:
+        return
+    try:
+        with _assemble(upload) as file:
+            content = normalize_photo(file)
+    except (UploadError, OSError, Image.DecompressionBombError) as e:
+        # Pillow が読めない画像は OSError (UnidentifiedImageError) になる
+        _finish(upload, PhotoUpload.FAILED, str(e) or '写真を読み込めませんでした。')
+        return
+
+    record = upload.record
+    stem = os.path.splitext(os.path.basename(upload.filename))[0] or 'photo'
+    record.image.save(f'{stem}.jpg', ContentFile(content), save=False)
+    with transaction.atomic():
+        # 縮小画像・山の集計値などは通常の保存と同じくシグナルで更新される
+        record.save(update_fields=['image', 'updated_at'])
+        _finish(upload, PhotoUpload.DONE)
+
+
+def discard(upload):
+    shutil.rmtree(upload_dir(upload), ignore_errors=True)
+    upload.delete()
+
+
+def prune(hours=None):
+    """送信が終わらないまま、または処理を終えてから hours 時間 (既定は PHOTO_UPLOAD_EXPIRE_HOURS)
+    経ったアップロードを消し、消した件数を返す"""
+    hours = settings.PHOTO_UPLOAD_EXPIRE_HOURS if hours is None else hours
+    expired = PhotoUpload.objects.filter(
+        status__in=[PhotoUpload.UPLOADING, PhotoUpload.DONE, PhotoUpload.FAILED],
+        updated_at__lt=timezone.now() - datetime.timedelta(hours=hours),
+    )
+    count = 0
+    for upload in expired.iterator():
+        discard(upload)
+        count += 1
+    return count
@@ -15,6 +15,7 @@ from .views import (
 router = routers.DefaultRouter()
 router.register(r'mountains', views.MountainViewSet)
 router.register(r'records', views.ClimbRecordViewSet)
+router.register(r'uploads', views.PhotoUploadViewSet, basename='photoupload')
 router.register(r'users', views.UserViewSet)
 
 urlpatterns = [
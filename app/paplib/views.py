@@ -1,27 +1,130 @@
-from django.shortcuts import render, redirect
-from .models import Mountain, ClimbRecord
+import os
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.shortcuts import render, redirect, get_object_or_404
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+from django.http import StreamingHttpResponse
+from django.core.paginator import Paginator
+from .models import Mountain, ClimbRecord, LeaderboardEntry, PhotoUpload, Tombstone
 from .forms import ClimbRecordForm, MountainForm
 from django.views.generic import UpdateView, DeleteView, CreateView, ListView, TemplateView
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from django.contrib.auth.models import User
 from django.contrib.auth.decorators import login_required
 from django.urls import reverse_lazy
-from rest_framework import generics, viewsets, permissions
-from .serializers import MountainSerializer, ClimbRecordSerializer, UserSerializer
+from django.db.models import F
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
+from django.views.static import serve
+from rest_framework import generics, mixins, viewsets, permissions, status
+from rest_framework.decorators import action
+from rest_framework.exceptions import NotAuthenticated, ValidationError
+from rest_framework.views import APIView
+from rest_framework.filters import OrderingFilter
+from rest_framework.parsers import JSONParser
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+from rest_framework.authtoken.models import Token
+from rest_framework.authtoken.serializers import AuthTokenSerializer
+from .serializers import MountainSerializer, ClimbRecordSerializer, PhotoUploadSerializer, UserSerializer
+from .serializers import NearbyMountainSerializer
+from .serializers import record_shape, shape_records, shape_updated_fields
 from .permissions import IsOwnerOrReadOnly
+from .authentication import issue_token, token_expires
+from .pagination import MountainCursorPagination, ClimbRecordCursorPagination
+from .search import search_mountains
+from .parsers import NDJSONParser
+from .bulk import import_records
+from .export import export_rows, iter_csv, iter_ndjson, buffered
+from .filters import filter_records, nearby_params
+from .conditional import ConditionalGetMixin
+from .storage import immutable_key, photo_storage
+from . import cache, geo, leaderboards, stats, sync, uploads
 
-def mountain_list(request):
+# 山の詳細ページで1ページに表示する記録数
+RECORDS_PER_PAGE = 10
+
+# 山の一覧の並び替え (?sort=)
+MOUNTAIN_SORT_OPTIONS = {
+    'name': ('名前順', ['name', 'id']),
+    'popular': ('記録の多い順', ['-record_count', 'name', 'id']),
+    'climbers': ('登山者の多い順', ['-climber_count', 'name', 'id']),
+    'recent': ('最近登られた順', [F('last_climbed_on').desc(nulls_last=True), 'name', 'id']),
+    'elevation': ('標高の高い順', ['-elevation', 'name', 'id']),
+}
+
+def mountain_list_params(request):
+    """検索語と並び順 (MOUNTAIN_SORT_OPTIONS にないものは None) を返す"""
+    sort = request.GET.get('sort')
+    if sort not in MOUNTAIN_SORT_OPTIONS:
+        sort = None
+    return request.GET.get('q'), sort
+
+def mountain_queryset(query, sort):
     mountains = Mountain.objects.all().order_by('name')
-    query = request.GET.get('q')
     if query:
-        mountains = mountains.filter(name__icontains=query)
+        mountains = search_mountains(query, mountains)
+    if sort:
+        mountains = mountains.order_by(*MOUNTAIN_SORT_OPTIONS[sort][1])
+    return mountains
+
+def mountain_list_context(items, sort):
+    return {
+        'mountain_items': mark_safe(items),
+        'sort': sort,
+        'sort_options': [(key, label) for key, (label, _) in MOUNTAIN_SORT_OPTIONS.items()],
+    }
+
+def mountain_list(request):
+    query, sort = mountain_list_params(request)
+
+    # 一覧部分はユーザーに依存しないので、検索語と並び順ごとにキャッシュする
+    key = cache.make_key('mountains', 'html', query, sort)
+    items = cache.get(key)
+    if items is None:
+        items = render_to_string('paplib/mountain_list_items.html', {'mountains': mountain_queryset(query, sort)})
+        cache.set(key, items)
+
+    return render(request, 'paplib/mountain_list.html', mountain_list_context(items, sort))
 
-    context = {'mountains': mountains}
-    return render(request, 'paplib/mountain_list.html', context)
+def mountain_records(mountain):
+    """山の詳細ページに出す記録 (新しい順)"""
+    return (
+        ClimbRecord.objects.filter(mountain=mountain)
+        .select_related('user')
+        .order_by('-climb_date', '-id')
+    )
+
+def latest_updates(records):
+    """記録の更新日時を新しい順に返す。先頭の1件だけ読めば (山|ユーザー, 更新日時) の索引で済む"""
+    return records.order_by('-updated_at').values_list('updated_at', flat=True)
+
+
+def records_version(count, latest):
+    """記録の一覧のフラグメントキャッシュ ({% cache %}) のキーにする版。
+
+    件数と最新の更新日時なので記録の追加・編集・削除のたびに変わり、キャッシュを消す必要がない。
+    ユーザー名や山の名前の変更はキーに入らないので、PAPLIB_CACHE_TIMEOUT が過ぎるまで古い名前が出る。
+    """
+    return f'{count}:{latest}'
+
+
+def mountain_detail_context(mountain, page_obj, form, version):
+    return {
+        'mountain': mountain,
+        'records': page_obj.object_list,
+        'page_obj': page_obj,
+        'is_paginated': page_obj.has_other_pages(),
+        'form': form,
+        'records_version': version,
+        **cache.fragment_context(),
+    }
 
 def mountain_detail(request, pk):
-    mountain = Mountain.objects.get(pk=pk)
-    
+    mountain = get_object_or_404(Mountain, pk=pk)
+
     if request.method == 'POST':
         form = ClimbRecordForm(request.POST, request.FILES) 
         if form.is_valid():
@@ -33,39 +136,40 @@ def mountain_detail(request, pk):
     else:
         form = ClimbRecordForm()
 
-    records = ClimbRecord.objects.filter(mountain=mountain).order_by('-climb_date')
+    records = mountain_records(mountain)
+    page_obj = Paginator(records, RECORDS_PER_PAGE).get_page(request.GET.get('page'))
+    version = records_version(page_obj.paginator.count, latest_updates(records).first())
+    return render(request, 'paplib/mountain_detail.html', mountain_detail_context(mountain, page_obj, form, version))
 
-    context = {
-        'mountain': mountain,
-        'records': records, 
-        'form': form,
-    }
-    return render(request, 'paplib/mountain_detail.html', context)
+class ClimbRecordOwnerMixin(UserPassesTestMixin):
+    """記録の所有者だけに編集・削除を許可する。
 
-class ClimbRecordUpdateView(LoginRequiredMixin, UserPassesTestMixin, UpdateView):
-    model = ClimbRecord
-    form_class = ClimbRecordForm
-    template_name = 'paplib/record_form.html'
+    test_func / get_success_url / 本処理で同じ行を何度も取得しないよう、
+    get_object() の結果をリクエスト中はキャッシュする。
+    """
+
+    def get_queryset(self):
+        return ClimbRecord.objects.select_related('user', 'mountain')
+
+    def get_object(self, queryset=None):
+        if not hasattr(self, '_record'):
+            self._record = super().get_object(queryset)
+        return self._record
 
     def get_success_url(self):
-        record = self.get_object()
-        return reverse_lazy('mountain_detail', kwargs={'pk': record.mountain.pk})
+        return reverse_lazy('mountain_detail', kwargs={'pk': self.object.mountain_id})
 
     def test_func(self):
-        record = self.get_object()
-        return self.request.user == record.user
+        return self.get_object().user_id == self.request.user.pk
 
-class ClimbRecordDeleteView(LoginRequiredMixin, UserPassesTestMixin, DeleteView):
+class ClimbRecordUpdateView(LoginRequiredMixin, ClimbRecordOwnerMixin, UpdateView):
     model = ClimbRecord
-    template_name = 'paplib/record_confirm_delete.html'
-
-    def get_success_url(self):
-        record = self.get_object()
-        return reverse_lazy('mountain_detail', kwargs={'pk': record.mountain.pk})
+    form_class = ClimbRecordForm
+    template_name = 'paplib/record_form.html'
 
-    def test_func(self):
-        record = self.get_object()
-        return self.request.user == record.user
+class ClimbRecordDeleteView(LoginRequiredMixin, ClimbRecordOwnerMixin, DeleteView):
+    model = ClimbRecord
+    template_name = 'paplib/record_confirm_delete.html'
 
 class MountainCreateView(LoginRequiredMixin, CreateView):
     model = Mountain
@@ -80,7 +184,20 @@ class MyPageView(LoginRequiredMixin, ListView):
     paginate_by = 10 
 
     def get_queryset(self):
-        return ClimbRecord.objects.filter(user=self.request.user).order_by('-climb_date')
+        return (
+            ClimbRecord.objects.filter(user=self.request.user)
+            .select_related('mountain')
+            .order_by('-climb_date', '-id')
+        )
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['stats'] = stats.user_stats(self.request.user.pk)
+        context['records_version'] = records_version(
+            context['paginator'].count, latest_updates(self.object_list).first(),
+        )
+        context.update(cache.fragment_context())
+        return context
 
 class MountainDeleteView(LoginRequiredMixin, UserPassesTestMixin, DeleteView):
     model = Mountain
@@ -106,19 +223,318 @@ class UserCreateAPIView(generics.CreateAPIView):
     serializer_class = UserSerializer
     permission_classes = [permissions.AllowAny] 
 
-class MountainViewSet(viewsets.ModelViewSet):
+class AuthTokenAPIView(generics.GenericAPIView):
+    """POST でユーザー名とパスワードを確かめてトークンを返し、DELETE でトークンを無効にする"""
+    serializer_class = AuthTokenSerializer
+
+    def get_permissions(self):
+        if self.request.method == 'POST':
+            return [permissions.AllowAny()]
+        return [permissions.IsAuthenticated()]
+
+    def post(self, request):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        token = issue_token(serializer.validated_data['user'])
+        return Response({'token': token.key, 'expires': token_expires(token)})
+
+    def delete(self, request):
+        Token.objects.filter(user=request.user).delete()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+class MountainViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     queryset = Mountain.objects.all()
     serializer_class = MountainSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
+    pagination_class = MountainCursorPagination
+    filter_backends = [OrderingFilter]
+    # カーソルの位置には並び順の列と id が入るので、値が同じ山が多い列でも読み進められる
+    ordering_fields = ['name', 'elevation', 'record_count', 'climber_count', 'last_climbed_on']
+
+    @property
+    def ordering(self):
+        # ?ordering= がなければ、検索時は関連度順・それ以外は名前順。
+        # 関連度は同じ値が多いので、id までをカーソルの位置にして同じ関連度の山を読み進める
+        if self.request.query_params.get('q'):
+            return ('-search_score', 'id')
+        return MountainCursorPagination.ordering
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        query = self.request.query_params.get('q')
+        if query and self.action == 'list':
+            queryset = search_mountains(query, queryset)
+        return queryset
+
+    def _cached(self, namespace, request, render):
+        """応答データと検証値をキャッシュし、ヒットすればDBに問い合わせずに返す"""
+        key = cache.make_key(namespace, request.build_absolute_uri(), request.accepted_media_type)
+        entry = cache.get(key)
+        if entry is not None:
+            etag, last_modified, data = entry
+            response = self._conditional(request, etag, last_modified)
+            if response is None:
+                response = self._with_validators(Response(data), etag, last_modified)
+            response['X-Cache'] = 'HIT'
+            return response
+
+        response = render()
+        if response.status_code == 200:
+            cache.set(key, (*self.validators, response.data))
+        response['X-Cache'] = 'MISS'
+        return response
 
-class ClimbRecordViewSet(viewsets.ModelViewSet):
-    queryset = ClimbRecord.objects.all()
+    def list(self, request, *args, **kwargs):
+        return self._cached('mountains', request, lambda: super(MountainViewSet, self).list(request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        return self._cached(
+            f'mountain:{kwargs["pk"]}', request,
+            lambda: super(MountainViewSet, self).retrieve(request, *args, **kwargs),
+        )
+
+    @action(detail=False, methods=['get'])
+    def nearby(self, request):
+        """近くの山を最大 ?limit= 件返す。
+
+        ?lat=&lon= なら近い順 (?radius= を付けるとその km 以内)。?bbox=西,南,東,北 ならその範囲内の山を、
+        lat / lon もあれば近い順、なければ標高の高い順に返す。
+        """
+        params = nearby_params(request.query_params)
+        queryset = Mountain.objects.all()
+        if params['bbox']:
+            queryset = geo.within_box(queryset, *params['bbox'])
+        if params['lat'] is not None:
+            mountains = geo.nearby(queryset, params['lat'], params['lon'], params['radius'], params['limit'])
+        else:
+            mountains = queryset.order_by('-elevation', 'id')[:params['limit']]
+        serializer = NearbyMountainSerializer(mountains, many=True, context=self.get_serializer_context())
+        return Response({'results': serializer.data})
+
+class ClimbRecordViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
+    """登山記録の API。一覧と詳細は ?fields= で出すフィールドを絞り、?expand=mountain,user で
+    山とユーザーの中身を埋め込める。どの形でも必要な列だけを1回のクエリで読む"""
+    # user はシリアライザでユーザー名を出すので一緒に取得する
+    queryset = ClimbRecord.objects.select_related('user')
     serializer_class = ClimbRecordSerializer
     permission_classes = [IsOwnerOrReadOnly]
+    pagination_class = ClimbRecordCursorPagination
+    # ?fields= と ?expand= を使う (読み出しだけの) アクション
+    shaped_actions = ('list', 'retrieve')
+
+    @property
+    def shape(self):
+        if not hasattr(self, '_shape'):
+            self._shape = record_shape(self.request.query_params)
+        return self._shape
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action in ('list', 'export'):
+            queryset = filter_records(queryset, self.request.query_params)
+        if self.action in self.shaped_actions:
+            queryset = shape_records(queryset, *self.shape)
+        return queryset
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if self.action in self.shaped_actions:
+            context['fields'], context['expand'] = self.shape
+        return context
+
+    def get_related_updated_fields(self):
+        # 埋め込んだ山が変わったときも 304 にしない
+        return shape_updated_fields(self.shape[1]) if self.action in self.shaped_actions else []
+
+    def perform_create(self, serializer):
+        serializer.save(user=self.request.user)
+
+    @action(detail=False, methods=['get'])
+    def export(self, request):
+        """記録を NDJSON (既定) または CSV (?fmt=csv) で全件ストリーミングする。
+
+        一覧と同じ user / mountain / since / until / updated_since で絞り込める。
+        """
+        rows = export_rows(self.get_queryset())
+        if request.query_params.get('fmt') == 'csv':
+            content, content_type, ext = iter_csv(rows), 'text/csv; charset=utf-8', 'csv'
+        else:
+            content, content_type, ext = iter_ndjson(rows), 'application/x-ndjson; charset=utf-8', 'ndjson'
+        response = StreamingHttpResponse(buffered(content), content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="climb_records.{ext}"'
+        return response
+
+    @action(detail=False, methods=['post'], url_path='bulk',
+            parser_classes=[JSONParser, NDJSONParser],
+            permission_classes=[permissions.IsAuthenticated])
+    def bulk_create(self, request):
+        """JSON 配列または NDJSON の記録をまとめて登録する。不正な行 (NDJSON の読めない行も) は
+        登録せずに errors に行番号付きで返し、残りの行は登録を続ける。"""
+        rows = request.data
+        if isinstance(rows, dict):
+            rows = [rows]
+        created, errors = import_records(request.user, rows)
+        return Response(
+            {'created': created, 'errors': errors},
+            status=status.HTTP_207_MULTI_STATUS if errors else status.HTTP_201_CREATED,
+        )
+
+class PhotoUploadViewSet(mixins.CreateModelMixin, mixins.RetrieveModelMixin,
+                         mixins.DestroyModelMixin, viewsets.GenericViewSet):
+    """写真の分割アップロード。
+
+    POST で record・filename・size・sha256 を登録し、PUT で Upload-Offset ヘッダーの位置からの部分を
+    本文に入れて送る (途中で切れたら GET で offset を確かめて続きから送る)。
+    全部送ったら POST .../complete/ で処理を始め、GET で status が done になるのを待つ。
+    """
+    serializer_class = PhotoUploadSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        return PhotoUpload.objects.filter(user=self.request.user)
 
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
 
+    def perform_destroy(self, instance):
+        uploads.discard(instance)
+
+    def update(self, request, *args, **kwargs):
+        upload = self.get_object()
+        try:
+            offset = int(request.headers['Upload-Offset'])
+            length = int(request.headers['Content-Length'])
+        except (KeyError, ValueError):
+            raise ValidationError({'detail': ['Upload-Offset と Content-Length ヘッダーを指定してください。']})
+        try:
+            # 本文はパーサーを通さず、そのまま一時ファイルに書く
+            uploads.append_chunk(upload, offset, request.stream, length)
+        except uploads.OffsetMismatch as e:
+            return Response({'detail': str(e), 'offset': e.offset}, status=status.HTTP_409_CONFLICT)
+        except uploads.ChunkTooLarge as e:
+            return Response({'detail': str(e)}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        except uploads.UploadError as e:
+            raise ValidationError({'detail': [str(e)]})
+        return Response(self.get_serializer(upload).data)
+
+    @action(detail=True, methods=['post'])
+    def complete(self, request, pk=None):
+        upload = self.get_object()
+        try:
+            uploads.complete(upload)
+        except uploads.UploadError as e:
+            raise ValidationError({'detail': [str(e)]})
+        return Response(self.get_serializer(upload).data, status=status.HTTP_202_ACCEPTED)
+
+class SyncAPIView(APIView):
+    """差分同期。?cursor= に前回の応答の cursor を渡すと、その後の変更と削除だけを返す。
+
+    has_more が true の間は続けて呼ぶ。410 が返ったらカーソルを捨てて最初から同期し直す。
+    """
+
+    def get(self, request):
+        try:
+            limit = int(request.query_params.get('limit', settings.SYNC_BATCH_SIZE))
+        except ValueError:
+            raise ValidationError({'limit': ['整数で指定してください。']})
+        limit = max(1, min(limit, settings.SYNC_MAX_BATCH_SIZE))
+        try:
+            changes, cursor, has_more = sync.changes(request.query_params.get('cursor') or None, limit)
+        except sync.InvalidCursor:
+            raise ValidationError({'cursor': ['カーソルが正しくありません。']})
+        except sync.CursorExpired:
+            return Response(
+                {'detail': 'カーソルが古すぎます。カーソルなしで最初から同期し直してください。'},
+                status=status.HTTP_410_GONE,
+            )
+
+        context = {'request': request}
+        deleted = {'mountains': [], 'records': []}
+        for tombstone in changes['deleted']:
+            deleted['mountains' if tombstone.kind == Tombstone.MOUNTAIN else 'records'].append(tombstone.object_id)
+        return Response({
+            'mountains': MountainSerializer(changes['mountains'], many=True, context=context).data,
+            'records': ClimbRecordSerializer(changes['records'], many=True, context=context).data,
+            'deleted': deleted,
+            'cursor': cursor,
+            'has_more': has_more,
+        })
+
+class UserStatsAPIView(APIView):
+    """?user= (ユーザー名) の登山の統計を返す。省略時はログイン中のユーザー"""
+
+    def get(self, request):
+        username = request.query_params.get('user')
+        if username:
+            user = get_object_or_404(User, username=username)
+        elif request.user.is_authenticated:
+            user = request.user
+        else:
+            raise NotAuthenticated
+        return Response({'user': user.username, **stats.user_stats(user.pk)})
+
+class LeaderboardAPIView(APIView):
+    """ランキング。?metric= (climbs / peaks / elevation) の多い順に返す。
+
+    ?prefecture= (都道府県) か ?mountain= (山のID) で範囲を、?year= で年を絞れる (山ごとは全期間だけ)。
+    """
+
+    def get(self, request):
+        params = request.query_params
+        metric = params.get('metric', 'climbs')
+        if metric not in LeaderboardEntry.METRICS:
+            raise ValidationError({'metric': [f'{", ".join(LeaderboardEntry.METRICS)} のどれかを指定してください。']})
+        try:
+            year = int(params.get('year') or leaderboards.ALL_TIME)
+            mountain = int(params['mountain']) if params.get('mountain') else None
+            size = int(params.get('page_size', settings.REST_FRAMEWORK['PAGE_SIZE']))
+        except ValueError:
+            raise ValidationError({'detail': ['year・mountain・page_size は整数で指定してください。']})
+        size = max(1, min(size, settings.API_MAX_PAGE_SIZE))
+
+        if mountain is not None:
+            if year or params.get('prefecture'):
+                raise ValidationError({'mountain': ['山ごとのランキングは年や都道府県と組み合わせられません。']})
+            scope = leaderboards.mountain_scope(mountain)
+        elif params.get('prefecture'):
+            scope = leaderboards.prefecture_scope(params['prefecture'])
+        else:
+            scope = leaderboards.OVERALL
+
+        try:
+            rows, cursor = leaderboards.page(metric, scope, year, size, params.get('cursor'))
+        except leaderboards.InvalidCursor:
+            raise ValidationError({'cursor': ['カーソルが正しくありません。']})
+        return Response({
+            'next': replace_query_param(request.build_absolute_uri(), 'cursor', cursor) if cursor else None,
+            'results': [
+                {'rank': rank, 'user': entry.user.username,
+                 **{name: getattr(entry, name) for name in LeaderboardEntry.METRICS}}
+                for rank, entry in rows
+            ],
+        })
+
+def media_etag(request, path):
+    key = immutable_key(path)
+    if key:
+        return key
+    try:
+        stat = os.stat(photo_storage().path(path))
+    except (OSError, SuspiciousFileOperation):
+        return None
+    return f'{stat.st_mtime_ns:x}-{stat.st_size:x}'
+
+@condition(etag_func=media_etag)
+def serve_media(request, path):
+    """MEDIA_URL のファイルを返す (SERVE_MEDIA のとき)。
+
+    ハッシュを名前にした写真 (paplib.storage) は名前が同じなら内容も変わらないので、immutable として長くキャッシュさせる。
+    """
+    response = serve(request, path, document_root=settings.MEDIA_ROOT)
+    if immutable_key(path):
+        patch_cache_control(response, public=True, max_age=settings.MEDIA_IMMUTABLE_MAX_AGE, immutable=True)
+    return response
+
 class RegisterPageView(TemplateView):
     template_name = 'paplib/register.html'
 